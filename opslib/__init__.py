@@ -3,14 +3,24 @@
 from .components import Component, Stack
 from .lazy import Lazy, MaybeLazy, evaluate, lazy_property
 from .local import run
-from .places import Command, Directory, File, LocalHost, SshHost
+from .places import (
+    Command,
+    ContainerHost,
+    Directory,
+    File,
+    HostGroup,
+    LocalHost,
+    SshHost,
+)
 from .props import Prop
 
 __all__ = [
     "Command",
     "Component",
+    "ContainerHost",
     "Directory",
     "File",
+    "HostGroup",
     "Lazy",
     "LocalHost",
     "MaybeLazy",
@@ -0,0 +1,546 @@
+"""
+Helper that inspects and changes files on the target host, without going
+through Ansible. It only uses the Python standard library, so that its source
+can be sent to the host and executed with ``python3 -c``. A request is a JSON
+object with the name of an operation and its arguments, read from standard
+input; the response is written as JSON to standard output.
+
+With the ``--serve`` argument, the helper keeps running, and handles a stream
+of requests. Each request and response is framed as a 4-byte big-endian length
+followed by that many bytes of JSON. Binary data is encoded as base64.
+"""
+
+import base64
+import grp
+import hashlib
+import io
+import json
+import os
+import pwd
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+MAX_DIFF_SIZE = 104448
+
+
+class AgentError(Exception):
+    pass
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def _read_for_diff(path):
+    if os.path.getsize(path) > MAX_DIFF_SIZE:
+        return None
+
+    with open(path, "rb") as f:
+        return _text_for_diff(f.read())
+
+
+def _text_for_diff(data):
+    if len(data) > MAX_DIFF_SIZE:
+        return None
+
+    try:
+        return data.decode("utf8")
+
+    except UnicodeDecodeError:
+        return None
+
+
+def _get_attributes(st):
+    try:
+        owner = pwd.getpwuid(st.st_uid).pw_name
+
+    except KeyError:
+        owner = str(st.st_uid)
+
+    try:
+        group = grp.getgrgid(st.st_gid).gr_name
+
+    except KeyError:
+        group = str(st.st_gid)
+
+    return {
+        "mode": "%04o" % stat.S_IMODE(st.st_mode),
+        "owner": owner,
+        "group": group,
+    }
+
+
+def _attributes_diff(path, st, mode, owner, group):
+    # same format as the diff of Ansible's file modules: owner and group are
+    # numeric ids, and only the attributes that change are listed
+    current = {"owner": st.st_uid, "group": st.st_gid, "mode": stat.S_IMODE(st.st_mode)}
+    wanted = {}
+    if owner is not None:
+        wanted["owner"] = pwd.getpwnam(owner).pw_uid
+    if group is not None:
+        wanted["group"] = grp.getgrnam(group).gr_gid
+    if mode is not None:
+        wanted["mode"] = int(mode, 8)
+
+    changed = [key for key in wanted if wanted[key] != current[key]]
+    if not changed:
+        return None
+
+    def state(values):
+        return {
+            "path": path,
+            **{
+                key: "0%03o" % values[key] if key == "mode" else values[key]
+                for key in changed
+            },
+        }
+
+    return {"before": state(current), "after": state(wanted)}
+
+
+def _set_attributes(path, mode, owner, group):
+    if mode is not None:
+        os.chmod(path, int(mode, 8))
+
+    if owner is not None or group is not None:
+        uid = pwd.getpwnam(owner).pw_uid if owner is not None else -1
+        gid = grp.getgrnam(group).gr_gid if group is not None else -1
+        os.chown(path, uid, gid)
+
+
+def _default_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def _write_atomic(path, content, mode):
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            os.fchmod(f.fileno(), mode)
+
+        os.replace(tmp_path, path)
+
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def ensure_file(
+    path,
+    content=None,
+    mode=None,
+    owner=None,
+    group=None,
+    check=False,
+    content_base64=None,
+    content_sha256=None,
+):
+    """
+    Make sure that ``path`` is a regular file with the given content and
+    attributes. The content is either text, or binary data given as
+    ``content_base64``. In check mode, only report the differences; the
+    content may then be replaced by its ``content_sha256`` digest, in which
+    case the diff doesn't show it.
+    """
+
+    if content_base64 is not None:
+        data = _decode(content_base64)
+
+    elif content is not None:
+        data = content.encode("utf8")
+
+    elif content_sha256 is not None and check:
+        data = None
+
+    else:
+        raise AgentError("No content given")
+
+    digest = hashlib.sha256(data).hexdigest() if data is not None else content_sha256
+
+    try:
+        st = os.lstat(path)
+
+    except FileNotFoundError:
+        st = None
+
+    if st is not None and not stat.S_ISREG(st.st_mode):
+        raise AgentError(f"{path} exists and is not a regular file")
+
+    # like Ansible's copy module, show the content diff if the content
+    # changes, and otherwise the attributes diff
+    diff = []
+    content_changed = st is None or _sha256(path) != digest
+    if content_changed:
+        before = _read_for_diff(path) if st is not None else ""
+        after = _text_for_diff(data) if data is not None else None
+        if before is not None and after is not None:
+            diff.append({"before": before, "after": after})
+        else:
+            diff.append({"binary": True})
+
+    attributes_diff = None
+    if st is not None:
+        attributes_diff = _attributes_diff(path, st, mode, owner, group)
+        if attributes_diff and not content_changed:
+            diff = attributes_diff
+
+    changed = content_changed or attributes_diff is not None
+    if changed and not check:
+        if content_changed:
+            if mode is not None:
+                new_mode = int(mode, 8)
+            elif st is not None:
+                new_mode = stat.S_IMODE(st.st_mode)
+            else:
+                new_mode = _default_mode()
+
+            _write_atomic(path, data, new_mode)
+
+        _set_attributes(path, mode, owner, group)
+
+    return {"changed": changed, "diff": diff}
+
+
+def ensure_directory(path, mode=None, owner=None, group=None, check=False):
+    """
+    Make sure that ``path`` is a directory with the given attributes. Missing
+    parent directories are created. In check mode, only report the
+    differences.
+    """
+
+    try:
+        st = os.stat(path)
+
+    except FileNotFoundError:
+        st = None
+
+    if st is not None and not stat.S_ISDIR(st.st_mode):
+        raise AgentError(f"{path} exists and is not a directory")
+
+    if st is None:
+        diff = {
+            "before": {"path": path, "state": "absent"},
+            "after": {"path": path, "state": "directory"},
+        }
+        if not check:
+            os.makedirs(path)
+            _set_attributes(path, mode, owner, group)
+
+        return {"changed": True, "diff": diff}
+
+    attributes_diff = _attributes_diff(path, st, mode, owner, group)
+    if attributes_diff is None:
+        return {"changed": False, "diff": []}
+
+    if not check:
+        _set_attributes(path, mode, owner, group)
+
+    return {"changed": True, "diff": attributes_diff}
+
+
+def _encode(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def _decode(text):
+    return base64.b64decode(text)
+
+
+def exec_(args, shell=False, input=None, cwd=None):
+    """
+    Run a command and return its exit code and output. With ``shell``, the
+    single argument is a command line for ``/bin/sh``.
+    """
+
+    completed = subprocess.run(
+        args[0] if shell else args,
+        shell=shell,
+        input=_decode(input) if input is not None else None,
+        stdin=subprocess.DEVNULL if input is None else None,
+        capture_output=True,
+        cwd=cwd,
+    )
+    return {
+        "returncode": completed.returncode,
+        "stdout": _encode(completed.stdout),
+        "stderr": _encode(completed.stderr),
+    }
+
+
+def stat_(path):
+    """
+    Returns the type, size, modification time and attributes of ``path``, or
+    ``None`` if it doesn't exist. Symlinks are not followed.
+    """
+
+    try:
+        st = os.lstat(path)
+
+    except FileNotFoundError:
+        return None
+
+    if stat.S_ISREG(st.st_mode):
+        kind = "file"
+    elif stat.S_ISDIR(st.st_mode):
+        kind = "directory"
+    elif stat.S_ISLNK(st.st_mode):
+        kind = "link"
+    else:
+        kind = "other"
+
+    return dict(
+        _get_attributes(st),
+        type=kind,
+        size=st.st_size,
+        mtime=st.st_mtime,
+    )
+
+
+def hash_(path):
+    """
+    Returns the SHA-256 hex digest of the file at ``path``, or ``None`` if it
+    doesn't exist.
+    """
+
+    try:
+        return _sha256(path)
+
+    except FileNotFoundError:
+        return None
+
+
+def read_file(path):
+    """
+    Returns the content of the file at ``path``, base64-encoded.
+    """
+
+    with open(path, "rb") as f:
+        return _encode(f.read())
+
+
+def write_file(path, content, mode=None):
+    """
+    Atomically replace the file at ``path`` with ``content``, which is
+    base64-encoded.
+    """
+
+    _write_atomic(path, _decode(content), int(mode, 8) if mode else _default_mode())
+
+
+def chmod(path, mode):
+    os.chmod(path, int(mode, 8))
+
+
+def chown(path, owner=None, group=None):
+    _set_attributes(path, None, owner, group)
+
+
+def get_manifest(root):
+    """
+    Describe the tree at ``root``, as a dictionary that maps each relative
+    path to its type, size, modification time, mode, and for symlinks, the
+    target. Returns an empty dictionary if ``root`` doesn't exist.
+    """
+
+    manifest = {}
+    for directory, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(directory, name)
+            st = os.lstat(path)
+            entry = {
+                "mode": "%04o" % stat.S_IMODE(st.st_mode),
+                "mtime": int(st.st_mtime),
+            }
+            if stat.S_ISLNK(st.st_mode):
+                entry.update(type="link", target=os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                entry.update(type="directory")
+            elif stat.S_ISREG(st.st_mode):
+                entry.update(type="file", size=st.st_size)
+            else:
+                continue
+
+            manifest[os.path.relpath(path, root)] = entry
+
+    return manifest
+
+
+def manifest(path, expected=None):
+    """
+    Same as :func:`get_manifest`. Files that have the size given in
+    ``expected``, but a different modification time, are hashed, so that the
+    caller can tell whether the content is different.
+    """
+
+    result = get_manifest(path)
+    for name, entry in (expected or {}).items():
+        current = result.get(name)
+        if (
+            current is not None
+            and current["type"] == "file"
+            and current["size"] == entry["size"]
+            and current["mtime"] != entry["mtime"]
+        ):
+            current["sha256"] = _sha256(os.path.join(path, name))
+
+    return result
+
+
+def _check_member(root, member):
+    target = os.path.realpath(os.path.join(root, member.name))
+    if os.path.commonpath([root, target]) != root:
+        raise AgentError(f"Refusing to extract {member.name!r} outside {root}")
+
+    if not (member.isfile() or member.isdir() or member.issym()):
+        raise AgentError(f"Refusing to extract special file {member.name!r}")
+
+    member.uid, member.gid = os.getuid(), os.getgid()
+    member.uname = member.gname = ""
+
+
+def extract_tar(path, content, delete=()):
+    """
+    Extract a tar archive, base64-encoded, into the directory at ``path``,
+    which is created if missing, then remove the paths in ``delete``,
+    relative to ``path``.
+    """
+
+    root = os.path.realpath(path)
+    os.makedirs(root, exist_ok=True)
+
+    # members are checked above, so there's no need for Python's own filter
+    options = {"filter": "fully_trusted"} if hasattr(tarfile, "data_filter") else {}
+
+    with tarfile.open(fileobj=io.BytesIO(_decode(content))) as tar:
+        for member in tar.getmembers():
+            _check_member(root, member)
+
+            # replace existing files of a different type
+            target = os.path.join(root, member.name)
+            if os.path.islink(target):
+                os.unlink(target)
+            elif os.path.isdir(target):
+                if not member.isdir():
+                    shutil.rmtree(target)
+            elif os.path.exists(target) and member.isdir():
+                os.unlink(target)
+
+            tar.extract(member, root, numeric_owner=True, **options)
+
+    for name in sorted(delete, reverse=True):
+        target = os.path.join(root, name)
+        _check_member(root, tarfile.TarInfo(name))
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        elif os.path.lexists(target):
+            os.unlink(target)
+
+
+def batch(calls):
+    """
+    Run several operations, in order, stopping at the first one that fails.
+    Returns a list of responses.
+    """
+
+    responses = []
+    for call in calls:
+        response = handle(call)
+        responses.append(response)
+        if "error" in response:
+            break
+
+    return responses
+
+
+OPERATIONS = {
+    "ensure_file": ensure_file,
+    "ensure_directory": ensure_directory,
+    "exec": exec_,
+    "stat": stat_,
+    "hash": hash_,
+    "read_file": read_file,
+    "write_file": write_file,
+    "chmod": chmod,
+    "chown": chown,
+    "manifest": manifest,
+    "extract_tar": extract_tar,
+    "batch": batch,
+}
+
+
+def handle(request):
+    """
+    Handle a request of the form ``{"op": name, "args": {...}}``. Returns
+    ``{"result": ...}`` on success, or ``{"error": message}``.
+    """
+
+    try:
+        operation = OPERATIONS[request["op"]]
+        return {"result": operation(**request.get("args", {}))}
+
+    except Exception as error:
+        return {"error": f"{type(error).__name__}: {error}"}
+
+
+def read_frame(f):
+    """
+    Read a framed message from the binary stream ``f``. Returns ``None`` at
+    the end of the stream.
+    """
+
+    header = f.read(4)
+    if len(header) < 4:
+        return None
+
+    (size,) = struct.unpack(">I", header)
+    return json.loads(f.read(size))
+
+
+def write_frame(f, message):
+    """
+    Write a framed message to the binary stream ``f``.
+    """
+
+    payload = json.dumps(message).encode("utf8")
+    f.write(struct.pack(">I", len(payload)) + payload)
+    f.flush()
+
+
+def serve(stdin, stdout):
+    """
+    Handle framed requests from ``stdin`` until it's closed.
+    """
+
+    while True:
+        request = read_frame(stdin)
+        if request is None:
+            return
+
+        write_frame(stdout, handle(request))
+
+
+def main():
+    if "--serve" in sys.argv[1:]:
+        serve(sys.stdin.buffer, sys.stdout.buffer)
+        return
+
+    request = json.loads(sys.stdin.buffer.read())
+    sys.stdout.write(json.dumps(handle(request)))
+
+
+if __name__ == "__main__":
+    main()
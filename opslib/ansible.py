@@ -1,44 +1,134 @@
+import json
 import logging
+import os
+import shutil
 from collections.abc import Callable
+from contextlib import contextmanager
+from functools import cache
+from pathlib import Path
 from typing import Optional
 from warnings import warn
 
-from ansible import context
-from ansible.executor.task_queue_manager import TaskQueueManager
-from ansible.inventory.manager import InventoryManager
-from ansible.module_utils.common.collections import ImmutableDict
-from ansible.parsing.dataloader import DataLoader
-from ansible.playbook.play import Play
-from ansible.plugins.callback import CallbackBase
-from ansible.vars.manager import VariableManager
 from opslib.state import StatefulMixin
 
 from .callbacks import Callbacks
 from .components import Component
-from .lazy import evaluate
+from .lazy import NotAvailable, evaluate
+from .operations import current_operation
 from .places import BaseHost
 from .props import Prop
-from .results import Result
+from .results import OperationError, Result
 from .uptodate import UpToDate
+from .utils import get_cache_directory, get_private_directory
 
 logger = logging.getLogger(__name__)
 
 
-class StdoutCallback(CallbackBase):
+class StdoutCallback:
+    """
+    Collects the results of a play. Ansible expects an instance of its
+    ``CallbackBase``; :func:`get_stdout_callback_class` combines the two when
+    Ansible is first used.
+    """
+
     def __init__(self):
+        self.reset()
+
+    def reset(self):
         self.results = []
         self.errors = False
+        self.task_results = {}
+        self.skipped = set()
 
-    def v2_runner_on_ok(self, result):
+    def _key(self, result):
+        return (result._host.get_name(), result._task.get_name())
+
+    def _record(self, result, failed):
         self.results.append(result._result)
+        self.task_results[self._key(result)] = (result._result, failed)
+
+    def v2_runner_on_ok(self, result):
+        self._record(result, failed=False)
+
+    def v2_runner_on_skipped(self, result):
+        self.skipped.add(self._key(result))
 
     def v2_runner_on_unreachable(self, result):
         self.errors = True
-        self.results.append(result._result)
+        self._record(result, failed=True)
 
     def v2_runner_on_failed(self, result, **kwargs):
         self.errors = True
-        self.results.append(result._result)
+        self._record(result, failed=True)
+
+
+@cache
+def get_stdout_callback_class():
+    from ansible.plugins.callback import CallbackBase
+
+    return type("StdoutCallback", (StdoutCallback, CallbackBase), {})
+
+
+def get_ansiballz_cache_directory():
+    """
+    Directory where module payloads ("AnsiballZ" files) are kept across runs,
+    for the installed version of Ansible.
+    """
+
+    from ansible.release import __version__
+
+    return get_cache_directory() / "ansiballz" / __version__
+
+
+def _get_ansiballz_tmp_directory():
+    # Ansible caches payloads here, in a temporary directory for each process
+    from ansible import constants as C
+
+    return Path(C.DEFAULT_LOCAL_TMP) / "ansiballz_cache"
+
+
+def _copy_atomic(source, target):
+    part = target.with_name(f"{target.name}-{os.getpid()}-part")
+    shutil.copyfile(source, part)
+    os.replace(part, target)
+
+
+def restore_ansiballz_cache():
+    """
+    Copy module payloads, built during previous runs, to Ansible's temporary
+    directory, so that it doesn't need to build them again.
+    """
+
+    cache_dir = get_ansiballz_cache_directory()
+    if not cache_dir.is_dir():
+        return
+
+    tmp_dir = _get_ansiballz_tmp_directory()
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    for path in cache_dir.iterdir():
+        if not (tmp_dir / path.name).exists():
+            _copy_atomic(path, tmp_dir / path.name)
+
+
+def save_ansiballz_cache():
+    """
+    Save module payloads built by Ansible during this run. Only payloads of
+    modules that ship with Ansible are saved, because they can't change
+    without the Ansible version changing too.
+    """
+
+    tmp_dir = _get_ansiballz_tmp_directory()
+    if not tmp_dir.is_dir():
+        return
+
+    cache_dir = get_ansiballz_cache_directory()
+    for path in tmp_dir.iterdir():
+        if not path.name.startswith("ansible.modules.") or path.name.endswith("-part"):
+            continue
+
+        if not (cache_dir / path.name).exists():
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            _copy_atomic(path, cache_dir / path.name)
 
 
 class AnsibleResult(Result):
@@ -80,6 +170,131 @@ class AnsibleResult(Result):
         )
 
 
+class AnsibleSession:
+    """
+    Long-lived Ansible machinery for a set of hosts. The loader, inventory,
+    variable manager and task queue manager are created once, and reused for
+    each play that is run on the hosts.
+
+    :param hosts: List of ``(hostname, ansible_variables)`` pairs.
+    :param forks: Maximum number of hosts that Ansible will act on in
+                  parallel. Defaults to Ansible's own ``forks`` setting.
+    """
+
+    def __init__(self, hosts, forks=None):
+        # Ansible takes a while to import, so it's only loaded once a session
+        # is needed, not when the stack is defined.
+        from ansible import constants as C
+        from ansible import context
+        from ansible.executor.task_queue_manager import TaskQueueManager
+        from ansible.inventory.manager import InventoryManager
+        from ansible.module_utils.common.collections import ImmutableDict
+        from ansible.parsing.dataloader import DataLoader
+        from ansible.vars.manager import VariableManager
+
+        self.hostnames = [hostname for hostname, _ in hosts]
+
+        context.CLIARGS = ImmutableDict(
+            connection="smart",
+            check=False,
+            diff=True,
+            verbosity=0,
+        )
+
+        self.loader = DataLoader()
+        self.inventory = InventoryManager(
+            loader=self.loader,
+            sources=",".join(self.hostnames) + ",",
+        )
+        self.variable_manager = VariableManager(
+            loader=self.loader, inventory=self.inventory
+        )
+        for hostname, ansible_variables in hosts:
+            for name, value in ansible_variables:
+                if name == "ansible_control_path_dir":
+                    get_private_directory(Path(value))
+                self.variable_manager.set_host_variable(hostname, name, value)
+
+        restore_ansiballz_cache()
+
+        self.stdout_callback = get_stdout_callback_class()()
+        self.task_queue_manager = TaskQueueManager(
+            inventory=self.inventory,
+            variable_manager=self.variable_manager,
+            loader=self.loader,
+            passwords={},
+            stdout_callback=self.stdout_callback,
+            forks=forks or C.DEFAULT_FORKS,
+        )
+
+    def run(self, tasks, check=False):
+        """
+        Run a play with the given tasks on all hosts. Returns the callback
+        object that collected the results.
+        """
+
+        from ansible.playbook.play import Play
+
+        self.stdout_callback.reset()
+
+        # failures from previous plays would make Ansible skip the host
+        self.task_queue_manager.clear_failed_hosts()
+        self.task_queue_manager._unreachable_hosts.clear()
+
+        play = Play().load(
+            dict(
+                hosts=self.hostnames,
+                gather_facts="no",
+                check_mode=check,
+                diff=True,
+                tasks=tasks,
+            ),
+            variable_manager=self.variable_manager,
+            loader=self.loader,
+        )
+
+        self.task_queue_manager.run(play)
+        return self.stdout_callback
+
+    def close(self):
+        try:
+            self.task_queue_manager.cleanup()
+            save_ansiballz_cache()
+
+        finally:
+            self.loader.cleanup_all_tmp_files()
+
+
+@contextmanager
+def ansible_session(hosts, forks=None):
+    """
+    Get an :class:`AnsibleSession` for the hosts. During an operation,
+    sessions are shared by all plays on the same hosts; otherwise, a new
+    session is created, and closed when the context manager exits.
+    """
+
+    hosts = tuple(
+        (hostname, tuple(tuple(pair) for pair in ansible_variables))
+        for hostname, ansible_variables in hosts
+    )
+
+    def create_session():
+        return AnsibleSession(hosts, forks=forks)
+
+    op = current_operation()
+    if op is not None:
+        key = (AnsibleSession, hosts, forks)
+        yield op.session(key, create_session)
+        return
+
+    session = create_session()
+    try:
+        yield session
+
+    finally:
+        session.close()
+
+
 def run_ansible(hostname, ansible_variables, action, check=False):
     """
     Invoke Ansible with a single action. This creates and executes an Ansible
@@ -89,7 +304,8 @@ def run_ansible(hostname, ansible_variables, action, check=False):
     Instead of directly calling this function, typically one would create an
     :class:`AnsibleAction` in the stack, but it's usable directly if need be.
     It encapsulates all setup and teardown of the Ansible machinery and exposes
-    only the essential arguments.
+    only the essential arguments. When called during an operation, the Ansible
+    machinery is reused across calls for the same host.
 
     :param hostname: Name of the host to act on.
     :param ansible_variables: List of variables to configure Ansible.
@@ -99,44 +315,8 @@ def run_ansible(hostname, ansible_variables, action, check=False):
                   apply any changes, just show differences.
     """
 
-    context.CLIARGS = ImmutableDict(
-        connection="smart",
-        check=check,
-        diff=True,
-        verbosity=0,
-    )
-
-    loader = DataLoader()
-    inventory = InventoryManager(loader=loader, sources=f"{hostname},")
-    variable_manager = VariableManager(loader=loader, inventory=inventory)
-    for name, value in ansible_variables:
-        variable_manager.set_host_variable(hostname, name, value)
-
-    stdout_callback = StdoutCallback()
-    task_queue_manager = TaskQueueManager(
-        inventory=inventory,
-        variable_manager=variable_manager,
-        loader=loader,
-        passwords={},
-        stdout_callback=stdout_callback,
-    )
-
-    play = Play().load(
-        dict(
-            hosts=[hostname],
-            gather_facts="no",
-            tasks=[{"action": action}],
-        ),
-        variable_manager=variable_manager,
-        loader=loader,
-    )
-
-    try:
-        task_queue_manager.run(play)
-
-    finally:
-        task_queue_manager.cleanup()
-        loader.cleanup_all_tmp_files()
+    with ansible_session([(hostname, ansible_variables)]) as session:
+        stdout_callback = session.run([{"action": action}], check=check)
 
     if check and not stdout_callback.results:
         # XXX the module likely doesn't support "check" mode
@@ -147,6 +327,61 @@ def run_ansible(hostname, ansible_variables, action, check=False):
     return result
 
 
+def run_ansible_play(hosts, actions, check=False, forks=None):
+    """
+    Invoke Ansible with several actions, as the tasks of a single Play that
+    targets one or more hosts. Like with a playbook, the tasks run in order,
+    and each host stops at its first failed task. Hosts are acted on in
+    parallel, up to ``forks`` at a time.
+
+    Returns a dictionary with an item for each hostname, whose value is a list
+    with one item for each action: an :class:`AnsibleResult` (which may be
+    failed), a :class:`~opslib.results.Result` with ``changed=True`` if the
+    module was skipped because it doesn't support check mode, or ``None`` if
+    the action did not run because a previous one failed.
+
+    :param hosts: List of ``(hostname, ansible_variables)`` pairs. The
+                  hostnames must be distinct.
+    :param actions: List of actions, in the same format as for
+                    :func:`run_ansible`.
+    :param check: Same as for :func:`run_ansible`.
+    :param forks: Same as for :class:`AnsibleSession`.
+    """
+
+    tasks = [
+        {"name": f"opslib-{n}", "action": action} for n, action in enumerate(actions)
+    ]
+
+    with ansible_session(hosts, forks=forks) as session:
+        stdout_callback = session.run(tasks, check=check)
+
+    def get_result(hostname, name):
+        key = (hostname, name)
+        if key in stdout_callback.task_results:
+            data, failed = stdout_callback.task_results[key]
+            return AnsibleResult(data, failed)
+
+        if check and key in stdout_callback.skipped:
+            return Result(changed=True)
+
+        return None
+
+    return {
+        hostname: [get_result(hostname, task["name"]) for task in tasks]
+        for hostname, _ in hosts
+    }
+
+
+def run_ansible_tasks(hostname, ansible_variables, actions, check=False):
+    """
+    Same as :func:`run_ansible_play`, for a single host. Returns the list of
+    results for the host.
+    """
+
+    results = run_ansible_play([(hostname, ansible_variables)], actions, check=check)
+    return results[hostname]
+
+
 class AnsibleAction(StatefulMixin, Component):
     """
     The AnsibleAction component executes an Ansible module.
@@ -210,3 +445,107 @@ class AnsibleAction(StatefulMixin, Component):
     @uptodate.deploy
     def deploy(self, dry_run=False):
         return self.run(check=dry_run)
+
+    def get_batch_key(self, method):
+        if method in ["refresh", "deploy"]:
+            return AnsibleAction
+
+        return None
+
+    @classmethod
+    def apply_batch(cls, method, actions, dry_run=False):
+        """
+        Run consecutive actions as Ansible plays. Consecutive actions on the
+        same host run as the tasks of a single play; consecutive hosts that
+        have identical lists of tasks share one play, and Ansible runs them in
+        parallel. The outcome is the same as calling :meth:`refresh` or
+        :meth:`deploy` on each action.
+        """
+
+        check = method == "refresh" or dry_run
+        op = current_operation()
+        outcomes = {}
+        pending = []
+
+        for action in actions:
+            try:
+                if method == "deploy" and action.uptodate.get():
+                    outcomes[action] = Result()
+                    continue
+
+                pending.append((action, action._get_ansible_args()))
+
+            except NotAvailable as error:
+                outcomes[action] = error
+
+        for play in _plan_plays(pending):
+            results = run_ansible_play(
+                hosts=list(play["hosts"]),
+                actions=play["actions"],
+                check=check,
+                forks=op.forks if op is not None else None,
+            )
+
+            failed = False
+            for (hostname, _), host_actions in play["hosts"].items():
+                for action, result in zip(host_actions, results[hostname]):
+                    if result is None:
+                        continue
+
+                    try:
+                        result.raise_if_failed("Ansible failed")
+
+                    except OperationError as error:
+                        outcomes[action] = error
+                        failed = True
+                        continue
+
+                    if result.changed and action.props.format_output:
+                        result.output = action.props.format_output(result)
+
+                    if not check:
+                        action.on_change.invoke()
+
+                    action.uptodate.set(
+                        not (check and result.changed), refreshed=(method == "refresh")
+                    )
+                    outcomes[action] = result
+
+            if failed:
+                break
+
+        return [outcomes.get(action) for action in actions]
+
+
+def _plan_plays(pending):
+    """
+    Group actions into plays, without changing their relative order.
+    Consecutive actions on the same host run as one play, and consecutive
+    plays on different hosts, with identical lists of actions, are merged
+    into a single multi-host play.
+    """
+
+    runs = []
+    for action, ansible_args in pending:
+        host = (
+            ansible_args["hostname"],
+            tuple(tuple(pair) for pair in ansible_args["ansible_variables"]),
+        )
+        if not runs or runs[-1][0] != host:
+            runs.append((host, []))
+        runs[-1][1].append((action, ansible_args["action"]))
+
+    plays = []
+    for host, items in runs:
+        play_actions = [play_action for _, play_action in items]
+        signature = json.dumps(play_actions, sort_keys=True, default=str)
+
+        play = plays[-1] if plays else None
+        hostnames = {hostname for hostname, _ in play["hosts"]} if play else set()
+        if play is None or play["signature"] != signature or host[0] in hostnames:
+            play = dict(signature=signature, actions=play_actions, hosts={})
+            plays.append(play)
+
+        play["hosts"][host] = [action for action, _ in items]
+
+    return plays
@@ -10,6 +10,7 @@ import click
 import opslib
 from .operations import apply, print_report
 from .results import OperationError
+from .utils import parse_duration
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +47,17 @@ def interact(banner=None, local=None):
     code.interact(banner=banner, local=local)
 
 
+class Duration(click.ParamType):
+    name = "duration"
+
+    def convert(self, value, param, ctx):
+        try:
+            return parse_duration(value)
+
+        except ValueError as error:
+            self.fail(str(error), param, ctx)
+
+
 class ComponentGroup(click.Group):
     def forward_command(self, *args, **kwargs):
         """
@@ -132,25 +144,40 @@ def get_cli(component: "opslib.Component") -> click.Group:
         def command(ctx, use_pdb, **kwargs):
             results = apply(component, use_pdb=use_pdb, **defaults, **kwargs)
             print_report(results)
+            if any(result.failed for result in results.values()):
+                sys.exit(1)
 
         for decorator in decorators:
             command = decorator(command)
 
         cli.command(name)(command)
 
+    upgrade_providers = click.option("--upgrade-providers", is_flag=True)
+    forks = click.option("-f", "--forks", type=click.IntRange(min=1))
+
     register_apply_command(
         "deploy",
         click.option("-n", "--dry-run", is_flag=True),
+        upgrade_providers,
+        forks,
         deploy=True,
     )
 
-    register_apply_command("diff", deploy=True, dry_run=True)
+    register_apply_command("diff", upgrade_providers, forks, deploy=True, dry_run=True)
 
-    register_apply_command("refresh", refresh=True)
+    register_apply_command(
+        "refresh",
+        click.option("--stale-only", is_flag=True),
+        click.option("--budget", type=Duration()),
+        upgrade_providers,
+        forks,
+        refresh=True,
+    )
 
     register_apply_command(
         "destroy",
         click.option("-n", "--dry-run", is_flag=True),
+        upgrade_providers,
         destroy=True,
     )
 
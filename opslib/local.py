@@ -2,7 +2,10 @@ import logging
 import os
 import subprocess
 import sys
+import tempfile
+import threading
 from collections.abc import Callable
+from pathlib import Path
 
 from .callbacks import Callbacks
 from .components import Component
@@ -13,6 +16,9 @@ from .state import JsonState
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TAIL_SIZE = 65536
+STREAM_CHUNK_SIZE = 65536
+
 
 class LocalRunResult(Result):
     """
@@ -22,28 +28,172 @@ class LocalRunResult(Result):
     :ivar completed: Exit code of the subprocess.
     :ivar stderr: Standard error from the subprocess (:class:`str`).
     :ivar stdout: Standard output from the subprocess (:class:`str`).
+    :ivar truncated: ``True`` if the output was streamed, and ``stdout`` and
+                     ``stderr`` only contain the end of it.
+    :ivar streamed: ``True`` if the output was streamed to the terminal, in
+                    which case :meth:`print_output` doesn't show it again.
+    :ivar spool_path: If the output was streamed, and the command failed or
+                      ``keep_spool`` was set, path of a temporary file with
+                      the complete output, otherwise ``None``. The caller is
+                      responsible for removing the file.
     """
 
-    def __init__(self, completed, encoding=None):
+    def __init__(
+        self,
+        completed,
+        encoding=None,
+        truncated=False,
+        spool_path=None,
+        streamed=False,
+    ):
         def decode(buf):
-            return buf.decode(encoding) if encoding else buf
+            if not encoding:
+                return buf
+
+            # the tail of the output may start in the middle of a character
+            return buf.decode(encoding, errors="replace" if truncated else "strict")
 
         self.completed = completed
         self.stderr = decode(self.completed.stderr or b"")
         self.stdout = decode(self.completed.stdout or b"")
+        self.truncated = truncated
+        self.spool_path = spool_path
+        self.streamed = streamed
 
         super().__init__(
             changed=True,
-            output=self.stderr + self.stdout,
+            output=None,
             failed=completed.returncode != 0,
         )
 
         logger.debug("%r output:\n====\n%s====", self, self.output)
 
+    @property
+    def output(self):
+        """
+        Combined ``stderr`` and ``stdout``, unless overwritten.
+        """
+
+        if self._output is None:
+            return self.stderr + self.stdout
+
+        return self._output
+
+    @output.setter
+    def output(self, value):
+        self._output = value
+
+    def print_output(self):
+        if not self.streamed:
+            super().print_output()
+
     def __str__(self):
         return f"{super().__str__()} {self.completed.args}"
 
 
+class _Tail:
+    """
+    Keeps the last ``size`` bytes written to it.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray()
+        self.truncated = False
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) > self.size:
+            del self.buffer[: len(self.buffer) - self.size]
+            self.truncated = True
+
+
+def _get_terminal_stream(stream):
+    return getattr(stream, "buffer", None) or stream
+
+
+def _write(target, data):
+    if hasattr(target, "encoding") and not hasattr(target, "buffer"):
+        # text stream, e.g. captured by a test runner
+        target.write(data.decode(target.encoding or "utf8", errors="replace"))
+    else:
+        target.write(data)
+
+    target.flush()
+
+
+def _run_streaming(args, input, stream, tail_size, keep_spool, **kwargs):
+    log_file = None
+    if stream is True:
+        targets = {"stdout": sys.stdout, "stderr": sys.stderr}
+
+    else:
+        if isinstance(stream, (str, Path)):
+            stream = log_file = open(stream, "ab")
+
+        targets = {"stdout": stream, "stderr": stream}
+
+    spool = tempfile.NamedTemporaryFile(prefix="opslib-run-", delete=False)
+    lock = threading.Lock()
+    tails = {name: _Tail(tail_size) for name in targets}
+
+    process = subprocess.Popen(
+        args,
+        stdin=subprocess.PIPE if input is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **kwargs,
+    )
+
+    def pump(name, pipe):
+        target = _get_terminal_stream(targets[name])
+        for chunk in iter(lambda: pipe.read1(STREAM_CHUNK_SIZE), b""):
+            with lock:
+                _write(target, chunk)
+                spool.write(chunk)
+                tails[name].write(chunk)
+
+    threads = [
+        threading.Thread(target=pump, args=("stdout", process.stdout)),
+        threading.Thread(target=pump, args=("stderr", process.stderr)),
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        if input is not None:
+            try:
+                process.stdin.write(input)
+                process.stdin.close()
+
+            except BrokenPipeError:
+                pass
+
+        for thread in threads:
+            thread.join()
+
+        returncode = process.wait()
+
+    finally:
+        spool.close()
+        if log_file is not None:
+            log_file.close()
+
+    completed = subprocess.CompletedProcess(
+        args,
+        returncode,
+        bytes(tails["stdout"].buffer),
+        bytes(tails["stderr"].buffer),
+    )
+    truncated = tails["stdout"].truncated or tails["stderr"].truncated
+    spool_path = Path(spool.name)
+    if not (keep_spool or returncode):
+        spool_path.unlink()
+        spool_path = None
+
+    return completed, truncated, spool_path
+
+
 def run(
     *args,
     input=None,
@@ -54,6 +204,9 @@ def run(
     exit_on_error=False,
     check=True,
     exec=False,
+    stream=False,
+    tail_size=DEFAULT_TAIL_SIZE,
+    keep_spool=False,
     **kwargs,
 ):
     """
@@ -77,6 +230,18 @@ def run(
                  using :func:`os.execvpe`. This will replace the current
                  program with the new one. Useful when wrapping commands for
                  the CLI.
+    :param stream: Show the output while the subprocess runs, instead of
+                   capturing it all in memory. If ``True``, output is copied
+                   to the terminal; if it's a path or a binary file object,
+                   output is appended to it. Only the last ``tail_size``
+                   bytes of each of *stdout* and *stderr* are kept in the
+                   result. The complete output is spooled to a temporary
+                   file, which is removed when the command succeeds, and
+                   otherwise kept, with its path in ``spool_path``.
+    :param tail_size: Number of bytes kept in the result when streaming.
+                      Defaults to 64 KiB.
+    :param keep_spool: When streaming, keep the temporary file with the
+                       complete output even if the command succeeds.
     """
 
     if input is None:
@@ -95,12 +260,21 @@ def run(
         env = dict(os.environ, **(extra_env or {}))
         os.execvpe(args[0], args, env)
 
-    completed = subprocess.run(
-        args,
-        input=input,
-        capture_output=capture_output,
-        **kwargs,
-    )
+    truncated = False
+    spool_path = None
+
+    if stream:
+        completed, truncated, spool_path = _run_streaming(
+            args, input, stream, tail_size, keep_spool, **kwargs
+        )
+
+    else:
+        completed = subprocess.run(
+            args,
+            input=input,
+            capture_output=capture_output,
+            **kwargs,
+        )
 
     if exit:
         sys.exit(completed.returncode)
@@ -108,7 +282,13 @@ def run(
     if exit_on_error and completed.returncode:
         sys.exit(completed.returncode)
 
-    result = LocalRunResult(completed, encoding=encoding)
+    result = LocalRunResult(
+        completed,
+        encoding=encoding,
+        truncated=truncated,
+        spool_path=spool_path,
+        streamed=stream is True,
+    )
     if check:
         result.raise_if_failed("Local command failed")
 
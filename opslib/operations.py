@@ -1,16 +1,27 @@
 import logging
+import math
 import pdb
 import sys
+import time
 from collections import defaultdict
+from contextlib import ExitStack
+from contextvars import ContextVar
 
 from click import echo, style
 
+from .components import walk
 from .lazy import Lazy, NotAvailable, evaluate
 from .results import OperationError, Result
+from .uptodate import get_refreshed, is_stale
 
 logger = logging.getLogger(__name__)
 
 
+_current_operation: "ContextVar[Operation | None]" = ContextVar(
+    "current_operation", default=None
+)
+
+
 class AbortOperation(RuntimeError):
     pass
 
@@ -27,6 +38,17 @@ class Operation:
     :param refresh: If ``True``, inspect the state of the target and save it in
                     local state.
     :param destroy: If ``True``, destroy the target resource.
+    :param stale_only: If ``True``, together with ``refresh``, skip components
+                       whose last refresh is within their refresh TTL.
+    :param budget: A :class:`~datetime.timedelta`. Together with ``refresh``,
+                   refresh the stalest components first, and stop when the
+                   time budget is spent.
+    :param upgrade_providers: If ``True``, Terraform components run
+                              ``terraform init -upgrade`` even if their
+                              provider requirements haven't changed.
+    :param forks: Maximum number of hosts that Ansible acts on in parallel,
+                  when a play targets several hosts. Defaults to Ansible's own
+                  ``forks`` setting.
     """
 
     FLAGS = [
@@ -34,24 +56,69 @@ class Operation:
         "deploy",
         "refresh",
         "destroy",
+        "stale_only",
+        "upgrade_providers",
     ]
 
+    OPTIONS = {
+        "budget": None,
+        "forks": None,
+    }
+
     def __init__(self, **kwargs):
         self.results = {}
+        self.sessions = {}
+        self._exit_stack = ExitStack()
         for flag in self.FLAGS:
             setattr(self, flag, kwargs.pop(flag, False))
+        for name, default in self.OPTIONS.items():
+            setattr(self, name, kwargs.pop(name, default))
         assert not kwargs, f"Unknown flags: {list(kwargs)}"
 
     def __str__(self):
+        names = [*self.FLAGS, *self.OPTIONS]
         return ", ".join(
-            f"{flag}={value}"
-            for flag, value in ((flag, getattr(self, flag)) for flag in self.FLAGS)
+            f"{name}={value}"
+            for name, value in ((name, getattr(self, name)) for name in names)
             if value
         )
 
     def __repr__(self):
         return f"<Operation {self}>"
 
+    def __enter__(self):
+        self._token = _current_operation.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current_operation.reset(self._token)
+        self.sessions.clear()
+        self._exit_stack.close()
+
+    def session(self, key, factory):
+        """
+        Get a long-lived object that is shared for the duration of the
+        operation, e.g. a connection to a host. If there is no session for
+        ``key``, it's created by calling ``factory()``. Sessions must have a
+        ``close()`` method, which is called when the operation ends.
+        """
+
+        if key not in self.sessions:
+            session = factory()
+            self._exit_stack.callback(session.close)
+            self.sessions[key] = session
+
+        return self.sessions[key]
+
+
+def current_operation() -> Operation | None:
+    """
+    Returns the :class:`Operation` that is currently being applied, or
+    ``None``.
+    """
+
+    return _current_operation.get()
+
 
 class Printer:
     def __init__(self, component, suffix=""):
@@ -121,61 +188,316 @@ class Runner:
             return result
 
         except BaseException as exception:
-            if self.debug:
-                raise RuntimeError from exception
+            return self.handle_exception(exception)
 
-            if isinstance(exception, NotAvailable):
-                result = Result(failed=True, output=exception.args[0])
-                self.printer.print_result(result)
-                return result
+    def handle_exception(self, exception):
+        """
+        Report an exception raised while running the component. Returns a
+        failed result if the operation can continue, otherwise raises
+        :class:`AbortOperation`.
+        """
 
-            if isinstance(exception, OperationError):
-                logger.warning("Run failed on %s: %r", self.component, exception)
+        if self.debug:
+            raise RuntimeError from exception
 
-                if self.use_pdb:
-                    logger.exception("Command failed")
-                    pdb.post_mortem()
-                    sys.exit(1)
+        if isinstance(exception, NotAvailable):
+            result = Result(failed=True, output=exception.args[0])
+            self.printer.print_result(result)
+            return result
 
-                try:
-                    self.printer.print_result(exception.result)
+        if isinstance(exception, OperationError):
+            logger.warning("Run failed on %s: %r", self.component, exception)
 
-                except Exception:
-                    logger.exception(
-                        "Failed to print exception result at %r", self.component
-                    )
+            if self.use_pdb:
+                logger.exception("Command failed", exc_info=exception)
+                pdb.post_mortem(exception.__traceback__)
+                sys.exit(1)
 
-                echo(style("Operation failed!", fg="red"), file=sys.stderr)
-                raise AbortOperation from exception
+            try:
+                self.printer.print_result(exception.result)
 
-            raise
+            except Exception:
+                logger.exception(
+                    "Failed to print exception result at %r", self.component
+                )
 
+            echo(style("Operation failed!", fg="red"), file=sys.stderr)
+            raise AbortOperation from exception
 
-def iter_apply(component, op, use_pdb):
-    runner = Runner(component, use_pdb)
+        raise exception
+
+
+class Rollout:
+    """
+    Strategy to deploy the children of a component in stages, instead of all
+    at once, e.g. to update a fleet of hosts a few at a time. It's enabled by
+    setting the ``rollout`` attribute of the component. Children in a batch
+    are deployed one after the other; a failed child doesn't stop the others,
+    but if too many of them fail, the rollout stops before the next batch.
+    It only affects ``deploy``; ``diff``, ``refresh`` and ``destroy`` work as
+    usual.
+
+    :param canary: Number of children that are deployed first, in a batch of
+                   their own. If any of them fails, the rollout stops.
+                   Defaults to ``1``.
+    :param batch_size: Number of children in each of the following batches.
+                       Either an :class:`int`, or a percentage of the
+                       children, like ``"25%"``. Defaults to ``1``.
+    :param max_failure_rate: Fraction of the children in a batch that may
+                             fail, without stopping the rollout. Defaults to
+                             ``0``.
+    :param health_check: Optional callable, called after each batch with the
+                         list of its children. If it returns a false value,
+                         or raises an exception, the rollout stops.
+    """
+
+    def __init__(self, canary=1, batch_size=1, max_failure_rate=0.0, health_check=None):
+        if isinstance(batch_size, str):
+            if not batch_size.endswith("%"):
+                raise ValueError(f"Invalid batch size: {batch_size!r}")
+            float(batch_size[:-1])
+
+        elif batch_size < 1:
+            raise ValueError(f"Invalid batch size: {batch_size!r}")
+
+        self.canary = canary
+        self.batch_size = batch_size
+        self.max_failure_rate = max_failure_rate
+        self.health_check = health_check
+
+    def __repr__(self):
+        return f"<{type(self).__name__} batch_size={self.batch_size!r}>"
+
+    def get_batches(self, children):
+        """
+        Split ``children`` into batches: the canary, then batches of
+        ``batch_size``.
+        """
+
+        if isinstance(self.batch_size, str):
+            percent = float(self.batch_size[:-1])
+            size = max(1, math.ceil(len(children) * percent / 100))
+
+        else:
+            size = self.batch_size
+
+        batches = []
+        rest = list(children)
+        if self.canary:
+            batches.append(rest[: self.canary])
+            del rest[: self.canary]
+
+        while rest:
+            batches.append(rest[:size])
+            del rest[:size]
+
+        return batches
+
+    def is_healthy(self, batch):
+        if self.health_check is None:
+            return True
+
+        try:
+            return bool(self.health_check(batch))
+
+        except Exception:
+            logger.exception("Health check failed for %r", batch)
+            return False
+
+    def apply_child(self, child, op, use_pdb):
+        """
+        Apply ``op`` to ``child``, yielding its results. Returns ``True`` if
+        anything failed. If the child's deployment is aborted, a failed result
+        is yielded for the child, so that the failure is reported.
+        """
+
+        failed = False
+        try:
+            for item, result in iter_apply(child, op, use_pdb):
+                failed = failed or result.failed
+                yield item, result
+
+        except AbortOperation as abort:
+            error = abort.__cause__
+            if isinstance(error, OperationError):
+                yield child, error.result
+
+            else:
+                yield child, Result(failed=True)
+
+            failed = True
+
+        return failed
+
+    def apply(self, component, op, use_pdb):
+        children = list(component)
+        batches = self.get_batches(children)
+
+        for number, batch in enumerate(batches):
+            canary = number == 0 and self.canary > 0
+            label = "canary" if canary else f"batch {number + 1} of {len(batches)}"
+            names = ", ".join(child._meta.name for child in batch)
+            echo(style(f"{component} rollout, {label}: {names}", fg="cyan"))
+
+            failed = []
+            for child in batch:
+                if (yield from self.apply_child(child, op, use_pdb)):
+                    failed.append(child)
+
+            max_failure_rate = 0 if canary else self.max_failure_rate
+            if len(failed) / len(batch) > max_failure_rate:
+                self.stop(component, f"{len(failed)} of {len(batch)} failed")
+
+            if not self.is_healthy(batch):
+                self.stop(component, "health check failed")
+
+    def stop(self, component, reason):
+        echo(
+            style(f"Rollout of {component} stopped: {reason}", fg="red"),
+            file=sys.stderr,
+        )
+        raise AbortOperation(reason)
+
+
+def iter_steps(component, op):
+    """
+    Iterate over the steps of applying ``op`` to ``component`` and its
+    children, in order. Each step is a tuple of ``(component, method,
+    kwargs)``, where ``method`` is the name of the component method to call,
+    or a :class:`Rollout` that deploys the component's children.
+    """
 
     logger.debug("Applying %r to %r", op, component)
 
     children = list(component)
     if op.destroy:
         if hasattr(component, "destroy"):
-            yield component, runner.run(component.destroy, dry_run=op.dry_run)
+            yield component, "destroy", dict(dry_run=op.dry_run)
 
         assert not op.refresh
         assert not op.deploy
         children.reverse()
 
-    for child in children:
-        yield from iter_apply(child, op, use_pdb)
+    rollout = getattr(component, "rollout", None)
+    if op.deploy and not op.dry_run and isinstance(rollout, Rollout):
+        yield component, rollout, {}
+
+    else:
+        for child in children:
+            yield from iter_steps(child, op)
 
     if op.refresh:
         assert not op.dry_run
         if hasattr(component, "refresh"):
-            yield component, runner.run(component.refresh)
+            if not (op.stale_only and not is_stale(component)):
+                yield component, "refresh", {}
 
     if op.deploy:
         if hasattr(component, "deploy"):
-            yield component, runner.run(component.deploy, dry_run=op.dry_run)
+            yield component, "deploy", dict(dry_run=op.dry_run)
+
+
+def get_batch_key(step):
+    """
+    Components may be applied in batches, e.g. to run several actions on the
+    same host in one go. A component opts in by implementing
+    ``get_batch_key(method)``, which returns a hashable key, or ``None`` if
+    the step can't be batched. Consecutive steps with equal keys are executed
+    together, by calling the ``apply_batch(method, components, **kwargs)``
+    class method of the component's type, which returns, for each component,
+    its :class:`~opslib.results.Result` or the exception it raised.
+    """
+
+    component, method, _ = step
+    get_key = getattr(component, "get_batch_key", None)
+    if get_key is None or isinstance(method, Rollout):
+        return None
+
+    key = get_key(method)
+    if key is None:
+        return None
+
+    return (type(component), method, key)
+
+
+def iter_batches(steps):
+    batch = []
+    batch_key = None
+
+    for step in steps:
+        key = get_batch_key(step)
+        if batch and (key is None or key != batch_key):
+            yield batch
+            batch = []
+
+        batch.append(step)
+        batch_key = key
+
+    if batch:
+        yield batch
+
+
+def run_batch(batch, use_pdb):
+    component, method, kwargs = batch[0]
+    components = [step[0] for step in batch]
+    runners = [Runner(item, use_pdb) for item in components]
+
+    for runner in runners:
+        runner.printer.print_component(wip=True)
+
+    try:
+        outcomes = type(component).apply_batch(method, components, **kwargs)
+
+    except BaseException as exception:
+        yield component, runners[0].handle_exception(exception)
+        return
+
+    for item, runner, outcome in zip(components, runners, outcomes):
+        if outcome is None:
+            # not run, because an earlier step failed
+            continue
+
+        if isinstance(outcome, BaseException):
+            yield item, runner.handle_exception(outcome)
+
+        else:
+            runner.printer.print_result(outcome)
+            yield item, outcome
+
+
+def iter_apply(component, op, use_pdb):
+    for batch in iter_batches(iter_steps(component, op)):
+        if len(batch) > 1:
+            yield from run_batch(batch, use_pdb)
+            continue
+
+        [(item, method, kwargs)] = batch
+        if isinstance(method, Rollout):
+            yield from method.apply(item, op, use_pdb)
+            continue
+
+        runner = Runner(item, use_pdb)
+        yield item, runner.run(getattr(item, method), **kwargs)
+
+
+def iter_refresh_stalest(component, op, use_pdb):
+    assert op.refresh
+    assert not (op.dry_run or op.deploy or op.destroy)
+
+    candidates = [
+        child
+        for child in walk(component)
+        if hasattr(child, "refresh") and not (op.stale_only and not is_stale(child))
+    ]
+    candidates.sort(key=lambda child: get_refreshed(child) or 0)
+
+    deadline = time.monotonic() + op.budget.total_seconds()
+    for child in candidates:
+        if time.monotonic() >= deadline:
+            logger.info("Refresh budget spent at %r", child)
+            break
+
+        yield child, Runner(child, use_pdb).run(child.refresh)
 
 
 def apply(component, use_pdb=False, **kwargs):
@@ -187,12 +509,19 @@ def apply(component, use_pdb=False, **kwargs):
     ``deploy``, children are processed first. For ``destroy``, the parent
     component is processed first, then its children.
 
+    If a ``budget`` is given for ``refresh``, components are instead refreshed
+    in order of staleness, least recently refreshed first, until the budget is
+    spent.
+
     :param component: The :class:`Component` on which to apply the operation.
     :param kwargs: Keyword arguments are forwarded to :class:`Operation`.
     """
 
-    op = Operation(**kwargs)
-    return dict(iter_apply(component, op, use_pdb))
+    with Operation(**kwargs) as op:
+        if op.budget is not None:
+            return dict(iter_refresh_stalest(component, op, use_pdb))
+
+        return dict(iter_apply(component, op, use_pdb))
 
 
 def print_report(results):
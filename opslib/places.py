@@ -1,27 +1,160 @@
+import atexit
+import contextvars
+import hashlib
+import io
+import json
+import keyword
+import mmap
 import os
+import re
 import shlex
+import shutil
+import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+from base64 import b64decode, b64encode
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
+from datetime import timedelta
+from functools import cache
 from pathlib import Path
 from typing import Optional, Union, cast
 
+import click
+
+from . import agent
 from .callbacks import Callbacks
 from .components import Component
-from .lazy import Lazy, evaluate
+from .lazy import Lazy, NotAvailable, evaluate
 from .local import LocalRunResult, run
+from .operations import current_operation
 from .props import Prop
-from .results import Result
+from .results import OperationError, Result
 from .state import JsonState, StatefulMixin
-from .utils import diff
+from .uptodate import UpToDate
+from .utils import diff, get_cache_directory, get_private_directory
+
+OCTAL_MODE = re.compile(r"[0-7]{3,4}")
+
+# leaves room for "/" and the 40 characters of "%C", within the 104-108
+# characters that Unix socket paths are limited to
+MAX_CONTROL_PATH_DIR = 60
+
+
+COMMAND_BATCH_MARKER = "opslib-command-result"
+
+# keyword arguments of `run` that can be handled by the agent
+AGENT_RUN_KWARGS = {"input", "encoding", "check", "cwd", "capture_output"}
+
+
+@cache
+def get_agent_source():
+    return Path(agent.__file__).read_text()
+
+
+class AgentProcess:
+    """
+    A running :mod:`opslib.agent` helper that handles a stream of requests,
+    sent over a pipe.
+
+    :param args: Command that starts the helper with ``--serve``.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.lock = threading.Lock()
+
+    def request(self, request):
+        """
+        Send a request to the helper and return its response.
+        """
+
+        with self.lock:
+            try:
+                agent.write_frame(self.process.stdin, request)
+                response = agent.read_frame(self.process.stdout)
+
+            except BrokenPipeError:
+                response = None
+
+        if response is None:
+            result = Result(failed=True, output=f"Agent exited: {self.args[0]}")
+            result.raise_if_failed("Agent failed")
+
+        return response
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+_agent_processes = {}
+
+
+def _close_agent_processes():
+    for agent_process in _agent_processes.values():
+        agent_process.close()
+
+    _agent_processes.clear()
 
 
-class BaseHost(Component):
+def get_agent_process(args):
+    """
+    Returns an :class:`AgentProcess` started with ``args``. It's started on
+    first use, and reused until opslib exits.
+    """
+
+    key = tuple(args)
+    if key not in _agent_processes:
+        if not _agent_processes:
+            atexit.register(_close_agent_processes)
+
+        _agent_processes[key] = AgentProcess(args)
+
+    return _agent_processes[key]
+
+
+class _HostFacts:
+    """
+    Facts of a host, shared by all components for the duration of an
+    :class:`~opslib.operations.Operation`.
+    """
+
+    def __init__(self, host):
+        self.facts = host._load_facts()
+
+    def close(self):
+        pass
+
+
+class BaseHost(StatefulMixin, Component):
     """
     Abstract component for a host.
+
+    All hosts accept the following props:
+
+    :param facts_ttl: How long gathered :attr:`facts` are reused before being
+                      gathered again. Defaults to one hour.
+    :param facts_subset: List of fact subsets to gather, passed as
+                         ``gather_subset`` to Ansible's ``setup`` module.
+                         Defaults to ``["min"]``.
     """
 
     with_sudo = False
+    native = False
+    use_agent = False
+    batch_commands = False
     ansible_variables: list
+    facts_state = JsonState()
 
     def file(self, **props):
         """
@@ -74,6 +207,192 @@ class BaseHost(Component):
             **props,
         )
 
+    def native_action(self, **props):
+        """
+        Shorthand function that returns a :class:`NativeAction` component with
+        ``host`` set to this host. Keyword arguments are forwarded as props to
+        *NativeAction*.
+        """
+
+        return NativeAction(
+            host=self,
+            **props,
+        )
+
+    def native_call(self, operation, **args):
+        """
+        Run an operation of the :mod:`opslib.agent` helper on the host, and
+        return its result. Raises :class:`~opslib.results.OperationError` if
+        the operation fails.
+        """
+
+        response = self._call_agent(dict(op=operation, args=args))
+        if "error" in response:
+            result = Result(failed=True, output=response["error"])
+            result.raise_if_failed("Native operation failed")
+
+        return response["result"]
+
+    def _call_agent(self, request):
+        if self.use_agent:
+            return get_agent_process(self._agent_args()).request(request)
+
+        result = self.run_python(get_agent_source(), input=json.dumps(request))
+        return json.loads(result.stdout)
+
+    def _agent_args(self) -> list: ...
+
+    def _can_run_with_agent(self, args, kwargs):
+        return (
+            self.use_agent
+            and args
+            and kwargs.get("capture_output", True)
+            and set(kwargs) <= AGENT_RUN_KWARGS
+        )
+
+    def _run_with_agent(
+        self,
+        args,
+        shell,
+        input=None,
+        encoding="utf8",
+        check=True,
+        cwd=None,
+        capture_output=True,
+    ):
+        if encoding and isinstance(input, str):
+            input = input.encode(encoding)
+
+        data = self.native_call(
+            "exec",
+            args=[str(arg) for arg in args],
+            shell=shell,
+            input=b64encode(input).decode("ascii") if input is not None else None,
+            cwd=str(cwd) if cwd is not None else None,
+        )
+        completed = subprocess.CompletedProcess(
+            args,
+            data["returncode"],
+            b64decode(data["stdout"]),
+            b64decode(data["stderr"]),
+        )
+        result = LocalRunResult(completed, encoding=encoding)
+        if check:
+            result.raise_if_failed("Command failed")
+
+        return result
+
+    def run_python(self, source, **kwargs) -> LocalRunResult:
+        """
+        Run a Python program on the host. Keyword arguments are forwarded to
+        :meth:`run`.
+        """
+
+        ...
+
+    def _command_line(self, args) -> str: ...
+
+    def run_commands(self, commands):
+        """
+        Run several commands, in order, as a single shell script, stopping at
+        the first one that fails. Each command is a tuple of ``(args, cwd,
+        input)``, with the same meaning as the props of :class:`Command`.
+
+        Returns a list with a :class:`~opslib.local.LocalRunResult` for each
+        command, or ``None`` for the commands that did not run.
+        """
+
+        script = [
+            'out="$(mktemp)" && err="$(mktemp)" || exit 1',
+            """trap 'rm -f "$out" "$err"' EXIT""",
+        ]
+        for args, cwd, input in commands:
+            command = self._command_line(args) if args else "sh"
+            if cwd is not None:
+                command = f"cd {shlex.quote(str(cwd))} && {command}"
+
+            if input is None:
+                command = f"( {command} ) </dev/null"
+            else:
+                command = f"printf '%s' {shlex.quote(input)} | ( {command} )"
+
+            script += [
+                f'{command} >"$out" 2>"$err"',
+                "rc=$?",
+                f"printf '{COMMAND_BATCH_MARKER} %d %d %d\\n'"
+                ' "$rc" $(wc -c <"$out") $(wc -c <"$err")',
+                'cat "$out" "$err"',
+                '[ "$rc" -eq 0 ] || exit 0',
+            ]
+
+        result = self.run("sh", input="\n".join(script).encode("utf8"), encoding=None)
+        return _parse_command_batch(commands, result.stdout)
+
+    def gather_facts(self):
+        """
+        Gather facts about the host with Ansible's ``setup`` module, and save
+        them in the host's state. Returns the facts as a dictionary.
+        """
+
+        from .ansible import run_ansible
+
+        result = run_ansible(
+            hostname=evaluate(self.hostname),
+            ansible_variables=self.ansible_variables,
+            action=dict(
+                module="ansible.builtin.setup",
+                args=dict(gather_subset=self.facts_subset),
+            ),
+        )
+        facts = result.data["ansible_facts"]
+
+        if self._meta is not None:
+            self.facts_state.save(
+                facts=facts,
+                subset=self.facts_subset,
+                gathered=time.time(),
+            )
+
+        return facts
+
+    def _get_saved_facts(self):
+        if self._meta is None:
+            return None
+
+        gathered = self.facts_state.get("gathered")
+        if gathered is None or self.facts_state.get("subset") != self.facts_subset:
+            return None
+
+        if time.time() - gathered > self.facts_ttl.total_seconds():
+            return None
+
+        return self.facts_state["facts"]
+
+    def _load_facts(self):
+        facts = self._get_saved_facts()
+        if facts is None:
+            facts = self.gather_facts()
+
+        return facts
+
+    def _get_facts(self):
+        op = current_operation()
+        if op is None:
+            return self._load_facts()
+
+        return op.session((_HostFacts, self), lambda: _HostFacts(self)).facts
+
+    @property
+    def facts(self):
+        """
+        :class:`~opslib.lazy.Lazy` dictionary of Ansible facts about the host,
+        e.g. ``ansible_os_family`` or ``ansible_architecture``. Facts are
+        gathered at most once per operation, and saved in the host's state,
+        where they are reused until ``facts_ttl`` expires.
+        """
+
+        return Lazy(self._get_facts)
+
     def sudo(self):
         """
         Returns a copy of this host that has the ``with_sudo`` flag set. This
@@ -101,7 +420,17 @@ class BaseHost(Component):
 
 class LocalHost(BaseHost):
     """
-    The local host on which opslib is running. It receives no props.
+    The local host on which opslib is running.
+
+    :param native: Manage :class:`File` and :class:`Directory` components
+                   directly from Python, instead of through Ansible. Defaults
+                   to ``False``.
+    :param use_agent: Run commands and native operations through a
+                      persistent :mod:`opslib.agent` process, connected over a
+                      pipe. It's the local counterpart of the *SshHost*
+                      option, useful for testing. Defaults to ``False``.
+    :param batch_commands: Run consecutive :class:`Command` components as a
+                           single shell script. Defaults to ``False``.
 
     :ivar hostname: Set to ``localhost``.
     :ivar ansible_variables: Two variables are set: ``ansible_connection`` is
@@ -115,6 +444,49 @@ class LocalHost(BaseHost):
         ("ansible_python_interpreter", sys.executable),
     ]
 
+    class Props:
+        native = Prop(bool, default=False)
+        use_agent = Prop(bool, default=False)
+        batch_commands = Prop(bool, default=False)
+        facts_ttl = Prop(timedelta, default=timedelta(hours=1))
+        facts_subset = Prop(list, default=["min"])
+
+    @property
+    def native(self):
+        return self.props.native
+
+    @property
+    def use_agent(self):
+        return self.props.use_agent
+
+    @property
+    def batch_commands(self):
+        return self.props.batch_commands
+
+    @property
+    def facts_ttl(self):
+        return self.props.facts_ttl
+
+    @property
+    def facts_subset(self):
+        return self.props.facts_subset
+
+    def _command_line(self, args):
+        return shlex.join(str(arg) for arg in args)
+
+    def _call_agent(self, request):
+        if self.use_agent or self.with_sudo:
+            return super()._call_agent(request)
+
+        return agent.handle(request)
+
+    def _agent_args(self):
+        sudo = ["sudo"] if self.with_sudo else []
+        return [*sudo, sys.executable, "-c", get_agent_source(), "--serve"]
+
+    def run_python(self, source, **kwargs):
+        return self.run(sys.executable, "-c", source, **kwargs)
+
     def run(self, *args, **kwargs):
         """
         Run a command on the local host. If ``args`` is empty, it defaults to a
@@ -123,6 +495,9 @@ class LocalHost(BaseHost):
         It invokes :func:`~opslib.local.run` with the arguments.
         """
 
+        if self._can_run_with_agent(args, kwargs):
+            return self._run_with_agent(args, shell=False, **kwargs)
+
         if not args:
             shell = os.environ.get("SHELL", "sh")
             args = [shell]
@@ -150,6 +525,30 @@ class SshHost(BaseHost):
     :param interpreter: Python interpreter to be used by Ansible. Set as the
                         ``ansible_python_interpreter`` variable. Defaults to
                         ``"python3"``.
+    :param pipelining: Enable Ansible pipelining, which runs modules without
+                       first copying them to the host. Defaults to ``True``.
+                       Turn it off if ``sudo`` on the host requires a TTY.
+    :param control_master: Share one SSH connection to the host, for
+                           :meth:`run` and for Ansible, through a
+                           ``ControlMaster`` socket in the opslib cache
+                           directory. Defaults to ``True``.
+    :param control_persist: How long the shared connection is kept open after
+                            it's no longer used. Defaults to ``"60s"``. If
+                            ``None``, the connection is kept open until the
+                            opslib process exits.
+    :param native: Manage :class:`File` and :class:`Directory` components
+                   with a small Python helper, run over a single ``ssh``
+                   invocation, instead of through Ansible. Defaults to
+                   ``False``.
+    :param use_agent: Start the :mod:`opslib.agent` helper once, over a
+                      single SSH session, and keep it running. Commands
+                      (:meth:`run` with captured output) and native
+                      operations are sent to it, instead of invoking ``ssh``
+                      each time. Defaults to ``False``.
+    :param batch_commands: Run consecutive :class:`Command` components, that
+                           are due to run, as a single shell script, in one
+                           SSH session. Each command still gets its own
+                           result. Defaults to ``False``.
     """
 
     class Props:
@@ -159,6 +558,14 @@ class SshHost(BaseHost):
         private_key_file = Prop(Optional[Path])
         config_file = Prop(Optional[Path])
         interpreter = Prop(str, default="python3")
+        pipelining = Prop(bool, default=True)
+        control_master = Prop(bool, default=True)
+        control_persist = Prop(Optional[str], default="60s")
+        native = Prop(bool, default=False)
+        use_agent = Prop(bool, default=False)
+        batch_commands = Prop(bool, default=False)
+        facts_ttl = Prop(timedelta, default=timedelta(hours=1))
+        facts_subset = Prop(list, default=["min"])
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)  # TODO always attach host to stack
@@ -182,18 +589,51 @@ class SshHost(BaseHost):
                 ("ansible_ssh_common_args", f"-F {self.props.config_file}"),
             )
 
+        if self.props.pipelining:
+            self.ansible_variables.append(("ansible_pipelining", True))
+
+        if self.props.control_master:
+            self.ansible_variables += [
+                (
+                    "ansible_ssh_args",
+                    f"-C -o ControlMaster=auto -o ControlPersist={self._persist}",
+                ),
+                ("ansible_control_path_dir", str(self.control_path_dir)),
+                ("ansible_control_path", "%(directory)s/%%C"),
+            ]
+
+        else:
+            self.ansible_variables.append(
+                ("ansible_ssh_args", "-C -o ControlMaster=no"),
+            )
+
     @property
-    def hostname(self):
-        return self.props.hostname
+    def _persist(self):
+        return self.props.control_persist or "yes"
 
-    def run(self, *args, ssh_tty=False, **kwargs):
+    @property
+    def control_path_dir(self):
         """
-        Run a command on the remote host.
-
-        It uses :func:`~opslib.local.run` to invoke ``ssh`` with the given
-        arguments.
+        Directory for ``ControlMaster`` sockets. Unix socket paths are limited
+        to about 100 characters, so if the opslib cache directory is too deep,
+        a directory in ``$XDG_RUNTIME_DIR``, or else in ``/tmp``, is used
+        instead. The directory is only created when a connection is made, and
+        it must be owned by the current user, and not accessible to anyone
+        else.
         """
 
+        candidates = [get_cache_directory() / "ssh"]
+        if os.environ.get("XDG_RUNTIME_DIR"):
+            candidates.append(Path(os.environ["XDG_RUNTIME_DIR"]) / "opslib-ssh")
+        candidates.append(Path(tempfile.gettempdir()) / f"opslib-ssh-{os.getuid()}")
+
+        for path in candidates:
+            if len(str(path)) <= MAX_CONTROL_PATH_DIR:
+                break
+
+        return path
+
+    def _ssh_args(self):
         hostname = evaluate(self.hostname)
         if self.props.username:
             hostname = f"{self.props.username}@{hostname}"
@@ -208,6 +648,82 @@ class SshHost(BaseHost):
         if self.props.config_file:
             ssh_args += ["-F", str(self.props.config_file)]
 
+        if self.props.control_master:
+            control_path_dir = get_private_directory(self.control_path_dir)
+            ssh_args += [
+                "-o",
+                "ControlMaster=auto",
+                "-o",
+                f"ControlPath={control_path_dir}/%C",
+                "-o",
+                f"ControlPersist={self._persist}",
+            ]
+
+            if self.props.control_persist is None:
+                _close_on_exit(tuple(ssh_args))
+
+        return ssh_args
+
+    @property
+    def hostname(self):
+        return self.props.hostname
+
+    @property
+    def native(self):
+        return self.props.native
+
+    @property
+    def use_agent(self):
+        return self.props.use_agent
+
+    @property
+    def batch_commands(self):
+        return self.props.batch_commands
+
+    @property
+    def facts_ttl(self):
+        return self.props.facts_ttl
+
+    @property
+    def facts_subset(self):
+        return self.props.facts_subset
+
+    def _command_line(self, args):
+        # like ssh, which joins the arguments into a command for the remote shell
+        return " ".join(str(arg) for arg in args)
+
+    def _agent_args(self):
+        sudo = ["sudo"] if self.with_sudo else []
+        return [
+            *self._ssh_args(),
+            "--",
+            *sudo,
+            self.props.interpreter,
+            "-c",
+            shlex.quote(get_agent_source()),
+            "--serve",
+        ]
+
+    def run_python(self, source, **kwargs):
+        return self.run(self.props.interpreter, "-c", shlex.quote(source), **kwargs)
+
+    def run(self, *args, ssh_tty=False, **kwargs):
+        """
+        Run a command on the remote host.
+
+        It uses :func:`~opslib.local.run` to invoke ``ssh`` with the given
+        arguments. With ``control_master`` enabled, only the first command
+        opens a connection; the following ones reuse it. With ``use_agent``,
+        the command is sent to the agent instead, as a command line for the
+        remote shell, unless it needs a terminal or uncaptured output.
+        """
+
+        if not ssh_tty and self._can_run_with_agent(args, kwargs):
+            return self._run_with_agent(
+                [" ".join(map(str, args))], shell=True, **kwargs
+            )
+
+        ssh_args = self._ssh_args()
         if ssh_tty:
             ssh_args += ["-t"]
 
@@ -228,14 +744,439 @@ class SshHost(BaseHost):
         return run(*ssh_args, *args, **kwargs)
 
 
+CONTAINER_CONNECTIONS = {
+    "podman": "containers.podman.podman",
+    "docker": "community.docker.docker",
+}
+
+
+class ContainerHost(BaseHost):
+    """
+    A container running on the local host, reached with ``podman exec`` or
+    ``docker exec``. It can be used instead of :class:`SshHost` to manage a
+    container, without the overhead of SSH.
+
+    Ansible connects to the container with the ``containers.podman.podman`` or
+    ``community.docker.docker`` connection plugin, which are not part of
+    ``ansible-core``; the matching collection must be installed.
+
+    :param container: Name or ID of the container.
+    :param engine: Container engine, ``"podman"`` (default) or ``"docker"``.
+    :param user: User that runs commands in the container. Defaults to the
+                 container's own user.
+    :param interpreter: Python interpreter to be used by Ansible. Set as the
+                        ``ansible_python_interpreter`` variable. Defaults to
+                        ``"python3"``.
+    :param native: Manage :class:`File` and :class:`Directory` components
+                   with a small Python helper, run with a single ``exec``,
+                   instead of through Ansible. Defaults to ``False``.
+    :param use_agent: Start the :mod:`opslib.agent` helper once, in the
+                      container, and keep it running. Commands and native
+                      operations are sent to it, instead of invoking the
+                      container engine each time. Defaults to ``False``.
+    :param batch_commands: Run consecutive :class:`Command` components, that
+                           are due to run, as a single shell script. Defaults
+                           to ``False``.
+    """
+
+    class Props:
+        container = Prop(str, lazy=True)
+        engine = Prop(str, default="podman")
+        user = Prop(Optional[str])
+        interpreter = Prop(str, default="python3")
+        native = Prop(bool, default=False)
+        use_agent = Prop(bool, default=False)
+        batch_commands = Prop(bool, default=False)
+        facts_ttl = Prop(timedelta, default=timedelta(hours=1))
+        facts_subset = Prop(list, default=["min"])
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.props.engine not in CONTAINER_CONNECTIONS:
+            raise ValueError(f"Unknown container engine: {self.props.engine!r}")
+
+        self.ansible_variables = [
+            ("ansible_connection", CONTAINER_CONNECTIONS[self.props.engine]),
+            ("ansible_python_interpreter", self.props.interpreter),
+        ]
+
+        if self.props.user:
+            self.ansible_variables.append(("ansible_user", self.props.user))
+
+    @property
+    def hostname(self):
+        return self.props.container
+
+    @property
+    def native(self):
+        return self.props.native
+
+    @property
+    def use_agent(self):
+        return self.props.use_agent
+
+    @property
+    def batch_commands(self):
+        return self.props.batch_commands
+
+    @property
+    def facts_ttl(self):
+        return self.props.facts_ttl
+
+    @property
+    def facts_subset(self):
+        return self.props.facts_subset
+
+    def sudo(self):
+        """
+        Returns a copy of this host that runs commands, and Ansible actions, as
+        ``root``. Containers often don't have ``sudo``, so it's not used; the
+        container engine switches the user instead.
+        """
+
+        rv = copy(self)
+        rv.with_sudo = True
+        rv.ansible_variables = [*rv.ansible_variables, ("ansible_user", "root")]
+        return rv
+
+    def _exec_args(self, interactive=False, tty=False, cwd=None):
+        exec_args = [self.props.engine, "exec"]
+        if interactive:
+            exec_args.append("-i")
+
+        if tty:
+            exec_args.append("-t")
+
+        user = "root" if self.with_sudo else self.props.user
+        if user:
+            exec_args += ["--user", user]
+
+        if cwd is not None:
+            exec_args += ["--workdir", str(cwd)]
+
+        return [*exec_args, evaluate(self.props.container)]
+
+    def _command_line(self, args):
+        return shlex.join(str(arg) for arg in args)
+
+    def _agent_args(self):
+        return [
+            *self._exec_args(interactive=True),
+            self.props.interpreter,
+            "-c",
+            get_agent_source(),
+            "--serve",
+        ]
+
+    def run_python(self, source, **kwargs):
+        return self.run(self.props.interpreter, "-c", source, **kwargs)
+
+    def run(self, *args, **kwargs):
+        """
+        Run a command in the container. If ``args`` is empty, it defaults to a
+        single argument, ``sh``.
+
+        It uses :func:`~opslib.local.run` to invoke ``podman exec`` (or
+        ``docker exec``) with the arguments. Standard input is forwarded to
+        the container if there is any ``input``, or if the output is not
+        captured, in which case a terminal is also allocated, if available.
+        """
+
+        if self._can_run_with_agent(args, kwargs):
+            return self._run_with_agent(args, shell=False, **kwargs)
+
+        if not args:
+            args = ["sh"]
+
+        interactive = not kwargs.get("capture_output", True)
+        exec_args = self._exec_args(
+            interactive=interactive or kwargs.get("input") is not None,
+            tty=interactive and sys.stdin.isatty(),
+            cwd=kwargs.pop("cwd", None),
+        )
+        return run(*exec_args, *args, **kwargs)
+
+
+class HostGroup(Component):
+    """
+    A group of hosts that can be acted on together. The hosts are attached to
+    the group as child components, unless they are already attached
+    elsewhere.
+
+    :param hosts: Dictionary of :class:`BaseHost` objects, by name. Names
+                  must be valid Python identifiers that don't clash with
+                  attributes of the group.
+    :param concurrency: Maximum number of hosts that :meth:`run` acts on at
+                        the same time. Defaults to ``10``.
+    """
+
+    class Props:
+        hosts = Prop(dict)
+        concurrency = Prop(int, default=10)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        for name in self.hosts:
+            if (
+                not name.isidentifier()
+                or keyword.iskeyword(name)
+                or name.startswith("_")
+                or hasattr(HostGroup, name)
+                or hasattr(PerHost, name)
+            ):
+                raise ValueError(f"Invalid host name: {name!r}")
+
+    @property
+    def hosts(self):
+        return self.props.hosts
+
+    def build(self):
+        for name, host in self.hosts.items():
+            if host._meta is None:
+                setattr(self, name, host)
+
+    def each(self, factory):
+        """
+        Returns a component with a child for each host, named after the host,
+        created by calling ``factory(host)``.
+        """
+
+        return PerHost(group=self, factory=factory)
+
+    def file(self, **props):
+        """
+        Shorthand that returns a :class:`File` on each host. Keyword arguments
+        are forwarded as props to *File*.
+        """
+
+        return self.each(lambda host: host.file(**props))
+
+    def directory(self, path, **props):
+        """
+        Shorthand that returns a :class:`Directory` on each host. Keyword
+        arguments are forwarded as props to *Directory*.
+        """
+
+        return self.each(lambda host: host.directory(path, **props))
+
+    def command(self, **props):
+        """
+        Shorthand that returns a :class:`Command` on each host. Keyword
+        arguments are forwarded as props to *Command*.
+        """
+
+        return self.each(lambda host: host.command(**props))
+
+    def run(self, *args, concurrency=None, **kwargs):
+        """
+        Run a command on all hosts, in parallel, up to ``concurrency`` at a
+        time, which defaults to the group's ``concurrency`` prop. Other
+        arguments are forwarded to the ``run`` method of each host; ``check``
+        defaults to ``False``. Returns a dictionary of results by host name.
+        If a command can't run on a host, e.g. it can't be reached, its result
+        is a failed :class:`~opslib.results.Result`.
+        """
+
+        kwargs.setdefault("check", False)
+
+        def run_on(host):
+            try:
+                return host.run(*args, **kwargs)
+
+            except OperationError as error:
+                return error.result
+
+        max_workers = concurrency or self.props.concurrency
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                name: executor.submit(contextvars.copy_context().run, run_on, host)
+                for name, host in self.hosts.items()
+            }
+
+        return {name: future.result() for name, future in futures.items()}
+
+    def add_commands(self, cli):
+        @cli.forward_command
+        @click.option("-j", "--concurrency", type=int)
+        def run(concurrency, args):
+            results = self.run(*args, concurrency=concurrency)
+            for name, result in results.items():
+                status = "failed" if result.failed else "ok"
+                completed = getattr(result, "completed", None)
+                if completed is not None:
+                    status += f" (exit code {completed.returncode})"
+                click.secho(f"{name}: {status}", fg="red" if result.failed else "green")
+                if result.output:
+                    click.echo(result.output, nl=not result.output.endswith("\n"))
+
+            failed = [name for name, result in results.items() if result.failed]
+            click.echo(f"{len(results) - len(failed)} ok, {len(failed)} failed")
+            sys.exit(1 if failed else 0)
+
+
+class PerHost(Component):
+    """
+    Component with a child for each host of a :class:`HostGroup`, created with
+    :meth:`HostGroup.each`.
+    """
+
+    class Props:
+        group = Prop(HostGroup)
+        factory = Prop(Callable)
+
+    def build(self):
+        for name, host in self.props.group.hosts.items():
+            setattr(self, name, self.props.factory(host))
+
+
+_control_masters = set()
+
+
+def _close_control_masters():
+    for ssh_args in _control_masters:
+        run(*ssh_args, "-O", "exit", check=False)
+
+
+def _close_on_exit(ssh_args):
+    if not _control_masters:
+        atexit.register(_close_control_masters)
+
+    _control_masters.add(ssh_args)
+
+
+def _parse_command_batch(commands, output):
+    results = []
+    position = 0
+    for args, _, _ in commands:
+        end = output.find(b"\n", position)
+        if end == -1:
+            results.append(None)
+            continue
+
+        marker, returncode, stdout_size, stderr_size = output[position:end].split()
+        assert marker.decode() == COMMAND_BATCH_MARKER
+        stdout_start = end + 1
+        stderr_start = stdout_start + int(stdout_size)
+        position = stderr_start + int(stderr_size)
+
+        completed = subprocess.CompletedProcess(
+            args,
+            int(returncode),
+            output[stdout_start:stderr_start],
+            output[stderr_start:position],
+        )
+        results.append(LocalRunResult(completed, encoding="utf8"))
+
+    return results
+
+
+def _use_native(host, mode):
+    return host.native and (mode is None or OCTAL_MODE.fullmatch(mode))
+
+
+def format_diff(path, result):
+    """
+    Format the ``diff`` data returned by Ansible's file modules, or by the
+    native helper, as a unified diff.
+    """
+
+    diffs = []
+
+    if result.changed:
+        data_diff = result.data["diff"]
+        if isinstance(data_diff, dict):
+            before = f'{data_diff["before"]}\n'
+            after = f'{data_diff["after"]}\n'
+            diffs.append(diff(path, before, after))
+
+        else:
+            for d in data_diff:
+                if "before" in d and "after" in d:
+                    diffs.append(diff(path, d["before"], d["after"]))
+
+                else:
+                    # Ansible doesn't show diffs for binary files
+                    diffs.append(f"Binary file {path} changed\n")
+
+    return "".join(diffs)
+
+
+_checksums = {}
+
+
+def file_checksum(path):
+    """
+    Returns the SHA-1 hex digest of the file at ``path``, as used by
+    Ansible's ``copy`` module. The file is read in chunks, and the digest is
+    remembered for as long as the file's size and modification time don't
+    change.
+    """
+
+    st = os.stat(path)
+    key = (str(path), st.st_size, st.st_mtime_ns)
+    if key not in _checksums:
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            if st.st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    digest.update(data)
+
+        _checksums[key] = digest.hexdigest()
+
+    return _checksums[key]
+
+
+_blob_directory = None
+_blob_directory_lock = threading.Lock()
+
+
+def _remove_blob_directory():
+    shutil.rmtree(_blob_directory, ignore_errors=True)
+
+
+def get_blob_path(data):
+    """
+    Save ``data`` in a private temporary directory, under a name derived from
+    its hash, and return the path. The directory is removed when opslib
+    exits, so that content, which may be secret, is not left behind.
+    """
+
+    global _blob_directory
+    with _blob_directory_lock:
+        if _blob_directory is None:
+            _blob_directory = Path(tempfile.mkdtemp(prefix="opslib-blobs-"))
+            atexit.register(_remove_blob_directory)
+
+    path = _blob_directory / hashlib.sha1(data).hexdigest()
+    if not path.exists():
+        with tempfile.NamedTemporaryFile(dir=_blob_directory, delete=False) as f:
+            f.write(data)
+
+        os.replace(f.name, path)
+
+    return path
+
+
+def _get_source(content) -> Optional[Path]:
+    if isinstance(content, bytes):
+        return get_blob_path(content)
+
+    if isinstance(content, Path):
+        return content
+
+    return None
+
+
 class File(Component):
     """
     The File component creates a regular file on the host.
 
     :param host: The parent host.
     :param path: Absolute path of the file.
-    :param content: Content to write to the file. May be :class:`str` or
-                    :class:`bytes`. May be :class:`~opslib.lazy.Lazy`.
+    :param content: Content to write to the file. May be :class:`str`,
+                    :class:`bytes`, or the :class:`~pathlib.Path` of a local
+                    file, which is streamed to the host without being loaded
+                    into memory. May be :class:`~opslib.lazy.Lazy`.
     :param mode: Unix file permissions (optional).
     :param owner: The name of the user owning the directory (optional).
     :param group: The name of the group owning the directory (optional).
@@ -244,7 +1185,7 @@ class File(Component):
     class Props:
         host = Prop(BaseHost)
         path = Prop(Path)
-        content = Prop(str, lazy=True)
+        content = Prop(Union[str, bytes, Path], lazy=True)
         mode = Prop(Optional[str])
         owner = Prop(Optional[str])
         group = Prop(Optional[str])
@@ -257,9 +1198,96 @@ class File(Component):
     def path(self):
         return self.props.path
 
+    def _get_content_args(self):
+        content = self.props.content
+        if isinstance(content, str):
+            return dict(content=content)
+
+        # Ansible copies local files with `src`; `checksum` makes the
+        # content part of the action's snapshot
+        source = Lazy(lambda: _get_source(evaluate(content)))
+
+        def get_content():
+            value = evaluate(content)
+            return value if isinstance(value, str) else None
+
+        def get_src():
+            return str(source.value) if source.value else None
+
+        def get_checksum():
+            return file_checksum(source.value) if source.value else None
+
+        return dict(
+            content=Lazy(get_content),
+            src=Lazy(get_src),
+            checksum=Lazy(get_checksum),
+        )
+
+    def _get_native_content_args(self):
+        """
+        Returns the arguments of ``ensure_file`` that identify the content,
+        and the ones that carry it, which are only sent when writing. Binary
+        content is identified by its digest, and sent base64-encoded.
+        """
+
+        content = self.props.content
+        if isinstance(content, str):
+            return dict(content=content), {}
+
+        def get_binary():
+            value = evaluate(content)
+            return None if isinstance(value, str) else value
+
+        def get_content():
+            value = evaluate(content)
+            return value if isinstance(value, str) else None
+
+        def get_content_sha256():
+            value = get_binary()
+            if isinstance(value, Path):
+                return agent.hash_(value)
+
+            if isinstance(value, bytes):
+                return hashlib.sha256(value).hexdigest()
+
+            return None
+
+        def get_content_base64():
+            value = get_binary()
+            if isinstance(value, Path):
+                value = value.read_bytes()
+
+            if isinstance(value, bytes):
+                return b64encode(value).decode("ascii")
+
+            return None
+
+        args = dict(content=Lazy(get_content), content_sha256=Lazy(get_content_sha256))
+        return args, dict(content_base64=Lazy(get_content_base64))
+
     def build(self):
+        # local files are streamed by Ansible, instead of being loaded into
+        # memory and sent through the agent
+        if not isinstance(self.props.content, Path) and _use_native(
+            self.host, self.props.mode
+        ):
+            content_args, payload = self._get_native_content_args()
+            self.action = self.host.native_action(
+                operation="ensure_file",
+                args=dict(
+                    path=str(self.path),
+                    **content_args,
+                    mode=self.props.mode,
+                    owner=self.props.owner,
+                    group=self.props.group,
+                ),
+                payload=payload,
+                format_output=self.format_output,
+            )
+            return
+
         args = dict(
-            content=self.props.content,
+            **self._get_content_args(),
             dest=str(self.path),
         )
 
@@ -279,19 +1307,7 @@ class File(Component):
         )
 
     def format_output(self, result):
-        diffs = []
-
-        if result.changed:
-            data_diff = result.data["diff"]
-            if isinstance(data_diff, dict):
-                before = f'{data_diff["before"]}\n'
-                after = f'{data_diff["after"]}\n'
-                diffs.append(diff(self.path, before, after))
-
-            else:
-                diffs += [diff(self.path, d["before"], d["after"]) for d in data_diff]
-
-        return "".join(diffs)
+        return format_diff(self.path, result)
 
     @property
     def on_change(self):
@@ -330,6 +1346,19 @@ class Directory(Component):
         return cast(Path, self.props.path)
 
     def build(self):
+        if _use_native(self.host, self.props.mode):
+            self.action = self.host.native_action(
+                operation="ensure_directory",
+                args=dict(
+                    path=str(self.path),
+                    mode=self.props.mode,
+                    owner=self.props.owner,
+                    group=self.props.group,
+                ),
+                format_output=self.format_output,
+            )
+            return
+
         args = dict(
             path=str(self.path),
             state="directory",
@@ -347,8 +1376,12 @@ class Directory(Component):
         self.action = self.host.ansible_action(
             module="ansible.builtin.file",
             args=args,
+            format_output=self.format_output,
         )
 
+    def format_output(self, result):
+        return format_diff(self.path, result)
+
     def subdir(self, name, **kwargs):
         """
         Shorthand function that returns a :class:`Directory` with the same
@@ -380,6 +1413,19 @@ class Directory(Component):
             **kwargs,
         )
 
+    def sync(self, source, **props):
+        """
+        Shorthand function that returns a :class:`SyncedDirectory` that
+        mirrors the local directory ``source`` to this directory. Keyword
+        arguments are forwarded as props to *SyncedDirectory*.
+        """
+
+        return SyncedDirectory(
+            directory=self,
+            source=Path(source),
+            **props,
+        )
+
     def command(self, **props):
         """
         Shorthand function that returns a :class:`Command` component with
@@ -404,6 +1450,111 @@ class Directory(Component):
         return self.host.run(cwd=self.path, *args, **kwargs)
 
 
+def _entry_changed(source_path, local, remote):
+    if remote is None or remote["type"] != local["type"]:
+        return True
+
+    if local["type"] == "link":
+        return remote["target"] != local["target"]
+
+    if remote["mode"] != local["mode"]:
+        return True
+
+    if local["type"] == "file":
+        if remote["size"] != local["size"]:
+            return True
+
+        if remote["mtime"] != local["mtime"]:
+            return remote["sha256"] != agent.hash_(source_path)
+
+    return False
+
+
+class SyncedDirectory(Component):
+    """
+    The SyncedDirectory component mirrors a local directory to a
+    :class:`Directory` on the host. Only new and modified files are
+    transferred, as a single tar archive.
+
+    :param directory: The target :class:`Directory`.
+    :param source: Path of the local directory.
+    :param delete: If ``True``, remove files from the target that don't exist
+                   in ``source``. Defaults to ``False``.
+
+    :ivar changed_paths: After deployment, the list of paths, relative to the
+                         directory, that were created, modified or removed.
+                         Useful in ``on_change`` callbacks.
+    """
+
+    class Props:
+        directory = Prop(Directory)
+        source = Prop(Path)
+        delete = Prop(bool, default=False)
+
+    on_change = Callbacks()
+    changed_paths: list = []
+
+    @property
+    def host(self):
+        return self.props.directory.host
+
+    @property
+    def path(self):
+        return self.props.directory.path
+
+    def _get_changes(self):
+        source = self.props.source
+        local = agent.get_manifest(str(source))
+        expected = {
+            name: {"size": entry["size"], "mtime": entry["mtime"]}
+            for name, entry in local.items()
+            if entry["type"] == "file"
+        }
+        remote = self.host.native_call(
+            "manifest", path=str(self.path), expected=expected
+        )
+
+        changed = [
+            name
+            for name, entry in sorted(local.items())
+            if _entry_changed(source / name, entry, remote.get(name))
+        ]
+        deleted = sorted(set(remote) - set(local)) if self.props.delete else []
+        return changed, deleted
+
+    def _get_archive(self, names):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+            for name in names:
+                tar.add(self.props.source / name, arcname=name, recursive=False)
+
+        return b64encode(buffer.getvalue()).decode("ascii")
+
+    def deploy(self, dry_run=False):
+        changed, deleted = self._get_changes()
+        if not (changed or deleted):
+            return Result()
+
+        if not dry_run:
+            self.host.native_call(
+                "extract_tar",
+                path=str(self.path),
+                content=self._get_archive(changed),
+                delete=deleted,
+            )
+            self.changed_paths = changed + deleted
+            self.on_change.invoke()
+
+        output = "".join(
+            [f"{name}\n" for name in changed]
+            + [f"deleting {name}\n" for name in deleted]
+        )
+        return Result(changed=True, output=output)
+
+    def refresh(self):
+        return self.deploy(dry_run=True)
+
+
 class Command(StatefulMixin, Component):
     """
     The Command component represents a command that should be run on the
@@ -419,6 +1570,11 @@ class Command(StatefulMixin, Component):
                       If empty, the command will always be run, otherwise it
                       will run once, and then only run after one of the
                       components changes.
+    :param stream: If set, the output is streamed to the terminal during
+                   deployment, and only its end is kept in the result (see
+                   the ``stream`` parameter of :func:`~opslib.local.run`).
+                   Useful for long-running commands. Streamed commands are
+                   not batched.
     """
 
     class Props:
@@ -427,6 +1583,7 @@ class Command(StatefulMixin, Component):
         args = Prop(Union[list, tuple], default=[], lazy=True)
         input = Prop(Optional[str])
         run_after = Prop(list, default=[])
+        stream = Prop(bool, default=False)
 
     state = JsonState()
     on_change = Callbacks()
@@ -466,13 +1623,211 @@ class Command(StatefulMixin, Component):
 
         def _run():
             self.on_change.invoke()
-            result = self.run(capture_output=False)
+            if self.props.stream:
+                result = self.run(stream=True)
+
+            else:
+                result = self.run(capture_output=False)
+
             self.state["must-run"] = False
             return result
 
         return Lazy(_run)
 
+    def get_batch_key(self, method):
+        if method == "deploy" and self.host.batch_commands and not self.props.stream:
+            return self.host
+
+        return None
+
+    @classmethod
+    def apply_batch(cls, method, commands, dry_run=False):
+        """
+        Deploy consecutive commands on the same host with a single call to
+        :meth:`BaseHost.run_commands`. The outcome is the same as calling
+        :meth:`deploy` on each command, except that output is captured.
+        """
+
+        outcomes = {}
+        due = []
+
+        for command in commands:
+            if command.props.run_after and not command.state.get("must-run"):
+                outcomes[command] = Result()
+
+            elif dry_run:
+                outcomes[command] = Result(changed=True)
+
+            else:
+                try:
+                    args = evaluate(command.props.args)
+
+                except NotAvailable as error:
+                    outcomes[command] = error
+                    continue
+
+                due.append((command, (args, command.props.cwd, command.props.input)))
+
+        if due:
+            host = commands[0].host
+            results = host.run_commands([call for _, call in due])
+
+            for (command, _), result in zip(due, results):
+                if result is None:
+                    break
+
+                if result.failed:
+                    outcomes[command] = OperationError("Command failed", result=result)
+                    break
+
+                command.on_change.invoke()
+                command.state["must-run"] = False
+                outcomes[command] = result
+
+        return [outcomes.get(command) for command in commands]
+
     def add_commands(self, cli):
         @cli.command
         def run():
             self.run(capture_output=False, exit=True)
+
+
+class NativeResult(Result):
+    """
+    Result of a :class:`NativeAction`.
+
+    :ivar data: The value returned by the operation.
+    """
+
+    def __init__(self, data, **kwargs):
+        self.data = data
+        super().__init__(**kwargs)
+
+
+class NativeAction(StatefulMixin, Component):
+    """
+    The NativeAction component runs an operation of the :mod:`opslib.agent`
+    helper on the host. It's used by :class:`File` and :class:`Directory` when
+    the host has ``native`` enabled, and behaves like an
+    :class:`~opslib.ansible.AnsibleAction`.
+
+    :param host: :class:`BaseHost` to act on.
+    :param operation: Name of the operation, e.g. ``"ensure_file"``.
+    :param args: Dictionary of arguments for the operation.
+    :param payload: Dictionary of extra arguments that are only sent when the
+                    operation makes changes, e.g. the content of a file.
+                    Unlike ``args``, they are not part of the action's
+                    snapshot, so ``args`` should identify them, e.g. with a
+                    digest.
+    :param format_output: Optional callback used to format the result output.
+                          If provided, it will be called with a single
+                          parameter, the :class:`NativeResult` object; its
+                          return value will be used to overwrite the
+                          ``output`` attribute of the result.
+    """
+
+    class Props:
+        host = Prop(BaseHost)
+        operation = Prop(str)
+        args = Prop(dict)
+        payload = Prop(dict, default={})
+        format_output = Prop(Optional[Callable])
+
+    uptodate = UpToDate()
+    on_change = Callbacks()
+
+    @uptodate.snapshot
+    def _get_call(self):
+        return dict(
+            hostname=evaluate(self.props.host.hostname),
+            with_sudo=self.props.host.with_sudo,
+            op=self.props.operation,
+            args=evaluate(self.props.args),
+        )
+
+    def _get_args(self, call, check):
+        if check:
+            return dict(call["args"], check=True)
+
+        return dict(call["args"], **evaluate(self.props.payload), check=False)
+
+    def _get_result(self, data):
+        result = NativeResult(data, changed=data["changed"])
+        if result.changed and self.props.format_output:
+            result.output = self.props.format_output(result)
+        return result
+
+    def run(self, check=False):
+        """
+        Run the operation on the host.
+        """
+
+        if not check:
+            self.on_change.invoke()
+
+        call = self._get_call()
+        data = self.props.host.native_call(call["op"], **self._get_args(call, check))
+        return self._get_result(data)
+
+    @uptodate.refresh
+    def refresh(self):
+        return self.run(check=True)
+
+    @uptodate.deploy
+    def deploy(self, dry_run=False):
+        return self.run(check=dry_run)
+
+    def get_batch_key(self, method):
+        if method in ["refresh", "deploy"]:
+            return self.props.host
+
+        return None
+
+    @classmethod
+    def apply_batch(cls, method, actions, dry_run=False):
+        """
+        Run consecutive operations on the same host in one round trip. The
+        outcome is the same as calling :meth:`refresh` or :meth:`deploy` on
+        each action.
+        """
+
+        check = method == "refresh" or dry_run
+        outcomes = {}
+        pending = []
+
+        for action in actions:
+            try:
+                if method == "deploy" and action.uptodate.get():
+                    outcomes[action] = Result()
+                    continue
+
+                call = action._get_call()
+                pending.append(
+                    (action, dict(op=call["op"], args=action._get_args(call, check)))
+                )
+
+            except NotAvailable as error:
+                outcomes[action] = error
+
+        if pending:
+            host = actions[0].props.host
+            responses = host.native_call("batch", calls=[call for _, call in pending])
+
+            for (action, _), response in zip(pending, responses):
+                if "error" in response:
+                    result = Result(failed=True, output=response["error"])
+                    outcomes[action] = OperationError(
+                        "Native operation failed", result=result
+                    )
+                    break
+
+                result = action._get_result(response["result"])
+                if not check:
+                    action.on_change.invoke()
+
+                action.uptodate.set(
+                    not (check and result.changed), refreshed=(method == "refresh")
+                )
+                outcomes[action] = result
+
+        return [outcomes.get(action) for action in actions]
@@ -1,24 +1,383 @@
 from contextlib import contextmanager
+import contextvars
+import fcntl
+import hashlib
 import json
 import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
+from pathlib import Path
+from textwrap import dedent
 from typing import Any, Optional
 
 import click
-from opslib.state import StatefulMixin
+from opslib.state import JsonState, StatefulMixin
 
-from .components import Component
+from .components import Component, walk
 from .lazy import Lazy, NotAvailable, evaluate
 from .local import run
+from .operations import current_operation
 from .props import Prop
-from .results import Result
+from .results import OperationError, Result
 from .uptodate import UpToDate
+from .utils import get_cache_directory, parse_size
 
 
 def lazy_quote(value):
     return Lazy(lambda: evaluate(value).replace("${", "$${"))
 
 
+def merge_config(config, other):
+    """
+    Merge the Terraform configuration ``other`` into ``config``, recursively.
+    """
+
+    for key, value in other.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            merge_config(config[key], value)
+
+        else:
+            config[key] = value
+
+    return config
+
+
+PLAN_FILE = "opslib.tfplan"
+
+PARALLEL_COMMANDS = {"plan", "apply", "refresh", "import"}
+
+ACTION_NAMES = {
+    ("create",): "created",
+    ("read",): "read during apply",
+    ("update",): "updated in-place",
+    ("delete",): "destroyed",
+    ("delete", "create"): "replaced",
+    ("create", "delete"): "replaced",
+}
+
+
+def get_changes(plan, address=None):
+    """
+    Returns the resource changes of ``plan``, as returned by ``terraform show
+    -json``, except the ones that are no-ops. If ``address`` is given, only
+    changes to that resource are returned.
+    """
+
+    return [
+        change
+        for change in plan.get("resource_changes", [])
+        if change["change"]["actions"] != ["no-op"]
+        and (address is None or change["address"] == address)
+    ]
+
+
+def get_output_changes(plan, names=None):
+    """
+    Returns the output changes of ``plan``, as a dictionary, except the ones
+    that are no-ops. If ``names`` is given, only changes to those outputs are
+    returned.
+    """
+
+    return {
+        name: change
+        for name, change in plan.get("output_changes", {}).items()
+        if change["actions"] != ["no-op"] and (names is None or name in names)
+    }
+
+
+def has_changes(plan):
+    """
+    Returns ``True`` if ``plan`` changes any resources or outputs.
+    """
+
+    return bool(get_changes(plan) or get_output_changes(plan))
+
+
+def _is_set(flags, key):
+    return bool(flags.get(key) if isinstance(flags, dict) else flags)
+
+
+def _format_value(value, sensitive=False, unknown=False):
+    if unknown:
+        return "(known after apply)"
+
+    if sensitive:
+        return "(sensitive value)"
+
+    return json.dumps(value)
+
+
+def format_change(change):
+    """
+    Describe a resource change from a plan, with a line for each attribute
+    that changes, similar to the output of ``terraform plan``.
+    """
+
+    details = change["change"]
+    actions = tuple(details["actions"])
+    lines = [f"# {change['address']} will be {ACTION_NAMES.get(actions, actions)}"]
+
+    before = details.get("before") or {}
+    after = details.get("after") or {}
+    after_unknown = details.get("after_unknown") or {}
+    before_sensitive = details.get("before_sensitive") or {}
+    after_sensitive = details.get("after_sensitive") or {}
+
+    for key in sorted(set(before) | set(after) | set(after_unknown)):
+        unknown = _is_set(after_unknown, key)
+        old = None
+        if before.get(key) is not None:
+            old = _format_value(before[key], _is_set(before_sensitive, key))
+
+        new = None
+        if after.get(key) is not None or unknown:
+            new = _format_value(after.get(key), _is_set(after_sensitive, key), unknown)
+
+        if old is None and new is not None:
+            lines.append(f"  + {key} = {new}")
+
+        elif old is not None and new is None:
+            lines.append(f"  - {key} = {old}")
+
+        elif old != new:
+            lines.append(f"  ~ {key} = {old} -> {new}")
+
+    return "\n".join(lines)
+
+
+def format_output_changes(output_changes):
+    """
+    Describe the output changes from a plan, similar to the output of
+    ``terraform plan``.
+    """
+
+    lines = ["Changes to outputs:"]
+    for name, change in sorted(output_changes.items()):
+        sign = {"create": "+", "delete": "-"}.get(change["actions"][0], "~")
+        value = _format_value(
+            change.get("after"),
+            _is_set(change, "after_sensitive"),
+            _is_set(change, "after_unknown"),
+        )
+        if sign == "-":
+            lines.append(f"  - {name}")
+
+        else:
+            lines.append(f"  {sign} {name} = {value}")
+
+    return "\n".join(lines)
+
+
+def run_plan(target, *args, apply=False):
+    """
+    Run ``terraform plan`` with the given arguments, save the plan, and read
+    it with ``terraform show -json``. With ``apply``, the saved plan is then
+    applied, if it has any changes. Returns the
+    :class:`~opslib.local.LocalRunResult` of the last ``terraform`` command,
+    and the plan.
+
+    :param target: A :class:`TerraformResource`, :class:`TerraformDataSource`
+                   or :class:`TerraformWorkspace`.
+    """
+
+    with target.terraform_directory() as tfdir, directory_lock(tfdir):
+        tf_result = target.run("plan", f"-out={PLAN_FILE}", *args)
+        show = target.run("show", "-json", PLAN_FILE, terraform_init=False)
+        plan = json.loads(show.stdout)
+
+        if apply and has_changes(plan):
+            tf_result = target.run("apply", PLAN_FILE, terraform_init=False)
+
+    return tf_result, plan
+
+
+class _DirectoryLock:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+            self.file = open(self.path / ".opslib.lock", "w")
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+
+        self.depth += 1
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            self.file.close()
+            self.file = None
+
+        self.lock.release()
+
+
+_directory_locks = {}
+_directory_locks_lock = threading.Lock()
+
+
+def directory_lock(path):
+    """
+    Returns an exclusive lock on the directory ``path``, e.g. a Terraform
+    working directory, that works across threads and processes. It's
+    re-entrant, so a thread can acquire it again while holding it.
+    """
+
+    path = Path(path)
+    with _directory_locks_lock:
+        if path not in _directory_locks:
+            _directory_locks[path] = _DirectoryLock(path)
+
+        return _directory_locks[path]
+
+
+STATE_FILE = "terraform.tfstate"
+
+_outputs = {}
+
+
+def read_outputs(tfdir):
+    """
+    Read the output values from the local Terraform state in ``tfdir``,
+    without running ``terraform``. The format is the same as ``terraform
+    output -json``. The state file is parsed again only after it changes.
+    """
+
+    path = tfdir / STATE_FILE
+
+    # terraform may be writing the state file
+    with directory_lock(tfdir):
+        try:
+            stat = path.stat()
+
+        except FileNotFoundError:
+            return {}
+
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = _outputs.get(path)
+        if cached is None or cached[0] != key:
+            outputs = json.loads(path.read_text()).get("outputs", {})
+            _outputs[path] = cached = (key, outputs)
+
+        return cached[1]
+
+
+def get_plugin_cache_directory():
+    """
+    Returns the directory where Terraform keeps the provider plugins that it
+    downloads. It's ``$TF_PLUGIN_CACHE_DIR`` if set, otherwise
+    ``terraform/plugins`` in opslib's cache directory, so it's shared by all
+    providers and stacks. Each version of a plugin is stored once, and linked
+    from the Terraform directories that use it.
+    """
+
+    if os.environ.get("TF_PLUGIN_CACHE_DIR"):
+        return Path(os.environ["TF_PLUGIN_CACHE_DIR"])
+
+    return get_cache_directory() / "terraform" / "plugins"
+
+
+def _get_plugin_cache_entries(cache_dir):
+    # plugins are stored as <host>/<namespace>/<type>/<version>/<platform>
+    return [path for path in cache_dir.glob("*/*/*/*/*") if path.is_dir()]
+
+
+def _get_size(path):
+    return sum(
+        item.stat().st_size
+        for item in path.rglob("*")
+        if item.is_file() and not item.is_symlink()
+    )
+
+
+def _get_linked_plugins(tfdir, cache_dir):
+    # terraform links the plugins of a directory to the cache, or the mirror
+    links = (tfdir / ".terraform" / "providers").glob("*/*/*/*/*")
+    return [
+        link.resolve()
+        for link in links
+        if link.is_symlink()
+        and link.exists()
+        and link.resolve().is_relative_to(cache_dir.resolve())
+    ]
+
+
+def _has_missing_plugins(tfdir):
+    links = (tfdir / ".terraform" / "providers").glob("*/*/*/*/*")
+    return any(link.is_symlink() and not link.exists() for link in links)
+
+
+def prune_plugin_cache(max_size, keep=()):
+    """
+    Remove the least recently used plugins from the plugin cache, until its
+    total size is at most ``max_size`` bytes. Plugins are marked as used when
+    ``terraform init`` links them into a Terraform directory. Terraform
+    directories that link to removed plugins are initialized again the next
+    time they are used.
+
+    :param max_size: Maximum size of the cache, in bytes.
+    :param keep: Plugin directories that are never removed, e.g. the ones that
+                 were just installed.
+    :return: List of the plugin directories that were removed.
+    """
+
+    cache_dir = get_plugin_cache_directory()
+    removed = []
+    with directory_lock(cache_dir):
+        entries = _get_plugin_cache_entries(cache_dir)
+        sizes = {entry: _get_size(entry) for entry in entries}
+        total = sum(sizes.values())
+        keep = {Path(path).resolve() for path in keep}
+
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if total <= max_size:
+                break
+
+            if entry.resolve() in keep:
+                continue
+
+            shutil.rmtree(entry)
+            total -= sizes[entry]
+            removed.append(entry)
+
+            # remove the version, type, etc. directories if they are now empty
+            for parent in list(entry.parents)[:4]:
+                if any(parent.iterdir()):
+                    break
+                parent.rmdir()
+
+    return removed
+
+
+def _get_offline_config(mirror):
+    """
+    Write a Terraform CLI configuration that installs plugins only from the
+    local directory ``mirror``, and return its path.
+    """
+
+    path = get_cache_directory() / "terraform" / "offline.tfrc"
+    content = dedent(
+        f"""\
+        provider_installation {{
+          filesystem_mirror {{
+            path = {json.dumps(str(mirror))}
+          }}
+        }}
+        """
+    )
+    if not path.exists() or path.read_text() != content:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+    return path
+
+
 class TerraformResult(Result):
     """
     The result of an invocation of ``terraform``. In addition to the fields
@@ -26,19 +385,41 @@ class TerraformResult(Result):
 
     :ivar tf_result: The original :class:`~opslib.local.LocalRunResult` of
                      invoking the ``terraform`` command.
+    :ivar plan: The plan, as returned by ``terraform show -json``.
+    :ivar changes: List of resource changes in the plan, other than no-ops.
+    :ivar output_changes: Dictionary of output changes in the plan, other than
+                          no-ops.
+
+    If ``address`` is given, only the changes to that resource are taken into
+    account, and if ``outputs`` is given, only the changes to those outputs,
+    which is useful when several resources share a :class:`TerraformWorkspace`.
     """
 
-    marker = "Terraform will perform the following actions:"
-
-    def __init__(self, tf_result):
+    def __init__(self, tf_result, plan, address=None, outputs=None):
         self.tf_result = tf_result
+        self.plan = plan
+        self.changes = get_changes(plan, address)
+        self.output_changes = get_output_changes(plan, outputs)
 
-        output = tf_result.stdout
-        if self.marker in output:
-            super().__init__(changed=True, output=output.split(self.marker)[1].strip())
+        output = [format_change(change) for change in self.changes]
+        if self.output_changes:
+            output.append(format_output_changes(self.output_changes))
+
+        super().__init__(
+            changed=bool(self.changes or self.output_changes),
+            output="\n\n".join(output),
+        )
 
-        else:
-            super().__init__(changed=False)
+
+class _Size(click.ParamType):
+    name = "size"
+
+    def convert(self, value, param, ctx):
+        try:
+            return parse_size(value)
+
+        except ValueError as error:
+            self.fail(str(error), param, ctx)
 
 
 class TerraformProvider(StatefulMixin, Component):
@@ -55,6 +436,16 @@ class TerraformProvider(StatefulMixin, Component):
                    some level of configuration, although it can sometimes be
                    set through environment variables; consult each provider's
                    documentation for details.
+    :param workspace: If ``True``, all resources and data sources of the
+                      provider share a single :class:`TerraformWorkspace`,
+                      created as the ``workspace`` child of the provider.
+                      Defaults to ``False``.
+    :param concurrency: Maximum number of consecutive resources and data
+                        sources of the provider, that are not in a workspace,
+                        to run at the same time. Defaults to ``1``.
+    :param parallelism: Passed as ``-parallelism`` to ``terraform``, to limit
+                        the number of operations that Terraform itself runs
+                        concurrently, e.g. in a workspace. (optional)
     """
 
     class Props:
@@ -62,12 +453,25 @@ class TerraformProvider(StatefulMixin, Component):
         source = Prop(Optional[str])
         version = Prop(Optional[str])
         config = Prop(Optional[dict])
+        workspace = Prop(bool, default=False)
+        concurrency = Prop(int, default=1)
+        parallelism = Prop(Optional[int])
 
-    @contextmanager
-    def plugin_cache_path(self):
-        # TODO should be a "cache" directory, not a "state" directory
-        with self.state_directory() as statedir:
-            yield statedir / "plugin-cache"
+    def build(self):
+        if self.props.workspace:
+            self.workspace = TerraformWorkspace()
+
+    def add_commands(self, cli):
+        @cli.command("prune-plugin-cache")
+        @click.argument("max_size", type=_Size())
+        def prune(max_size):
+            """
+            Remove the least recently used plugins from the plugin cache,
+            until it's at most MAX_SIZE, e.g. "2G".
+            """
+
+            for path in prune_plugin_cache(max_size):
+                click.echo(f"Removed {path}")
 
     @cached_property
     def config(self):
@@ -113,6 +517,311 @@ class TerraformProvider(StatefulMixin, Component):
         )
 
 
+class TerraformWorkspace(StatefulMixin, Component):
+    """
+    A Terraform working directory that is shared by several
+    :class:`TerraformResource` and :class:`TerraformDataSource` components, so
+    that they are planned and applied together, by a single ``terraform``
+    process, instead of one process for each component.
+
+    Resources and data sources use the workspace if they are placed inside it,
+    i.e. it's one of their ancestors in the stack, or if their provider was
+    created with ``workspace=True``. Each of them gets a unique address in the
+    workspace, based on its name in the stack. Commands are targeted (with
+    ``-target``) at the components being deployed, so the workspace may
+    contain resources whose arguments are not yet available.
+    """
+
+    @cached_property
+    def members(self):
+        """
+        List of the resources and data sources that use this workspace.
+        """
+
+        return [
+            component
+            for component in walk(self._meta.stack)
+            if isinstance(component, _TerraformComponent)
+            and component.workspace is self
+        ]
+
+    @property
+    def config(self):
+        config = {}
+        for member in self.members:
+            try:
+                merge_config(config, member.config)
+
+            except NotAvailable:
+                # it's left out until its args are available; commands are
+                # targeted, so the existing resource is not affected
+                continue
+
+        return config
+
+    init_state = JsonState()
+
+    @contextmanager
+    def terraform_directory(self):
+        with self.state_directory() as statedir:
+            yield statedir / "terraform"
+
+    def _get_provider(self):
+        for member in self.members:
+            if member.props.provider:
+                return member.props.provider
+
+        return None
+
+    def run(self, *args, terraform_init=True, **kwargs):
+        """
+        Run the ``terraform`` command with the given arguments, after writing
+        the configuration of all members.
+        """
+
+        with self.terraform_directory() as tfdir, directory_lock(tfdir):
+            if terraform_init:
+                config = self.config
+                (tfdir / "main.tf.json").write_text(json.dumps(config, indent=2))
+                self._init(config)
+
+            return _run_terraform(self, *args, **kwargs)
+
+    def _init(self, config):
+        _init_terraform(self, config)
+        self._init = lambda config: None
+
+    @property
+    def _output_values(self):
+        with self.terraform_directory() as tfdir:
+            return read_outputs(tfdir)
+
+    def apply_members(self, method, members, dry_run=False):
+        """
+        Run ``method`` (``"refresh"``, ``"deploy"`` or ``"destroy"``) on
+        several members with a single ``terraform`` command. Members whose
+        args depend on the outputs of other members are run with another
+        command, after those are applied. Returns the outcome for each
+        member, like the ``apply_batch`` method of components.
+        """
+
+        outcomes = {}
+        remaining = list(members)
+        while remaining:
+            pending = []
+            waiting = []
+            for member in remaining:
+                try:
+                    if method == "deploy" and member.uptodate.get():
+                        outcomes[member] = Result()
+                        continue
+
+                    member.config
+
+                except NotAvailable as error:
+                    outcomes[member] = error
+                    waiting.append(member)
+                    continue
+
+                pending.append(member)
+
+            if not pending:
+                break
+
+            targets = [f"-target={member.address}" for member in pending]
+            try:
+                if method == "refresh":
+                    self.run("refresh", *targets)
+                    tf_result, plan = run_plan(self, *targets)
+
+                else:
+                    args = ["-destroy"] if method == "destroy" else []
+                    tf_result, plan = run_plan(
+                        self, *args, "-refresh=false", *targets, apply=not dry_run
+                    )
+
+            except OperationError as error:
+                outcomes[pending[0]] = error
+                break
+
+            for member in pending:
+                result = member._get_result(tf_result, plan)
+                if method == "refresh":
+                    member.uptodate.set(not result.changed, refreshed=True)
+                elif method == "deploy":
+                    member.uptodate.set((not result.changed) if dry_run else True)
+                else:
+                    member.uptodate.set(False)
+                outcomes[member] = result
+
+            # members that depend on the outputs of the ones that were just
+            # applied can be tried again
+            remaining = waiting
+
+        return [outcomes.get(member) for member in members]
+
+    def add_commands(self, cli):
+        @cli.forward_command
+        def terraform(args):
+            self.run(*args, capture_output=False, exit=True)
+
+
+def _get_init_fingerprint(config, tfdir):
+    requirements = json.dumps(config.get("terraform", {}), sort_keys=True)
+    lock_file = tfdir / ".terraform.lock.hcl"
+    lock = lock_file.read_bytes() if lock_file.exists() else b""
+    return dict(
+        requirements=hashlib.sha256(requirements.encode("utf8")).hexdigest(),
+        lock=hashlib.sha256(lock).hexdigest(),
+    )
+
+
+def _init_terraform(component, config):
+    """
+    Run ``terraform init`` in the directory of ``component``, unless the
+    provider requirements and the lock file are the same as after the last
+    successful init, which is saved in the component's state, and the
+    plugins are still in the plugin cache.
+    """
+
+    operation = current_operation()
+    upgrade = operation is not None and operation.upgrade_providers
+
+    with component.terraform_directory() as tfdir:
+        fingerprint = _get_init_fingerprint(config, tfdir)
+        saved = component.init_state.get("init")
+        if (
+            saved == fingerprint
+            and (tfdir / ".terraform").is_dir()
+            and not _has_missing_plugins(tfdir)
+            and not upgrade
+        ):
+            return
+
+        if saved is None or saved["requirements"] != fingerprint["requirements"]:
+            upgrade = True
+
+        # the plugin cache is not safe for concurrent inits
+        cache_dir = get_plugin_cache_directory()
+        with directory_lock(cache_dir):
+            _run_terraform(component, "init", *(["-upgrade"] if upgrade else []))
+
+            used = _get_linked_plugins(tfdir, cache_dir)
+            for path in used:
+                os.utime(path)
+
+            max_size = os.environ.get("OPSLIB_TERRAFORM_PLUGIN_CACHE_SIZE")
+            if max_size:
+                prune_plugin_cache(parse_size(max_size), keep=used)
+
+        component.init_state["init"] = _get_init_fingerprint(config, tfdir)
+
+
+def _run_terraform(component, *args, **kwargs):
+    extra_env = {"TF_IN_AUTOMATION": "true"}
+    provider = component._get_provider()
+
+    cache_dir = get_plugin_cache_directory()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    if os.environ.get("OPSLIB_TERRAFORM_OFFLINE"):
+        # the plugin cache has the same layout as a filesystem mirror
+        extra_env["TF_CLI_CONFIG_FILE"] = str(_get_offline_config(cache_dir))
+        extra_env["TF_PLUGIN_CACHE_DIR"] = ""
+
+    else:
+        extra_env["TF_PLUGIN_CACHE_DIR"] = str(cache_dir)
+
+    parallelism = provider.props.parallelism if provider else None
+    if parallelism and args and args[0] in PARALLEL_COMMANDS:
+        args = (args[0], f"-parallelism={parallelism}", *args[1:])
+
+    with component.terraform_directory() as tfdir, directory_lock(tfdir):
+        return run("terraform", *args, **kwargs, cwd=tfdir, extra_env=extra_env)
+
+
+class _Output(Lazy):
+    """
+    A :class:`~opslib.lazy.Lazy` output value of a Terraform component, which
+    keeps track of the component, so that dependencies can be found.
+    """
+
+    def __init__(self, component, func):
+        super().__init__(func)
+        self.component = component
+
+
+def _iter_lazy(ob):
+    if isinstance(ob, Lazy):
+        yield ob
+
+    elif isinstance(ob, dict):
+        for value in ob.values():
+            yield from _iter_lazy(value)
+
+    elif isinstance(ob, (list, tuple)):
+        for value in ob:
+            yield from _iter_lazy(value)
+
+
+def _may_depend_on(component, others):
+    """
+    Returns ``True`` if the arguments of ``component`` may depend on the
+    outputs of any of ``others``. Lazy values other than outputs can't be
+    inspected, so they count as dependencies, unless already evaluated.
+    """
+
+    for lazy in _iter_lazy(component.props.args):
+        if isinstance(lazy, _Output):
+            if lazy.component in others:
+                return True
+
+        elif "value" not in vars(lazy):
+            return True
+
+    return False
+
+
+def _apply_concurrently(method, components, **kwargs):
+    """
+    Call ``method`` on each of ``components``, up to the ``concurrency`` of
+    their provider at the same time. Components that may depend on the
+    outputs of another component in the batch, and components whose inputs
+    were not available, are run one at a time once the others are done, so
+    that they don't see outputs that are about to change.
+    """
+
+    def call(component):
+        try:
+            return getattr(component, method)(**kwargs)
+
+        except Exception as error:
+            return error
+
+    dependent = {
+        component
+        for component in components
+        if _may_depend_on(component, set(components) - {component})
+    }
+    outcomes = {}
+
+    # each call gets a copy of the context, so that it sees the operation
+    max_workers = components[0].props.provider.props.concurrency
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            component: executor.submit(contextvars.copy_context().run, call, component)
+            for component in components
+            if component not in dependent
+        }
+        for component, future in futures.items():
+            outcomes[component] = future.result()
+
+    for component in components:
+        if component in dependent or isinstance(outcomes[component], NotAvailable):
+            outcomes[component] = call(component)
+
+    return [outcomes[component] for component in components]
+
+
 class _TerraformComponent(StatefulMixin, Component):
     class Props:
         provider = Prop(Optional[TerraformProvider])
@@ -121,33 +830,68 @@ class _TerraformComponent(StatefulMixin, Component):
         output = Prop(Optional[list])
 
     config: Any
+    init_state = JsonState()
+
+    @cached_property
+    def workspace(self):
+        """
+        The :class:`TerraformWorkspace` used by this component, or ``None``.
+        """
+
+        parent = self._meta.parent
+        while parent is not None:
+            if isinstance(parent, TerraformWorkspace):
+                return parent
+            parent = parent._meta.parent
+
+        provider = self.props.provider
+        if provider is not None and provider.props.workspace:
+            return provider.workspace
+
+        return None
+
+    @property
+    def name(self):
+        """
+        Name of the resource in the Terraform configuration.
+        """
+
+        if self.workspace is None:
+            return "thing"
+
+        return self._meta.full_name.replace(".", "-")
 
     @property
     def address(self):
-        return f"{self.props.type}.thing"
+        return f"{self.props.type}.{self.name}"
+
+    def _output_name(self, key):
+        if self.workspace is None:
+            return key
+
+        return f"{self.name}__{key}"
 
     @contextmanager
     def terraform_directory(self):
+        if self.workspace is not None:
+            with self.workspace.terraform_directory() as tfdir:
+                yield tfdir
+            return
+
         with self.state_directory() as statedir:
             yield statedir / "terraform"
 
-    def _run(self, *args, **kwargs):
-        extra_env = {"TF_IN_AUTOMATION": "true"}
-        provider = self.props.provider
-
-        with provider.plugin_cache_path() as plugin_cache_path:
-            if provider and not os.environ.get("TF_PLUGIN_CACHE_DIR"):
-                plugin_cache_path.mkdir(exist_ok=True)
-                extra_env["TF_PLUGIN_CACHE_DIR"] = str(plugin_cache_path)
+    def _get_provider(self):
+        return self.props.provider
 
-            with self.terraform_directory() as tfdir:
-                return run("terraform", *args, **kwargs, cwd=tfdir, extra_env=extra_env)
+    def _run(self, *args, **kwargs):
+        return _run_terraform(self, *args, **kwargs)
 
     def _init(self):
-        with self.terraform_directory() as tfdir:
-            tfdir.mkdir(exist_ok=True, mode=0o700)
-            (tfdir / "main.tf.json").write_text(json.dumps(self.config, indent=2))
-            self._run("init", "-upgrade")  # XXX not concurrency safe
+        config = self.config
+        with self.terraform_directory() as tfdir, directory_lock(tfdir):
+            (tfdir / "main.tf.json").write_text(json.dumps(config, indent=2))
+            _init_terraform(self, config)
             self._init = lambda: None
 
     def run(self, *args, terraform_init=True, **kwargs):
@@ -155,13 +899,27 @@ class _TerraformComponent(StatefulMixin, Component):
         Run the ``terraform`` command with the given arguments.
         """
 
+        if self.workspace is not None:
+            return self.workspace.run(*args, terraform_init=terraform_init, **kwargs)
+
         if terraform_init:
             self._init()
         return self._run(*args, **kwargs)
 
-    @cached_property
+    def _targets(self):
+        if self.workspace is None:
+            return []
+
+        return [f"-target={self.address}"]
+
+    def _get_result(self, tf_result, plan):
+        outputs = [self._output_name(key) for key in self.props.output or []]
+        return TerraformResult(tf_result, plan, address=self.address, outputs=outputs)
+
+    @property
     def _output_values(self):
-        return json.loads(self.run("output", "-json", terraform_init=False).stdout)
+        with self.terraform_directory() as tfdir:
+            return read_outputs(tfdir)
 
     @cached_property
     def output(self):
@@ -172,21 +930,44 @@ class _TerraformComponent(StatefulMixin, Component):
         def lazy_output(name):
             def get_value():
                 try:
-                    with self.terraform_directory() as tfdir:
-                        if not tfdir.exists():
-                            raise KeyError
-
-                    output = self._output_values[name]
+                    output = self._output_values[self._output_name(name)]
 
                 except KeyError:
                     raise NotAvailable(f"{self!r}: output {name!r} not available")
 
                 return output["value"]
 
-            return Lazy(get_value)
+            return _Output(self, get_value)
 
         return {name: lazy_output(name) for name in self.props.output}
 
+    def get_batch_key(self, method):
+        if method not in ["refresh", "deploy", "destroy"]:
+            return None
+
+        if self.workspace is not None:
+            return self.workspace
+
+        provider = self.props.provider
+        if provider is not None and provider.props.concurrency > 1:
+            return provider
+
+        return None
+
+    @classmethod
+    def apply_batch(cls, method, components, **kwargs):
+        """
+        Run consecutive components that share a :class:`TerraformWorkspace`
+        with a single ``terraform`` command. Consecutive components of a
+        provider with ``concurrency`` are run at the same time.
+        """
+
+        workspace = components[0].workspace
+        if workspace is None:
+            return _apply_concurrently(method, components, **kwargs)
+
+        return workspace.apply_members(method, components, **kwargs)
+
     def add_commands(self, cli):
         @cli.forward_command
         def terraform(args):
@@ -220,14 +1001,14 @@ class TerraformResource(_TerraformComponent):
             provider.config if provider else {},
             resource={
                 self.props.type: {
-                    "thing": evaluate(self.props.args),
+                    self.name: evaluate(self.props.args),
                 },
             },
         )
 
         if self.props.output:
             config["output"] = {
-                key: {
+                self._output_name(key): {
                     "value": f"${{{self.address}.{key}}}",
                     "sensitive": True,
                 }
@@ -238,14 +1019,20 @@ class TerraformResource(_TerraformComponent):
 
     @uptodate.refresh
     def refresh(self):
-        self.run("refresh")
-        return TerraformResult(self.run("plan"))
+        self.run("refresh", *self._targets())
+        return self._get_result(*run_plan(self, *self._targets()))
 
     def _apply(self, dry_run=False, destroy=False):
-        args = ["plan"] if dry_run else ["apply", "-auto-approve"]
-        if destroy:
-            args.append("-destroy")
-        return TerraformResult(self.run(*args, "-refresh=false"))
+        args = ["-destroy"] if destroy else []
+        return self._get_result(
+            *run_plan(
+                self,
+                *args,
+                "-refresh=false",
+                *self._targets(),
+                apply=not dry_run,
+            )
+        )
 
     @uptodate.deploy
     def deploy(self, dry_run=False):
@@ -302,15 +1089,15 @@ class TerraformDataSource(_TerraformComponent):
             provider.config if provider else {},
             data={
                 self.props.type: {
-                    "thing": evaluate(self.props.args),
+                    self.name: evaluate(self.props.args),
                 },
             },
         )
 
         if self.props.output:
             config["output"] = {
-                key: {
-                    "value": f"${{data.{self.address}.{key}}}",
+                self._output_name(key): {
+                    "value": f"${{{self.address}.{key}}}",
                     "sensitive": True,
                 }
                 for key in self.props.output
@@ -318,10 +1105,14 @@ class TerraformDataSource(_TerraformComponent):
 
         return config
 
+    @property
+    def address(self):
+        return f"data.{super().address}"
+
     @uptodate.refresh
     def refresh(self):
-        self.run("refresh")
-        return TerraformResult(self.run("plan"))
+        self.run("refresh", *self._targets())
+        return self._get_result(*run_plan(self, *self._targets()))
 
     @uptodate.deploy
     def deploy(self, dry_run=False):
@@ -329,3 +1120,13 @@ class TerraformDataSource(_TerraformComponent):
             return Result(changed=True)
 
         return self.refresh()
+
+    @classmethod
+    def apply_batch(cls, method, components, **kwargs):
+        if method == "deploy" and components[0].workspace is not None:
+            if kwargs.get("dry_run"):
+                return [Result(changed=True) for _ in components]
+
+            return super().apply_batch("refresh", components)
+
+        return super().apply_batch(method, components, **kwargs)
@@ -2,6 +2,8 @@ from collections.abc import Iterator
 from contextlib import contextmanager
 import hashlib
 import json
+import time
+from datetime import timedelta
 from functools import partial, wraps
 from pathlib import Path
 
@@ -9,9 +11,10 @@ from .results import Result
 
 
 class ComponentUpToDate:
-    def __init__(self, component, get_snapshot):
+    def __init__(self, component, get_snapshot, refresh_ttl=None):
         self.component = component
         self.get_snapshot = get_snapshot
+        self.default_refresh_ttl = refresh_ttl
 
     @contextmanager
     def json_path(self) -> Iterator[Path]:
@@ -23,24 +26,85 @@ class ComponentUpToDate:
         buffer = json.dumps(snapshot, sort_keys=True).encode("utf8")
         return hashlib.sha256(buffer).hexdigest()
 
-    def set(self, uptodate):
-        with self.json_path() as json_path:
-            json_path.write_text(json.dumps(self._get_hash() if uptodate else None))
-
-    def get(self):
+    def _load(self):
         try:
             with self.json_path() as json_path:
-                hash = json.loads(json_path.read_text())
+                data = json.loads(json_path.read_text())
 
         except FileNotFoundError:
-            hash = None
+            data = None
+
+        if not isinstance(data, dict):
+            # older versions only stored the hash
+            data = {"hash": data, "refreshed": None}
 
+        return data
+
+    def set(self, uptodate, refreshed=False):
+        """
+        Record whether the component is up to date. If ``refreshed`` is set,
+        the state was just inspected, so the refresh time is updated;
+        otherwise the previous one is kept.
+        """
+
+        data = {
+            "hash": self._get_hash() if uptodate else None,
+            "refreshed": time.time() if refreshed else self.refreshed,
+        }
+        with self.json_path() as json_path:
+            json_path.write_text(json.dumps(data))
+
+    def get(self):
+        hash = self._load()["hash"]
         return hash == self._get_hash() if hash else False
 
+    @property
+    def refreshed(self):
+        """
+        Timestamp of the last time the component's state was inspected, or
+        ``None`` if it's unknown.
+        """
+
+        return self._load()["refreshed"]
+
+    @property
+    def refresh_ttl(self) -> timedelta | None:
+        """
+        How long the result of a refresh is considered fresh. Taken from the
+        component's ``refresh_ttl`` attribute if set, otherwise from the
+        :class:`UpToDate` descriptor.
+        """
+
+        ttl = getattr(self.component, "refresh_ttl", None)
+        return ttl if ttl is not None else self.default_refresh_ttl
+
+    def is_stale(self, now=None):
+        """
+        Returns ``True`` if the component has never been refreshed, it has no
+        refresh TTL, or the TTL has expired.
+        """
+
+        refreshed = self.refreshed
+        ttl = self.refresh_ttl
+        if refreshed is None or ttl is None:
+            return True
+
+        if now is None:
+            now = time.time()
+
+        return now - refreshed >= ttl.total_seconds()
+
 
 class UpToDate:
+    def __init__(self, refresh_ttl: timedelta | None = None):
+        self.refresh_ttl = refresh_ttl
+
     def __get__(self, obj, objtype=None):
-        return ComponentUpToDate(obj, partial(self.snapshot_func, obj))
+        return ComponentUpToDate(
+            obj,
+            partial(self.snapshot_func, obj),
+            refresh_ttl=self.refresh_ttl,
+        )
 
     def snapshot(self, func):
         self.snapshot_func = func
@@ -50,7 +114,7 @@ class UpToDate:
         @wraps(func)
         def decorator(obj):
             result = func(obj)
-            obj.uptodate.set(not result.changed)
+            obj.uptodate.set(not result.changed, refreshed=True)
             return result
 
         return decorator
@@ -75,3 +139,29 @@ class UpToDate:
             return result
 
         return decorator
+
+
+def get_refreshed(component):
+    """
+    Returns the last refresh timestamp of ``component``, or ``None`` if it
+    doesn't keep track of it.
+    """
+
+    uptodate = getattr(component, "uptodate", None)
+    if isinstance(uptodate, ComponentUpToDate):
+        return uptodate.refreshed
+
+    return None
+
+
+def is_stale(component, now=None):
+    """
+    Returns ``True`` if ``component`` should be refreshed. Components that
+    don't keep track of refresh times are always stale.
+    """
+
+    uptodate = getattr(component, "uptodate", None)
+    if isinstance(uptodate, ComponentUpToDate):
+        return uptodate.is_stale(now=now)
+
+    return True
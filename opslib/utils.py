@@ -1,8 +1,64 @@
+import os
+import re
+import stat
+from datetime import timedelta
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 from .local import run
 
+DURATION_UNITS = {
+    "s": "seconds",
+    "m": "minutes",
+    "h": "hours",
+    "d": "days",
+}
+
+SIZE_UNITS = {
+    "": 1,
+    "k": 1024,
+    "m": 1024**2,
+    "g": 1024**3,
+    "t": 1024**4,
+}
+
+
+def get_cache_directory() -> Path:
+    """
+    Returns the user-level cache directory for opslib, which is shared across
+    stacks. It's ``$OPSLIB_CACHE_DIR`` if set, otherwise ``opslib`` inside
+    ``$XDG_CACHE_HOME`` (which defaults to ``~/.cache``). The directory is not
+    created.
+    """
+
+    if os.environ.get("OPSLIB_CACHE_DIR"):
+        return Path(os.environ["OPSLIB_CACHE_DIR"])
+
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(xdg_cache_home) / "opslib"
+
+
+def get_private_directory(path: Path) -> Path:
+    """
+    Create the directory ``path``, if missing, and make sure that it's a real
+    directory, owned by the current user, with mode ``0700``, so that other
+    users can't tamper with its contents, e.g. by creating it beforehand.
+    """
+
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    st = os.lstat(path)
+    if (
+        not stat.S_ISDIR(st.st_mode)
+        or st.st_uid != os.getuid()
+        or stat.S_IMODE(st.st_mode) != 0o700
+    ):
+        raise RuntimeError(
+            f"Refusing to use {path}: it must be a directory owned by the "
+            "current user, with mode 0700"
+        )
+
+    return path
+
 
 def colordiff(path, before, after):
     diff_output = plain_diff(path, before, after)
@@ -48,3 +104,37 @@ def get_diff_tool():
 def diff(path, before, after):
     tool = get_diff_tool()
     return tool(path, before, after)
+
+
+def parse_duration(value):
+    """
+    Parse a duration like ``"90s"``, ``"5m"`` or ``"1h30m"`` into a
+    :class:`~datetime.timedelta`. A bare number is a number of seconds.
+    """
+
+    value = value.strip()
+    if re.fullmatch(r"\d+(\.\d+)?", value):
+        return timedelta(seconds=float(value))
+
+    parts = re.findall(r"(\d+(?:\.\d+)?)([smhd])", value)
+    if not parts or "".join(n + u for n, u in parts) != value:
+        raise ValueError(f"Invalid duration: {value!r}")
+
+    return sum(
+        (timedelta(**{DURATION_UNITS[unit]: float(number)}) for number, unit in parts),
+        timedelta(),
+    )
+
+
+def parse_size(value):
+    """
+    Parse a size like ``"500M"`` or ``"2G"`` into a number of bytes. Units are
+    powers of 1024, and a bare number is a number of bytes.
+    """
+
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?", value.strip().lower())
+    if not match:
+        raise ValueError(f"Invalid size: {value!r}")
+
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit])
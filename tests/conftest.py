@@ -8,7 +8,7 @@ import pytest
 
 from opslib.components import Stack
 from opslib.local import run
-from opslib.places import SshHost
+from opslib.places import ContainerHost, SshHost
 from opslib.state import ComponentStateDirectory
 
 IMAGE = "opslib-tests"
@@ -128,6 +128,12 @@ def ssh_container(container_image, tmp_path):
         yield SshHost(hostname="opslib-tests", config_file=config_file)
 
 
+@pytest.fixture
+def podman_container(container_image):
+    with container(container_image):
+        yield ContainerHost(container=CONTAINER, user="opslib")
+
+
 def pytest_addoption(parser):
     parser.addoption("--runslow", action="store_true", help="Run slow tests")
 
@@ -150,6 +156,11 @@ def no_statedir_outside_tmp_path(tmp_path, monkeypatch):
     monkeypatch.setattr(ComponentStateDirectory, "_mkdir", mock_mkdir)
 
 
+@pytest.fixture(autouse=True)
+def cache_dir_in_tmp_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPSLIB_CACHE_DIR", str(tmp_path / "cache"))
+
+
 @pytest.fixture
 def TestingStack(tmp_path):
     class TestingStack(Stack):
@@ -1,9 +1,21 @@
 import sys
+from copy import copy
+from datetime import timedelta
+from pathlib import Path
+from textwrap import dedent
 
 import pytest
+from click.testing import CliRunner
 
-from opslib.ansible import AnsibleAction, run_ansible
-from opslib.operations import apply
+from opslib import run
+from opslib.ansible import (
+    AnsibleAction,
+    AnsibleSession,
+    get_ansiballz_cache_directory,
+    run_ansible,
+)
+from opslib.cli import get_cli
+from opslib.operations import AbortOperation, Operation, apply
 from opslib.places import LocalHost
 from opslib.results import OperationError
 
@@ -75,3 +87,300 @@ def test_check_not_supported(stack, op):
 
     results = apply(stack, **op)
     assert results[stack.action].changed
+
+
+def test_session_reused_during_operation(stack, monkeypatch):
+    sessions = []
+    original_init = AnsibleSession.__init__
+
+    def mock_init(self, *args, **kwargs):
+        sessions.append(self)
+        original_init(self, *args, **kwargs)
+
+    monkeypatch.setattr(AnsibleSession, "__init__", mock_init)
+
+    host = LocalHost()
+    stack.one = host.ansible_action(
+        module="ansible.builtin.shell",
+        args=dict(cmd="echo one"),
+    )
+    stack.two = host.ansible_action(
+        module="ansible.builtin.shell",
+        args=dict(cmd="echo two"),
+    )
+
+    results = apply(stack, deploy=True)
+    assert len(sessions) == 1
+    assert results[stack.one].stdout == "one"
+    assert results[stack.two].stdout == "two"
+
+
+def test_session_runs_after_failure():
+    with Operation():
+        with pytest.raises(OperationError):
+            run_local_ansible(
+                action=dict(
+                    module="ansible.builtin.shell",
+                    args=dict(cmd="false"),
+                ),
+            )
+
+        result = run_local_ansible(
+            action=dict(
+                module="ansible.builtin.shell",
+                args=dict(cmd="echo still here"),
+            ),
+        )
+
+    assert result.stdout == "still here"
+
+
+@pytest.fixture
+def count_plays(monkeypatch):
+    plays = []
+    original_run = AnsibleSession.run
+
+    def mock_run(self, tasks, check=False):
+        plays.append(tasks)
+        return original_run(self, tasks, check=check)
+
+    monkeypatch.setattr(AnsibleSession, "run", mock_run)
+    return plays
+
+
+def test_batch_actions_in_one_play(tmp_path, stack, count_plays):
+    host = LocalHost()
+    for name in ["one", "two", "three"]:
+        setattr(
+            stack,
+            name,
+            host.file(path=tmp_path / f"{name}.txt", content=f"{name}\n"),
+        )
+
+    results = apply(stack, deploy=True)
+    assert len(count_plays) == 1
+    assert len(count_plays[0]) == 3
+    assert (tmp_path / "two.txt").read_text() == "two\n"
+    assert results[stack.two.action].changed
+    assert stack.two.action.uptodate.get()
+
+    results = apply(stack, deploy=True)
+    assert len(count_plays) == 1
+    assert not results[stack.two.action].changed
+
+
+def test_batch_refresh_stale_only(tmp_path, stack, count_plays):
+    host = LocalHost()
+    for name in ["one", "two"]:
+        setattr(stack, name, host.file(path=tmp_path / name, content=name))
+    apply(stack, refresh=True)
+    assert len(count_plays) == 1
+
+    for file in [stack.one, stack.two]:
+        assert file.action.uptodate.refreshed is not None
+        file.action.refresh_ttl = timedelta(hours=1)
+
+    apply(stack, refresh=True, stale_only=True)
+    assert len(count_plays) == 1
+
+
+def test_batch_diff_per_action(tmp_path, stack, capsys, count_plays):
+    host = LocalHost()
+    (tmp_path / "one.txt").write_text("one\n")
+    stack.one = host.file(path=tmp_path / "one.txt", content="one\n")
+    stack.two = host.file(path=tmp_path / "two.txt", content="two\n")
+
+    results = apply(stack, deploy=True, dry_run=True)
+    assert len(count_plays) == 1
+    assert not results[stack.one.action].changed
+    assert results[stack.two.action].changed
+    assert "+two" in results[stack.two.action].output
+    assert not (tmp_path / "two.txt").exists()
+
+    captured = capsys.readouterr()
+    assert "one.action AnsibleAction [ok]\ntwo.action AnsibleAction [changed]\n" in (
+        captured.out
+    )
+
+
+def test_batch_stops_at_failure(tmp_path, stack, count_plays):
+    host = LocalHost()
+    stack.one = host.file(path=tmp_path / "one.txt", content="one\n")
+    stack.two = host.ansible_action(
+        module="ansible.builtin.shell",
+        args=dict(cmd="false"),
+    )
+    stack.three = host.file(path=tmp_path / "three.txt", content="three\n")
+
+    with pytest.raises(AbortOperation):
+        apply(stack, deploy=True)
+
+    assert len(count_plays) == 1
+    assert (tmp_path / "one.txt").exists()
+    assert stack.one.action.uptodate.get()
+    assert not (tmp_path / "three.txt").exists()
+
+
+def test_batch_on_change(tmp_path, stack):
+    host = LocalHost()
+    out_path = tmp_path / "out.txt"
+    stack.one = host.file(path=tmp_path / "one.txt", content="one\n")
+    stack.two = host.file(path=tmp_path / "two.txt", content="two\n")
+    stack.cmd = host.command(
+        args=["cp", tmp_path / "two.txt", out_path],
+        run_after=[stack.two],
+    )
+
+    apply(stack, deploy=True)
+    assert out_path.read_text() == "two\n"
+
+
+def test_batch_on_change_skipped_after_failure(tmp_path, stack):
+    host = LocalHost()
+    stack.one = host.ansible_action(
+        module="ansible.builtin.shell", args=dict(cmd="false")
+    )
+    stack.two = host.file(path=tmp_path / "two.txt", content="two\n")
+    stack.cmd = host.command(args=["true"], run_after=[stack.two])
+
+    with pytest.raises(AbortOperation):
+        apply(stack, deploy=True)
+
+    assert not stack.cmd.state.get("must-run")
+
+
+class NamedLocalHost(LocalHost):
+    def __init__(self, hostname):
+        super().__init__()
+        self.hostname = hostname
+
+
+@pytest.mark.parametrize("op", [dict(refresh=True), dict(deploy=True, dry_run=True)])
+def test_deploy_reuses_clean_check(tmp_path, stack, count_plays, op):
+    path = tmp_path / "foo.txt"
+    path.write_text("foo\n")
+    stack.foo = LocalHost().file(path=path, content="foo\n")
+
+    apply(stack, **op)
+    assert len(count_plays) == 1
+
+    results = apply(stack, deploy=True)
+    assert not results[stack.foo.action].changed
+    assert len(count_plays) == 1
+
+
+def test_deploy_after_check_with_new_inputs(tmp_path, TestingStack, count_plays):
+    path = tmp_path / "foo.txt"
+    path.write_text("foo\n")
+    stack = TestingStack()
+    stack.foo = LocalHost().file(path=path, content="foo\n")
+    apply(stack, refresh=True)
+
+    stack = TestingStack()
+    stack.foo = LocalHost().file(path=path, content="bar\n")
+    results = apply(stack, deploy=True)
+    assert results[stack.foo.action].changed
+    assert len(count_plays) == 2
+    assert path.read_text() == "bar\n"
+
+
+def test_identical_actions_share_multi_host_play(stack, count_plays):
+    for hostname in ["alpha", "beta"]:
+        setattr(
+            stack,
+            hostname,
+            NamedLocalHost(hostname).ansible_action(
+                module="ansible.builtin.shell",
+                args=dict(cmd="echo {{ inventory_hostname }}"),
+            ),
+        )
+
+    stack.gamma = NamedLocalHost("gamma").ansible_action(
+        module="ansible.builtin.shell",
+        args=dict(cmd="echo gamma is different"),
+    )
+
+    results = apply(stack, deploy=True)
+    assert len(count_plays) == 2
+    assert results[stack.alpha].stdout == "alpha"
+    assert results[stack.beta].stdout == "beta"
+    assert results[stack.gamma].stdout == "gamma is different"
+
+
+def test_batch_keeps_order_across_host_variants(tmp_path, stack, count_plays):
+    host = LocalHost()
+    variant = copy(host)
+    variant.ansible_variables = [*host.ansible_variables, ("opslib_variant", "b")]
+
+    stack.one = host.directory(path=tmp_path / "one")
+    stack.two = variant.directory(path=tmp_path / "one/two")
+    stack.three = host.file(path=tmp_path / "one/two/three.txt", content="three\n")
+
+    apply(stack, deploy=True)
+    assert len(count_plays) == 3
+    assert (tmp_path / "one/two/three.txt").read_text() == "three\n"
+
+
+def test_forks_passed_to_session(stack, monkeypatch):
+    session_forks = []
+    original_init = AnsibleSession.__init__
+
+    def mock_init(self, hosts, forks=None):
+        session_forks.append(forks)
+        original_init(self, hosts, forks=forks)
+
+    monkeypatch.setattr(AnsibleSession, "__init__", mock_init)
+    for hostname in ["alpha", "beta"]:
+        setattr(
+            stack,
+            hostname,
+            NamedLocalHost(hostname).ansible_action(
+                module="ansible.builtin.shell", args=dict(cmd="true")
+            ),
+        )
+
+    result = CliRunner().invoke(
+        get_cli(stack), ["deploy", "--forks", "3"], catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    assert session_forks == [3]
+
+
+def test_ansiballz_cache_saved():
+    run_local_ansible(action=dict(module="ansible.builtin.ping"))
+    cache_dir = get_ansiballz_cache_directory()
+    assert (cache_dir / "ansible.modules.ping-ZIP_DEFLATED").is_file()
+
+
+def test_ansiballz_cache_restored():
+    from ansible import constants as C
+
+    cache_dir = get_ansiballz_cache_directory()
+    cache_dir.mkdir(parents=True)
+    (cache_dir / "ansible.modules.opslib_test-ZIP_DEFLATED").write_text("payload")
+
+    AnsibleSession([("localhost", [])]).close()
+
+    tmp_path = Path(C.DEFAULT_LOCAL_TMP) / "ansiballz_cache"
+    assert (
+        tmp_path / "ansible.modules.opslib_test-ZIP_DEFLATED"
+    ).read_text() == "payload"
+
+
+def test_ansible_not_imported_until_used(tmp_path):
+    script = dedent(
+        f"""\
+        import sys
+        from opslib import LocalHost, Stack
+        from opslib.components import walk
+
+        stack = Stack(stateroot={str(tmp_path)!r})
+        stack.host = LocalHost()
+        stack.dir = stack.host.directory({str(tmp_path)!r})
+        stack.file = stack.dir.file("foo.txt", content="foo")
+        list(walk(stack))
+        assert "ansible" not in sys.modules, "ansible was imported"
+        """
+    )
+    result = run(sys.executable, "-c", script, check=False)
+    assert not result.failed, result.output
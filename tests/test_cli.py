@@ -130,3 +130,23 @@ def test_forward_command_with_custom_name(stack):
 
     stack.my_command = MyCommand()
     assert invoke_output(stack, "my_command", "bar", "a", "b") == "['a', ('b',)]\n"
+
+
+def test_refresh_options(stack):
+    log = []
+
+    class Target(Component):
+        def refresh(self):
+            log.append("refresh")
+            return Result()
+
+    stack.target = Target()
+    cli = get_cli(stack)
+    CliRunner().invoke(cli, ["refresh", "--stale-only"], catch_exceptions=False)
+    assert log == ["refresh"]
+
+    CliRunner().invoke(cli, ["refresh", "--budget", "5m"], catch_exceptions=False)
+    assert log == ["refresh", "refresh"]
+
+    result = CliRunner().invoke(cli, ["refresh", "--budget", "soon"])
+    assert "Invalid duration: 'soon'" in result.output
@@ -0,0 +1,111 @@
+import os
+from pathlib import Path
+from textwrap import dedent
+
+import pytest
+
+from opslib import places
+from opslib.operations import apply
+from opslib.places import ContainerHost
+
+
+@pytest.fixture
+def exec_calls(monkeypatch):
+    calls = []
+
+    def mock_run(*args, **kwargs):
+        calls.append(args)
+
+    monkeypatch.setattr(places, "run", mock_run)
+    return calls
+
+
+@pytest.fixture
+def fake_podman(tmp_path, monkeypatch):
+    """
+    Install a fake ``podman`` that runs ``exec`` commands on the local host.
+    """
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    podman = bin_dir / "podman"
+    podman.write_text(
+        dedent(
+            """\
+            #!/bin/sh
+            shift
+            while true; do
+                case "$1" in
+                    -i|-t) shift ;;
+                    --user) shift 2 ;;
+                    --workdir) cd "$2"; shift 2 ;;
+                    *) break ;;
+                esac
+            done
+            shift
+            exec "$@"
+            """
+        )
+    )
+    podman.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_run(exec_calls):
+    host = ContainerHost(container="web")
+    host.run("true")
+    assert exec_calls == [("podman", "exec", "web", "true")]
+
+
+def test_run_options(exec_calls):
+    host = ContainerHost(container="web", engine="docker", user="app")
+    host.run("cat", input="hi", cwd=Path("/srv"))
+    host.sudo().run("id")
+    assert exec_calls == [
+        ("docker", "exec", "-i", "--user", "app", "--workdir", "/srv", "web", "cat"),
+        ("docker", "exec", "--user", "root", "web", "id"),
+    ]
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        ContainerHost(container="web", engine="lxc")
+
+
+def test_ansible_variables():
+    host = ContainerHost(container="web", user="app")
+    assert host.hostname == "web"
+    assert ("ansible_connection", "containers.podman.podman") in host.ansible_variables
+    assert host.sudo().ansible_variables[-1] == ("ansible_user", "root")
+
+
+@pytest.mark.parametrize("use_agent", [False, True])
+def test_native_file(fake_podman, tmp_path, stack, use_agent):
+    host = ContainerHost(container="web", native=True, use_agent=use_agent)
+    stack.foo = host.file(path=tmp_path / "foo.txt", content="hello\n")
+
+    apply(stack, deploy=True)
+
+    assert (tmp_path / "foo.txt").read_text() == "hello\n"
+    assert host.run("cat", "foo.txt", cwd=tmp_path).stdout == "hello\n"
+
+
+@pytest.mark.slow
+def test_container_run(podman_container):
+    result = podman_container.run("id")
+    assert result.stdout == "uid=1000(opslib) gid=1000(opslib) groups=1000(opslib)\n"
+
+    result = podman_container.sudo().run("id")
+    assert result.stdout.startswith("uid=0(root) gid=0(root)")
+
+
+@pytest.mark.slow
+def test_container_ansible(podman_container, stack):
+    stack.foo = podman_container.file(
+        path=Path("/tmp/foo.txt"),
+        content="hello world",
+    )
+
+    apply(stack, deploy=True)
+
+    assert podman_container.run("cat", "/tmp/foo.txt").stdout == "hello world"
@@ -1,4 +1,5 @@
 import sys
+import tempfile
 from pathlib import Path
 from textwrap import dedent
 
@@ -102,3 +103,54 @@ def test_exec_env():
     )
     result = run(sys.executable, input=input, cwd=repo_path)
     assert result.output == "hello world\n"
+
+
+def test_stream_to_terminal(capsys):
+    result = run("bash", "-c", "echo out; echo err >&2", stream=True, keep_spool=True)
+    captured = capsys.readouterr()
+    assert captured.out == "out\n"
+    assert captured.err == "err\n"
+    assert result.stdout == "out\n"
+    assert result.stderr == "err\n"
+    assert not result.truncated
+    assert sorted(result.spool_path.read_text().splitlines()) == ["err", "out"]
+    result.spool_path.unlink()
+
+
+def test_stream_tail(tmp_path):
+    log_path = tmp_path / "log"
+    script = "for i in $(seq 1000); do echo line $i; done; cat"
+    result = run("bash", "-c", script, input="the end\n", stream=log_path, tail_size=20)
+    assert result.truncated
+    assert result.stdout == "9\nline 1000\nthe end\n"
+    assert result.output == result.stdout
+    assert log_path.read_text().splitlines()[-1] == "the end"
+    assert result.spool_path is None
+
+
+def test_stream_spool_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path / "tmp"))
+    (tmp_path / "tmp").mkdir()
+    result = run("true", stream=tmp_path / "log")
+    assert result.spool_path is None
+    assert list((tmp_path / "tmp").iterdir()) == []
+
+    result = run("true", stream=tmp_path / "log", keep_spool=True)
+    assert result.spool_path.parent == tmp_path / "tmp"
+
+
+def test_stream_failed(tmp_path):
+    with pytest.raises(OperationError) as error:
+        run("bash", "-c", "echo oops; exit 3", stream=tmp_path / "log")
+
+    assert error.value.result.completed.returncode == 3
+    assert error.value.result.output == "oops\n"
+    assert error.value.result.spool_path.read_text() == "oops\n"
+    error.value.result.spool_path.unlink()
+
+
+def test_output_overwrite():
+    result = run("echo", "hello")
+    result.output = "formatted"
+    assert result.output == "formatted"
+    assert result.stdout == "hello\n"
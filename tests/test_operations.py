@@ -1,8 +1,12 @@
+import pytest
+from click.testing import CliRunner
+
+from opslib.cli import get_cli
 from opslib.components import Component
 from opslib.lazy import Lazy, NotAvailable
-from opslib.operations import apply
+from opslib.operations import AbortOperation, Rollout, apply
 from opslib.props import Prop
-from opslib.results import Result
+from opslib.results import OperationError, Result
 
 
 def test_call_deploy(stack):
@@ -137,3 +141,130 @@ def test_not_available(capsys, stack):
     assert results[stack.one].failed
     captured = capsys.readouterr()
     assert "one Task [failed]\nSomething is not quite ready yet\n" in captured.out
+
+
+class Member(Component):
+    class Props:
+        fail = Prop(bool, default=False)
+
+    def deploy(self, dry_run=False):
+        if self.props.fail and not dry_run:
+            raise OperationError(result=Result(failed=True))
+
+        return Result(changed=True)
+
+
+def add_members(parent, count, failing=()):
+    for n in range(count):
+        setattr(parent, f"m{n}", Member(fail=n in failing))
+
+
+@pytest.mark.parametrize(
+    "canary, batch_size, expected",
+    [
+        (1, 2, [[0], [1, 2], [3, 4], [5]]),
+        (0, 4, [[0, 1, 2, 3], [4, 5]]),
+        (2, "50%", [[0, 1], [2, 3, 4], [5]]),
+        (1, "10%", [[0], [1], [2], [3], [4], [5]]),
+    ],
+)
+def test_rollout_batches(canary, batch_size, expected):
+    rollout = Rollout(canary=canary, batch_size=batch_size)
+    assert rollout.get_batches(list(range(6))) == expected
+
+
+def test_rollout_invalid_batch_size():
+    with pytest.raises(ValueError):
+        Rollout(batch_size="half")
+
+
+def test_rollout_deploys_in_batches(capsys, stack):
+    checked = []
+
+    def health_check(batch):
+        checked.append(batch)
+        return True
+
+    stack.fleet = Component()
+    stack.fleet.rollout = Rollout(batch_size=2, health_check=health_check)
+    add_members(stack.fleet, 4)
+
+    results = apply(stack, deploy=True)
+
+    assert list(results) == [getattr(stack.fleet, f"m{n}") for n in range(4)]
+    assert [[m._meta.name for m in batch] for batch in checked] == [
+        ["m0"],
+        ["m1", "m2"],
+        ["m3"],
+    ]
+    captured = capsys.readouterr()
+    assert "fleet rollout, canary: m0\n" in captured.out
+    assert "fleet rollout, batch 3 of 3: m3\n" in captured.out
+
+
+def test_rollout_canary_failure_stops(capsys, stack):
+    stack.fleet = Component()
+    stack.fleet.rollout = Rollout(max_failure_rate=0.5)
+    add_members(stack.fleet, 3, failing={0})
+
+    with pytest.raises(AbortOperation):
+        apply(stack, deploy=True)
+
+    captured = capsys.readouterr()
+    assert "fleet rollout, batch" not in captured.out
+    assert "Rollout of fleet stopped: 1 of 1 failed" in captured.err
+
+
+@pytest.mark.parametrize("max_failure_rate, completed", [(0.5, True), (0.3, False)])
+def test_rollout_failure_threshold(capsys, stack, max_failure_rate, completed):
+    stack.fleet = Component()
+    stack.fleet.rollout = Rollout(batch_size=2, max_failure_rate=max_failure_rate)
+    add_members(stack.fleet, 5, failing={1})
+
+    if completed:
+        results = apply(stack, deploy=True)
+        assert len(results) == 5
+        assert results[stack.fleet.m1].failed
+        assert [m for m, r in results.items() if r.failed] == [stack.fleet.m1]
+
+    else:
+        with pytest.raises(AbortOperation):
+            apply(stack, deploy=True)
+
+    captured = capsys.readouterr()
+    assert ("m4 Member" in captured.out) == completed
+
+
+def test_rollout_health_check_stops(capsys, stack):
+    stack.fleet = Component()
+    stack.fleet.rollout = Rollout(health_check=lambda batch: False)
+    add_members(stack.fleet, 2)
+
+    with pytest.raises(AbortOperation):
+        apply(stack, deploy=True)
+
+    captured = capsys.readouterr()
+    assert "m0 Member [changed]" in captured.out
+    assert "m1 Member" not in captured.out
+    assert "Rollout of fleet stopped: health check failed" in captured.err
+
+
+def test_rollout_ignored_on_diff(stack):
+    stack.fleet = Component()
+    stack.fleet.rollout = Rollout(health_check=lambda batch: False)
+    add_members(stack.fleet, 2, failing={0})
+
+    results = apply(stack, deploy=True, dry_run=True)
+
+    assert len(results) == 2
+
+
+def test_rollout_failure_reported_by_cli(stack):
+    stack.fleet = Component()
+    stack.fleet.rollout = Rollout(batch_size=2, max_failure_rate=0.5)
+    add_members(stack.fleet, 3, failing={1})
+
+    result = CliRunner().invoke(get_cli(stack), ["deploy"])
+
+    assert result.exit_code == 1
+    assert "1 failed" in result.output
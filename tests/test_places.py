@@ -1,13 +1,31 @@
+import json
+import os
 import shlex
+import stat
+import sys
+from base64 import b64encode
+from datetime import timedelta
+from hashlib import sha1, sha256
+from io import BytesIO
+from pathlib import Path
 from textwrap import dedent
 
 import pytest
 from click.testing import CliRunner
 
+from opslib import agent, ansible
 from opslib.cli import get_cli
-from opslib.lazy import Lazy
-from opslib.operations import apply
-from opslib.places import LocalHost
+from opslib.lazy import Lazy, evaluate
+from opslib.local import run
+from opslib.operations import AbortOperation, Operation, apply, current_operation
+from opslib.places import (
+    HostGroup,
+    LocalHost,
+    NativeAction,
+    file_checksum,
+    get_agent_source,
+)
+from opslib.results import OperationError, Result
 
 
 @pytest.fixture
@@ -223,3 +241,717 @@ def test_file_mode_diff(tmp_path, local_host, capsys, stack):
     assert captured.err == ""
 
     assert (foo_path.stat().st_mode & 0xFFF) == 0o644
+
+
+@pytest.fixture
+def native_host():
+    return LocalHost(native=True)
+
+
+def test_native_file(tmp_path, native_host, stack):
+    path = tmp_path / "foo.txt"
+    stack.foo = native_host.file(
+        path=path,
+        content="hello foo",
+        mode="600",
+    )
+
+    apply(stack, deploy=True)
+
+    assert isinstance(stack.foo.action, NativeAction)
+    assert path.read_text() == "hello foo"
+    assert (path.stat().st_mode & 0xFFF) == 0o600
+
+
+def test_native_file_content_diff(tmp_path, native_host, capsys, stack):
+    foo_path = tmp_path / "foo.txt"
+    foo_path.write_text("hello\nworld\n")
+
+    stack.foo = native_host.file(
+        path=foo_path,
+        content="hello\nthere\n",
+    )
+
+    apply(stack, deploy=True, dry_run=True)
+
+    captured = capsys.readouterr()
+    assert captured.out == dedent(
+        f"""\
+        foo.action NativeAction ...
+        foo.action NativeAction [changed]
+        --- {foo_path}
+        +++ {foo_path}
+        @@ -1,2 +1,2 @@
+         hello
+        -world
+        +there
+
+        """
+    )
+    assert foo_path.read_text() == "hello\nworld\n", "Target file must not change"
+
+
+def test_native_file_mode_diff(tmp_path, native_host, capsys, stack):
+    foo_path = tmp_path / "foo.txt"
+    foo_path.touch(mode=0o644)
+
+    stack.foo = native_host.file(
+        path=foo_path,
+        content="",
+        mode="755",
+    )
+
+    apply(stack, deploy=True, dry_run=True)
+
+    captured = capsys.readouterr()
+    assert captured.out == dedent(
+        f"""\
+        foo.action NativeAction ...
+        foo.action NativeAction [changed]
+        --- {foo_path}
+        +++ {foo_path}
+        @@ -1 +1 @@
+        -{{'path': {str(foo_path)!r}, 'mode': '0644'}}
+        +{{'path': {str(foo_path)!r}, 'mode': '0755'}}
+
+        """
+    )
+    assert (foo_path.stat().st_mode & 0xFFF) == 0o644
+
+
+@pytest.mark.parametrize(
+    "kind, props",
+    [
+        ("file", dict(content="a\n", mode="600")),
+        ("file", dict(content="b\n", mode="600")),
+        ("file", dict(content="b\n")),
+        ("directory", dict(mode="700")),
+        ("new-directory", dict()),
+    ],
+)
+def test_native_diff_same_as_ansible(tmp_path, stack, kind, props):
+    outputs = []
+    for native in [False, True]:
+        path = tmp_path / str(native) / "foo"
+        if kind == "file":
+            path.parent.mkdir()
+            path.write_text("a\n")
+            path.chmod(0o644)
+        elif kind == "directory":
+            path.mkdir(mode=0o755, parents=True)
+
+        host = LocalHost(native=native)
+        method = host.file if kind == "file" else host.directory
+        setattr(stack, f"native_{native}", method(path=path, **props))
+        results = apply(stack, deploy=True, dry_run=True)
+        result = results[getattr(stack, f"native_{native}").action]
+        outputs.append(result.output.replace(str(native), "*"))
+
+    assert outputs[0] == outputs[1]
+
+
+def test_native_file_unchanged(tmp_path, native_host, stack):
+    path = tmp_path / "foo.txt"
+    path.write_text("hello foo")
+    stack.foo = native_host.file(
+        path=path,
+        content="hello foo",
+    )
+
+    results = apply(stack, refresh=True)
+
+    assert not results[stack.foo.action].changed
+
+
+@pytest.mark.parametrize("kind", ["bytes", "path"])
+def test_native_file_lazy_binary_content(tmp_path, native_host, stack, kind):
+    data = b"\x00\xffbinary"
+    source = tmp_path / "source.bin"
+    source.write_bytes(data)
+    path = tmp_path / "foo.bin"
+    stack.foo = native_host.file(
+        path=path,
+        content=Lazy(lambda: data if kind == "bytes" else source),
+    )
+
+    results = apply(stack, deploy=True)
+
+    assert isinstance(stack.foo.action, NativeAction)
+    assert results[stack.foo.action].changed
+    assert path.read_bytes() == data
+
+    results = apply(stack, refresh=True)
+    assert not results[stack.foo.action].changed
+
+
+def test_native_file_content_sent_when_writing(
+    tmp_path, native_host, stack, monkeypatch
+):
+    data = b"\x00\xffbinary"
+    stack.foo = native_host.file(path=tmp_path / "foo.bin", content=data)
+    calls = []
+    native_call = LocalHost.native_call
+
+    def mock_native_call(self, operation, **args):
+        calls.append(args)
+        return native_call(self, operation, **args)
+
+    monkeypatch.setattr(LocalHost, "native_call", mock_native_call)
+
+    snapshot = stack.foo.action._get_call()["args"]
+    assert snapshot["content_sha256"] == sha256(data).hexdigest()
+    assert "content_base64" not in snapshot
+
+    results = apply(stack, deploy=True, dry_run=True)
+    assert results[stack.foo.action].changed
+    assert "content_base64" not in calls[-1]
+
+    apply(stack, deploy=True)
+    assert calls[-1]["content_base64"] == b64encode(data).decode("ascii")
+    assert (tmp_path / "foo.bin").read_bytes() == data
+
+
+def test_native_file_binary_content(tmp_path, native_host, stack):
+    data = b"\x00\xffbinary"
+    source = tmp_path / "source.bin"
+    source.write_bytes(data)
+    stack.bytes = native_host.file(path=tmp_path / "bytes.bin", content=data)
+    stack.path = native_host.file(path=tmp_path / "path.bin", content=source)
+
+    results = apply(stack, deploy=True)
+
+    assert isinstance(stack.bytes.action, NativeAction)
+    assert isinstance(stack.path.action, ansible.AnsibleAction)
+    assert "src" in stack.path.action.props.args
+    assert results[stack.bytes.action].changed
+    assert results[stack.path.action].changed
+    assert (tmp_path / "bytes.bin").read_bytes() == data
+    assert (tmp_path / "path.bin").read_bytes() == data
+
+    results = apply(stack, refresh=True)
+    assert not results[stack.bytes.action].changed
+    assert not results[stack.path.action].changed
+
+
+def test_native_agent_unexpected_error(tmp_path):
+    request = dict(op="ensure_file", args=dict(path=str(tmp_path / "foo"), content=1))
+    response = agent.handle(request)
+    assert response["error"].startswith("AttributeError: ")
+
+
+def test_native_symbolic_mode_uses_ansible(tmp_path, native_host, stack):
+    stack.foo = native_host.file(
+        path=tmp_path / "foo.txt",
+        content="",
+        mode="u=rw",
+    )
+
+    assert not isinstance(stack.foo.action, NativeAction)
+
+
+def test_native_directory(tmp_path, native_host, stack):
+    path = tmp_path / "foo" / "bar"
+    stack.bar = native_host.directory(path)
+    stack.baz = stack.bar.file("baz", content="hello baz")
+
+    results = apply(stack, deploy=True)
+
+    assert results[stack.bar.action].changed
+    assert (path / "baz").read_text() == "hello baz"
+
+    results = apply(stack, refresh=True)
+
+    assert not results[stack.bar.action].changed
+    assert not results[stack.baz.action].changed
+
+
+def test_native_batch_one_call(tmp_path, native_host, stack, monkeypatch):
+    calls = []
+    native_call = LocalHost.native_call
+
+    def mock_native_call(self, operation, **args):
+        calls.append(operation)
+        return native_call(self, operation, **args)
+
+    monkeypatch.setattr(LocalHost, "native_call", mock_native_call)
+
+    for name in ["one", "two", "three"]:
+        setattr(stack, name, native_host.file(path=tmp_path / name, content=name))
+
+    apply(stack, deploy=True)
+
+    assert calls == ["batch"]
+    assert (tmp_path / "three").read_text() == "three"
+
+
+def test_native_batch_refresh_stale_only(tmp_path, native_host, stack, monkeypatch):
+    for name in ["one", "two"]:
+        setattr(stack, name, native_host.file(path=tmp_path / name, content=name))
+    apply(stack, deploy=True)
+    apply(stack, refresh=True)
+
+    for file in [stack.one, stack.two]:
+        assert file.action.uptodate.refreshed is not None
+        file.action.refresh_ttl = timedelta(hours=1)
+
+    calls = []
+    monkeypatch.setattr(LocalHost, "native_call", lambda *args, **kw: calls.append(1))
+    apply(stack, refresh=True, stale_only=True)
+    assert calls == []
+
+
+def test_native_batch_stops_at_failure(tmp_path, native_host, capsys, stack):
+    (tmp_path / "two").mkdir()
+    for name in ["one", "two", "three"]:
+        setattr(stack, name, native_host.file(path=tmp_path / name, content=name))
+
+    with pytest.raises(AbortOperation):
+        apply(stack, deploy=True)
+
+    assert "is not a regular file" in capsys.readouterr().out
+    assert (tmp_path / "one").read_text() == "one"
+    assert not (tmp_path / "three").exists()
+
+
+def test_native_batch_on_change_skipped_after_failure(tmp_path, native_host, stack):
+    (tmp_path / "one").mkdir()
+    stack.one = native_host.file(path=tmp_path / "one", content="one")
+    stack.two = native_host.file(path=tmp_path / "two", content="two")
+    stack.cmd = native_host.command(args=["true"], run_after=[stack.two])
+
+    with pytest.raises(AbortOperation):
+        apply(stack, deploy=True)
+
+    assert not stack.cmd.state.get("must-run")
+
+
+def test_native_agent_subprocess(tmp_path):
+    path = tmp_path / "foo.txt"
+    request = dict(op="ensure_file", args=dict(path=str(path), content="hi"))
+    result = run(
+        sys.executable,
+        "-c",
+        get_agent_source(),
+        input=json.dumps(request),
+    )
+
+    assert json.loads(result.stdout)["result"]["changed"]
+    assert path.read_text() == "hi"
+
+
+@pytest.fixture
+def count_setup(monkeypatch):
+    calls = []
+    run_ansible = ansible.run_ansible
+
+    def mock_run_ansible(**kwargs):
+        calls.append(kwargs["action"]["module"])
+        return run_ansible(**kwargs)
+
+    monkeypatch.setattr(ansible, "run_ansible", mock_run_ansible)
+    return calls
+
+
+def test_facts(local_host, stack, count_setup):
+    stack.host = local_host
+
+    assert "ansible_os_family" in evaluate(stack.host.facts)
+    assert evaluate(stack.host.facts)["ansible_system"] == "Linux"
+    assert count_setup == ["ansible.builtin.setup"]
+
+
+def test_facts_saved_in_state(TestingStack, count_setup):
+    stack = TestingStack()
+    stack.host = LocalHost()
+    facts = evaluate(stack.host.facts)
+
+    stack = TestingStack()
+    stack.host = LocalHost()
+    assert evaluate(stack.host.facts) == facts
+    assert len(count_setup) == 1
+
+
+def test_facts_ttl_expired(TestingStack, count_setup):
+    stack = TestingStack()
+    stack.host = LocalHost()
+    evaluate(stack.host.facts)
+
+    stack = TestingStack()
+    stack.host = LocalHost(facts_ttl=timedelta(0))
+    evaluate(stack.host.facts)
+    assert len(count_setup) == 2
+
+
+def test_facts_cached_per_operation(stack, count_setup):
+    stack.host = LocalHost(facts_ttl=timedelta(0))
+
+    def get_args():
+        return ["echo", evaluate(stack.host.facts)["ansible_system"]]
+
+    stack.one = stack.host.command(args=Lazy(get_args))
+    stack.two = stack.host.command(args=Lazy(get_args))
+
+    apply(stack, deploy=True)
+    assert len(count_setup) == 1
+
+    stack.three = stack.host.command(args=Lazy(get_args))
+    apply(stack.three, deploy=True)
+    assert len(count_setup) == 2
+
+
+def test_facts_detached_host(count_setup):
+    host = LocalHost()
+    assert "ansible_os_family" in evaluate(host.facts)
+    assert len(count_setup) == 1
+
+
+@pytest.fixture
+def agent_host():
+    return LocalHost(use_agent=True, native=True)
+
+
+def test_agent_run(tmp_path, agent_host):
+    result = agent_host.run("sh", "-c", "cat; pwd", input="hello\n", cwd=tmp_path)
+    assert result.stdout == f"hello\n{tmp_path}\n"
+
+    with pytest.raises(OperationError):
+        agent_host.run("false")
+
+    assert agent_host.run("false", check=False).failed
+
+
+def test_agent_process_reused(agent_host):
+    pids = {agent_host.run("sh", "-c", "echo $PPID").stdout for _ in range(3)}
+    assert len(pids) == 1
+
+
+def test_agent_native_file(tmp_path, agent_host, stack):
+    path = tmp_path / "foo.txt"
+    stack.foo = agent_host.file(path=path, content="hello foo")
+    apply(stack, deploy=True)
+    assert path.read_text() == "hello foo"
+
+
+def test_agent_file_operations(tmp_path, agent_host):
+    path = str(tmp_path / "foo.txt")
+    assert agent_host.native_call("stat", path=path) is None
+
+    content = b64encode(b"hello").decode()
+    agent_host.native_call("write_file", path=path, content=content, mode="600")
+    agent_host.native_call("chmod", path=path, mode="640")
+
+    stat = agent_host.native_call("stat", path=path)
+    assert stat["type"] == "file"
+    assert stat["size"] == 5
+    assert stat["mode"] == "0640"
+    assert agent_host.native_call("hash", path=path) == sha256(b"hello").hexdigest()
+    assert agent_host.native_call("read_file", path=path) == content
+
+
+def test_agent_serve():
+    requests = [
+        dict(op="hash", args=dict(path="/nonexistent")),
+        dict(op="nonexistent"),
+    ]
+    stdin = BytesIO()
+    for request in requests:
+        agent.write_frame(stdin, request)
+    stdin.seek(0)
+    stdout = BytesIO()
+
+    agent.serve(stdin, stdout)
+
+    stdout.seek(0)
+    assert agent.read_frame(stdout) == {"result": None}
+    assert agent.read_frame(stdout) == {"error": "KeyError: 'nonexistent'"}
+    assert agent.read_frame(stdout) is None
+
+
+@pytest.fixture
+def batch_host():
+    return LocalHost(batch_commands=True)
+
+
+def test_batch_commands(tmp_path, batch_host, stack, monkeypatch):
+    calls = []
+    original_run = LocalHost.run
+
+    def mock_run(self, *args, **kwargs):
+        calls.append(args)
+        return original_run(self, *args, **kwargs)
+
+    monkeypatch.setattr(LocalHost, "run", mock_run)
+
+    stack.one = batch_host.command(args=["echo", "one two"])
+    stack.two = batch_host.command(input="cat >&2 <<EOF\ntwo\nEOF\n")
+    stack.three = batch_host.command(args=["pwd"], cwd=tmp_path)
+    stack.four = batch_host.command(args=["cat"], input="it's\nfour")
+
+    results = apply(stack, deploy=True)
+
+    assert calls == [("sh",)]
+    assert results[stack.one].stdout == "one two\n"
+    assert results[stack.two].stderr == "two\n"
+    assert results[stack.three].stdout == f"{tmp_path}\n"
+    assert results[stack.four].stdout == "it's\nfour"
+
+
+def test_command_stream(batch_host, stack, capfd):
+    stack.one = batch_host.command(args=["echo", "one"])
+    stack.two = batch_host.command(args=["echo", "two"])
+    stack.three = batch_host.command(args=["echo", "three"], stream=True)
+
+    results = apply(stack, deploy=True)
+
+    assert results[stack.one].stdout == "one\n"
+    assert results[stack.two].stdout == "two\n"
+    assert results[stack.three].stdout == "three\n"
+    assert results[stack.three].spool_path is None
+    # streamed output is shown once, not repeated in the report
+    assert capfd.readouterr().out.splitlines().count("three") == 1
+
+
+def test_batch_commands_stop_at_failure(tmp_path, batch_host, capsys, stack):
+    stack.one = batch_host.command(args=["touch", tmp_path / "one"])
+    stack.two = batch_host.command(args=["sh", "-c", "echo oops; exit 3"])
+    stack.three = batch_host.command(args=["touch", tmp_path / "three"])
+
+    with pytest.raises(AbortOperation):
+        apply(stack, deploy=True)
+
+    assert (tmp_path / "one").exists()
+    assert not (tmp_path / "three").exists()
+    assert "oops" in capsys.readouterr().out
+
+
+def test_batch_commands_on_change_skipped_after_failure(batch_host, stack):
+    stack.one = batch_host.command(args=["false"])
+    stack.two = batch_host.command(args=["true"])
+    stack.after = LocalHost().command(args=["true"], run_after=[stack.two])
+
+    with pytest.raises(AbortOperation):
+        apply(stack, deploy=True)
+
+    assert not stack.after.state.get("must-run")
+
+
+def test_batch_commands_run_after(tmp_path, batch_host, stack):
+    stack.file = batch_host.file(path=tmp_path / "file", content="x")
+    stack.one = batch_host.command(
+        args=["touch", tmp_path / "one"], run_after=[stack.file]
+    )
+    stack.two = batch_host.command(
+        args=["touch", tmp_path / "two"], run_after=[stack.file]
+    )
+    apply(stack, deploy=True)
+    (tmp_path / "one").unlink()
+
+    results = apply(stack, deploy=True)
+
+    assert not results[stack.one].changed
+    assert not (tmp_path / "one").exists()
+
+
+def test_synced_directory(tmp_path, local_host, stack):
+    source = tmp_path / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "one.txt").write_text("one")
+    (source / "sub" / "two.txt").write_text("two")
+    (source / "link").symlink_to("one.txt")
+    target = tmp_path / "target"
+
+    stack.target = local_host.directory(target)
+    stack.sync = stack.target.sync(source)
+    changed_paths = []
+    stack.sync.on_change.add(lambda: changed_paths.append(stack.sync.changed_paths))
+
+    results = apply(stack, deploy=True)
+
+    assert results[stack.sync].changed
+    assert (target / "sub" / "two.txt").read_text() == "two"
+    assert (target / "link").readlink() == Path("one.txt")
+    assert changed_paths == [["link", "one.txt", "sub", "sub/two.txt"]]
+
+    results = apply(stack, deploy=True)
+    assert not results[stack.sync].changed
+    assert len(changed_paths) == 1
+
+
+def test_synced_directory_transfers_changes(tmp_path, local_host, stack):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "same.txt").write_text("same")
+    (source / "changed.txt").write_text("new")
+    (source / "touched.txt").write_text("touched")
+    target = tmp_path / "target"
+    target.mkdir()
+    (target / "same.txt").write_text("same")
+    (target / "changed.txt").write_text("old")
+    (target / "touched.txt").write_text("touched")
+    (target / "extra.txt").write_text("extra")
+    for name in ["changed.txt", "touched.txt"]:
+        os.utime(target / name, (0, 0))
+
+    stack.sync = local_host.directory(target).sync(source)
+    results = apply(stack, deploy=True, dry_run=True)
+    assert results[stack.sync].output == "changed.txt\n"
+    assert (target / "changed.txt").read_text() == "old"
+
+    apply(stack, deploy=True)
+    assert (target / "changed.txt").read_text() == "new"
+    assert (target / "extra.txt").exists()
+
+
+def test_synced_directory_delete(tmp_path, local_host, stack):
+    source = tmp_path / "source"
+    source.mkdir()
+    target = tmp_path / "target"
+    (target / "extra").mkdir(parents=True)
+    (target / "extra" / "file.txt").write_text("extra")
+
+    stack.sync = local_host.directory(target).sync(source, delete=True)
+    results = apply(stack, deploy=True)
+
+    assert results[stack.sync].output == ("deleting extra\ndeleting extra/file.txt\n")
+    assert list(target.iterdir()) == []
+
+
+def test_file_bytes_content(tmp_path, local_host, stack):
+    path = tmp_path / "foo.bin"
+    stack.foo = local_host.file(path=path, content=b"\x00\xff binary")
+
+    apply(stack, deploy=True)
+
+    assert path.read_bytes() == b"\x00\xff binary"
+    source = Path(stack.foo.action.props.args["src"].value)
+    assert not (tmp_path / "cache" / "blobs").exists()
+    assert stat.S_IMODE(source.parent.stat().st_mode) == 0o700
+
+
+def test_file_path_content(tmp_path, local_host, TestingStack):
+    source = tmp_path / "source.txt"
+    source.write_text("one\n")
+    path = tmp_path / "foo.txt"
+
+    def deploy():
+        stack = TestingStack()
+        stack.foo = local_host.file(path=path, content=source)
+        return apply(stack, deploy=True)[stack.foo.action]
+
+    assert deploy().changed
+    assert path.read_text() == "one\n"
+    assert not deploy().changed
+
+    source.write_text("two\n")
+    assert deploy().changed
+    assert path.read_text() == "two\n"
+
+
+def test_file_lazy_path_content(tmp_path, local_host, stack):
+    source = tmp_path / "source.txt"
+    source.write_text("hello\n")
+    path = tmp_path / "foo.txt"
+    stack.foo = local_host.file(path=path, content=Lazy(lambda: source))
+
+    apply(stack, deploy=True)
+
+    assert path.read_text() == "hello\n"
+
+
+def test_file_checksum_cached(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("hello\n")
+    assert file_checksum(source) == sha1(b"hello\n").hexdigest()
+
+    source.write_text("bye\n")
+    assert file_checksum(source) == sha1(b"bye\n").hexdigest()
+
+
+def test_host_group_run(stack):
+    stack.group = HostGroup(hosts=dict(one=LocalHost(), two=LocalHost()))
+
+    results = stack.group.run("echo", "hi")
+
+    assert list(results) == ["one", "two"]
+    assert results["one"].stdout == "hi\n"
+    assert results["two"].stdout == "hi\n"
+
+
+def test_host_group_run_does_not_raise(stack):
+    stack.group = HostGroup(hosts=dict(one=LocalHost(), two=LocalHost()))
+
+    results = stack.group.run("false")
+
+    assert results["one"].failed
+    assert results["two"].failed
+
+
+def test_host_group_file(tmp_path, stack):
+    stack.group = HostGroup(hosts=dict(one=LocalHost(), two=LocalHost()))
+    stack.hello = stack.group.file(path=tmp_path / "hello.txt", content="hi\n")
+
+    apply(stack, deploy=True)
+
+    assert (tmp_path / "hello.txt").read_text() == "hi\n"
+    assert stack.hello.one.host is stack.group.one
+    assert stack.hello.two.host is stack.group.two
+
+
+def test_host_group_each(tmp_path, stack):
+    stack.group = HostGroup(hosts=dict(one=LocalHost(), two=LocalHost()))
+    stack.hello = stack.group.each(
+        lambda host: host.file(
+            path=tmp_path / f"{host._meta.name}.txt",
+            content="hi\n",
+        )
+    )
+
+    apply(stack, deploy=True)
+
+    assert (tmp_path / "one.txt").read_text() == "hi\n"
+    assert (tmp_path / "two.txt").read_text() == "hi\n"
+
+
+@pytest.mark.parametrize("code", [0, 3])
+def test_host_group_cli_run(stack, code):
+    stack.group = HostGroup(hosts=dict(one=LocalHost(), two=LocalHost()))
+    cli = get_cli(stack.group)
+    result = CliRunner().invoke(
+        cli,
+        ["run", "-j", "1", "sh", "-c", f"echo hi; exit {code}"],
+        catch_exceptions=False,
+    )
+
+    status = "failed" if code else "ok"
+    assert result.exit_code == (1 if code else 0)
+    assert result.output.splitlines() == [
+        f"one: {status} (exit code {code})",
+        "hi",
+        f"two: {status} (exit code {code})",
+        "hi",
+        "0 ok, 2 failed" if code else "2 ok, 0 failed",
+    ]
+    assert stack.group.props.concurrency == 10
+
+
+@pytest.mark.parametrize("name", ["web-1", "_one", "class", "hosts", "run", "each"])
+def test_host_group_invalid_host_name(name):
+    with pytest.raises(ValueError):
+        HostGroup(hosts={name: LocalHost()})
+
+
+def test_host_group_run_in_operation_context(stack, monkeypatch):
+    seen = []
+
+    def mock_run(self, *args, **kwargs):
+        seen.append(current_operation())
+        return Result()
+
+    monkeypatch.setattr(LocalHost, "run", mock_run)
+    stack.group = HostGroup(hosts=dict(one=LocalHost(), two=LocalHost()))
+    op = Operation(deploy=True)
+
+    with op:
+        stack.group.run("true", concurrency=1)
+
+    assert seen == [op, op]
@@ -1,8 +1,14 @@
+import tempfile
+import time
 from pathlib import Path
 
 import pytest
 
+from opslib import places
+from opslib.ansible import ansible_session
+from opslib.lazy import evaluate
 from opslib.operations import apply
+from opslib.places import SshHost
 
 
 @pytest.mark.slow
@@ -108,3 +114,170 @@ def test_command_space_in_cwd_fails(ssh_container, stack):
         apply(stack, deploy=True)
 
     assert error.value.args == ("CWD must not contain special characters",)
+
+
+def test_fast_ansible_defaults(monkeypatch, tmp_path):
+    monkeypatch.setattr(places, "MAX_CONTROL_PATH_DIR", 200)
+    monkeypatch.setenv("OPSLIB_CACHE_DIR", str(tmp_path / "cache"))
+    host = SshHost(hostname="example.com")
+    variables = dict(host.ansible_variables)
+    assert variables["ansible_pipelining"] is True
+    assert variables["ansible_ssh_args"] == (
+        "-C -o ControlMaster=auto -o ControlPersist=60s"
+    )
+    assert variables["ansible_control_path_dir"] == str(host.control_path_dir)
+    assert variables["ansible_control_path"] == "%(directory)s/%%C"
+
+
+def test_ansible_session_creates_control_path_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(places, "MAX_CONTROL_PATH_DIR", 200)
+    monkeypatch.setenv("OPSLIB_CACHE_DIR", str(tmp_path / "cache"))
+    host = SshHost(hostname="example.com")
+    assert not host.control_path_dir.exists()
+
+    with ansible_session([(evaluate(host.hostname), host.ansible_variables)]):
+        assert host.control_path_dir.stat().st_mode & 0o777 == 0o700
+
+
+def test_fast_ansible_opt_out():
+    host = SshHost(hostname="example.com", pipelining=False, control_master=False)
+    variables = dict(host.ansible_variables)
+    assert "ansible_pipelining" not in variables
+    assert "ansible_control_path" not in variables
+    assert variables["ansible_ssh_args"] == "-C -o ControlMaster=no"
+
+
+@pytest.mark.slow
+def test_agent(ssh_container, stack):
+    host = SshHost(
+        hostname=ssh_container.props.hostname,
+        config_file=ssh_container.props.config_file,
+        use_agent=True,
+        native=True,
+    )
+    stack.foo = host.file(path=Path("/tmp/foo.txt"), content="hello world")
+    apply(stack, deploy=True)
+
+    assert host.run("cat /tmp/foo.txt").stdout == "hello world"
+    assert host.run("cat", input="hi").stdout == "hi"
+    assert host.sudo().run("id -u").stdout == "0\n"
+
+
+@pytest.fixture
+def ssh_calls(monkeypatch, tmp_path):
+    # keep the control path directory inside tmp_path
+    monkeypatch.setattr(places, "MAX_CONTROL_PATH_DIR", 200)
+    calls = []
+
+    def mock_run(*args, **kwargs):
+        calls.append(args)
+
+    monkeypatch.setattr(places, "run", mock_run)
+    return calls
+
+
+def test_run_control_master(ssh_calls):
+    host = SshHost(hostname="example.com")
+    host.run("true")
+    control_path_dir = host.control_path_dir
+    assert ssh_calls == [
+        (
+            "ssh",
+            "example.com",
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={control_path_dir}/%C",
+            "-o",
+            "ControlPersist=60s",
+            "--",
+            "true",
+        )
+    ]
+    assert control_path_dir.stat().st_mode & 0o777 == 0o700
+
+
+def test_run_control_master_opt_out(ssh_calls):
+    host = SshHost(hostname="example.com", control_master=False)
+    host.run("true")
+    assert ssh_calls == [("ssh", "example.com", "--", "true")]
+
+
+def test_control_path_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(places, "MAX_CONTROL_PATH_DIR", 200)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path / "tmp"))
+    monkeypatch.setenv("OPSLIB_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    host = SshHost(hostname="example.com")
+    assert host.control_path_dir == tmp_path / "cache/ssh"
+
+    monkeypatch.setenv("OPSLIB_CACHE_DIR", str(tmp_path / ("x" * 200)))
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path / "run"))
+    assert host.control_path_dir == tmp_path / "run/opslib-ssh"
+
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    assert host.control_path_dir.parent == tmp_path / "tmp"
+
+    # nothing is created until a connection is made
+    assert sorted(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("problem", ["mode", "symlink"])
+def test_control_path_dir_refused(tmp_path, monkeypatch, ssh_calls, problem):
+    monkeypatch.setenv("OPSLIB_CACHE_DIR", str(tmp_path / "cache"))
+    if problem == "mode":
+        (tmp_path / "cache/ssh").mkdir(mode=0o777, parents=True)
+        (tmp_path / "cache/ssh").chmod(0o777)
+    else:
+        (tmp_path / "elsewhere").mkdir(mode=0o700)
+        (tmp_path / "cache").mkdir()
+        (tmp_path / "cache/ssh").symlink_to(tmp_path / "elsewhere")
+
+    host = SshHost(hostname="example.com")
+
+    with pytest.raises(RuntimeError) as error:
+        host.run("true")
+
+    assert "Refusing to use" in str(error.value)
+    assert ssh_calls == []
+
+
+def test_control_master_closed_on_exit(monkeypatch, ssh_calls):
+    monkeypatch.setattr(places, "_control_masters", set())
+    host = SshHost(hostname="example.com", control_persist=None)
+    host.run("true")
+    host.run("false")
+    assert ssh_calls[0][7] == "ControlPersist=yes"
+
+    places._close_control_masters()
+    assert ssh_calls[2] == (*ssh_calls[0][:8], "-O", "exit")
+
+
+@pytest.mark.slow
+def test_ansible_ssh_latency(ssh_container, TestingStack, record_property):
+    def refresh_files(host):
+        class Bench(TestingStack):
+            def build(self):
+                for n in range(10):
+                    setattr(
+                        self,
+                        f"file{n}",
+                        host.file(path=Path(f"/tmp/bench-{n}.txt"), content=f"{n}"),
+                    )
+
+        t0 = time.monotonic()
+        apply(Bench(), refresh=True)
+        return time.monotonic() - t0
+
+    props = dict(
+        hostname=ssh_container.props.hostname,
+        config_file=ssh_container.props.config_file,
+    )
+    refresh_files(SshHost(**props))  # warm up
+
+    # wall-clock timings are too noisy to assert on; they are reported as
+    # properties of the test, e.g. in the JUnit XML report
+    slow = refresh_files(SshHost(**props, pipelining=False, control_master=False))
+    fast = refresh_files(SshHost(**props))
+    record_property("seconds_without_pipelining", round(slow, 2))
+    record_property("seconds_with_pipelining", round(fast, 2))
@@ -1,13 +1,33 @@
 import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from datetime import timedelta
 from hashlib import sha256
+from textwrap import dedent
+from types import SimpleNamespace
 
 import pytest
 from click.testing import CliRunner
 
+from opslib import terraform
 from opslib.cli import get_main_cli
-from opslib.lazy import NotAvailable, evaluate
+from opslib.lazy import Lazy, NotAvailable, evaluate
+from opslib.local import LocalRunResult
 from opslib.operations import apply
-from opslib.terraform import TerraformProvider, TerraformResource
+from opslib.terraform import (
+    TerraformProvider,
+    TerraformResource,
+    TerraformResult,
+    TerraformWorkspace,
+    directory_lock,
+    get_plugin_cache_directory,
+    prune_plugin_cache,
+    read_outputs,
+)
+from opslib.utils import get_cache_directory
 
 
 @pytest.fixture
@@ -64,9 +84,8 @@ def test_diff(local_stack, capsys):
     captured = capsys.readouterr()
     assert results[stack.file].changed
     assert "# local_file.thing will be created" in captured.out
-    assert '+ resource "local_file" "thing"' in captured.out
-    assert '+ content              = "world"' in captured.out
-    assert f'+ filename             = "{stack.path}"' in captured.out
+    assert '+ content = "world"' in captured.out
+    assert f'+ filename = "{stack.path}"' in captured.out
 
 
 @pytest.mark.slow
@@ -105,7 +124,7 @@ def test_no_global_plugin_cache(local_stack, monkeypatch):
     assert arch.is_symlink()
 
     assert arch.readlink() == (
-        stack.provider.plugin_cache_path
+        get_plugin_cache_directory()
         / "registry.terraform.io/hashicorp/local"
         / version.name
         / arch.name
@@ -198,3 +217,624 @@ def test_data_source(stack, tmp_path):
     )
     apply(stack, deploy=True)
     assert evaluate(stack.source.output["content"]) == "world"
+
+
+def resource_change(address, actions, before=None, after=None, **kwargs):
+    return dict(
+        address=address,
+        change=dict(actions=actions, before=before, after=after, **kwargs),
+    )
+
+
+PLAN = dict(
+    resource_changes=[
+        resource_change(
+            "local_file.records-one",
+            ["create"],
+            after=dict(content="one", id=None),
+            after_unknown=dict(id=True),
+        ),
+        resource_change(
+            "local_file.records-two",
+            ["update"],
+            before=dict(content="old", filename="two.txt"),
+            after=dict(content="two", filename="two.txt"),
+        ),
+        resource_change("local_file.records-three", ["no-op"]),
+    ],
+)
+
+
+@pytest.fixture
+def terraform_calls(monkeypatch):
+    terraform_calls = SimpleNamespace(calls=[], stdout={"show": json.dumps({})})
+
+    def mock_run(*args, cwd, extra_env, **kwargs):
+        terraform_calls.calls.append(args[1:])
+        terraform_calls.env = extra_env
+        stdout = terraform_calls.stdout.get(args[1], "")
+        completed = subprocess.CompletedProcess(args, 0, stdout.encode("utf8"), b"")
+        return LocalRunResult(completed, encoding="utf8")
+
+    monkeypatch.setattr(terraform, "run", mock_run)
+    return terraform_calls
+
+
+@pytest.fixture
+def workspace_stack(stack):
+    stack.provider = TerraformProvider(name="local", source="hashicorp/local")
+    stack.records = TerraformWorkspace()
+    for name in ["one", "two", "three"]:
+        setattr(
+            stack.records,
+            name,
+            stack.provider.resource(type="local_file", args=dict(content=name)),
+        )
+
+    return stack
+
+
+def test_result_from_plan():
+    result = TerraformResult(None, PLAN)
+    assert result.changed
+    assert [change["address"] for change in result.changes] == [
+        "local_file.records-one",
+        "local_file.records-two",
+    ]
+    assert (
+        result.output
+        == dedent(
+            """\
+        # local_file.records-one will be created
+          + content = "one"
+          + id = (known after apply)
+
+        # local_file.records-two will be updated in-place
+          ~ content = "old" -> "two"
+        """
+        ).strip()
+    )
+
+    assert not TerraformResult(None, PLAN, address="local_file.records-three").changed
+
+
+def test_result_sensitive_values():
+    plan = dict(
+        resource_changes=[
+            resource_change(
+                "random_password.db",
+                ["delete", "create"],
+                before=dict(result="hunter2", length=8),
+                after=dict(result=None, length=16),
+                after_unknown=dict(result=True),
+                before_sensitive=dict(result=True),
+                after_sensitive=dict(result=True),
+            ),
+        ],
+    )
+    assert (
+        TerraformResult(None, plan).output
+        == dedent(
+            """\
+        # random_password.db will be replaced
+          ~ length = 8 -> 16
+          ~ result = (sensitive value) -> (known after apply)
+        """
+        ).strip()
+    )
+
+
+def test_output_only_changes_applied(stack, terraform_calls):
+    terraform_calls.stdout["show"] = json.dumps(
+        dict(
+            resource_changes=[resource_change("local_file.thing", ["no-op"])],
+            output_changes={
+                "id": dict(actions=["create"], after=None, after_sensitive=True),
+            },
+        )
+    )
+    stack.provider = TerraformProvider(name="local")
+    stack.file = stack.provider.resource(type="local_file", output=["id"])
+
+    results = apply(stack, deploy=True)
+    assert ("apply", "opslib.tfplan") in terraform_calls.calls
+    assert results[stack.file].changed
+    assert results[stack.file].output == (
+        "Changes to outputs:\n  + id = (sensitive value)"
+    )
+
+
+def test_workspace_config(workspace_stack):
+    config = workspace_stack.records.config
+    assert config["terraform"] == {
+        "required_providers": {"local": {"source": "hashicorp/local"}},
+    }
+    assert config["resource"] == {
+        "local_file": {
+            "records-one": {"content": "one"},
+            "records-two": {"content": "two"},
+            "records-three": {"content": "three"},
+        },
+    }
+
+
+def test_workspace_skips_unavailable_members(workspace_stack):
+    stack = workspace_stack
+
+    def not_available():
+        raise NotAvailable("not yet")
+
+    stack.records.four = stack.provider.resource(
+        type="local_file", args=Lazy(not_available)
+    )
+    assert "records-four" not in stack.records.config["resource"]["local_file"]
+
+
+def test_workspace_output_names(stack):
+    stack.provider = TerraformProvider(name="local", workspace=True)
+    stack.file = stack.provider.resource(
+        type="local_file", args=dict(content="hi"), output=["id"]
+    )
+
+    assert stack.file.workspace is stack.provider.workspace
+    assert stack.file.config["output"] == {
+        "file__id": {"value": "${local_file.file.id}", "sensitive": True},
+    }
+
+
+def test_workspace_deploy_runs_terraform_once(workspace_stack, terraform_calls):
+    stack = workspace_stack
+    terraform_calls.stdout["show"] = json.dumps(PLAN)
+
+    results = apply(stack, deploy=True)
+
+    assert terraform_calls.calls == [
+        ("init", "-upgrade"),
+        (
+            "plan",
+            "-out=opslib.tfplan",
+            "-refresh=false",
+            "-target=local_file.records-one",
+            "-target=local_file.records-two",
+            "-target=local_file.records-three",
+        ),
+        ("show", "-json", "opslib.tfplan"),
+        ("apply", "opslib.tfplan"),
+    ]
+    assert results[stack.records.one].changed
+    assert "will be created" in results[stack.records.one].output
+    assert results[stack.records.two].changed
+    assert not results[stack.records.three].changed
+
+    terraform_calls.calls.clear()
+    apply(stack, deploy=True)
+    assert terraform_calls.calls == []
+
+
+def test_workspace_refresh_stale_only(workspace_stack, terraform_calls):
+    stack = workspace_stack
+    terraform_calls.stdout["show"] = json.dumps(PLAN)
+    members = [stack.records.one, stack.records.two, stack.records.three]
+
+    apply(stack, refresh=True)
+    for member in members:
+        assert member.uptodate.refreshed is not None
+        member.refresh_ttl = timedelta(hours=1)
+
+    terraform_calls.calls.clear()
+    apply(stack, refresh=True, stale_only=True)
+    assert terraform_calls.calls == []
+
+
+def test_workspace_dependent_members_retried(stack, terraform_calls, monkeypatch):
+    terraform_calls.stdout["show"] = json.dumps(PLAN)
+    mock_run = terraform.run
+
+    def run_and_write_state(*args, cwd, **kwargs):
+        if args[1] == "apply":
+            outputs = dict(zone__id=dict(value="zone-id"))
+            (cwd / "terraform.tfstate").write_text(json.dumps(dict(outputs=outputs)))
+        return mock_run(*args, cwd=cwd, **kwargs)
+
+    monkeypatch.setattr(terraform, "run", run_and_write_state)
+    stack.provider = TerraformProvider(name="local", workspace=True)
+    stack.zone = stack.provider.resource(type="local_file", output=["id"])
+    stack.record = stack.provider.resource(
+        type="local_file", args=dict(content=stack.zone.output["id"])
+    )
+
+    results = apply(stack, deploy=True)
+
+    assert not results[stack.record].failed
+    plans = [call for call in terraform_calls.calls if call[0] == "plan"]
+    assert [plan[-1] for plan in plans] == [
+        "-target=local_file.zone",
+        "-target=local_file.record",
+    ]
+    assert stack.record.config["resource"]["local_file"]["record"] == dict(
+        content="zone-id"
+    )
+
+
+def test_workspace_single_member(workspace_stack, terraform_calls):
+    stack = workspace_stack
+    terraform_calls.stdout["show"] = json.dumps(PLAN)
+
+    results = apply(stack.records.two, deploy=True, dry_run=True)
+
+    assert terraform_calls.calls[-2] == (
+        "plan",
+        "-out=opslib.tfplan",
+        "-refresh=false",
+        "-target=local_file.records-two",
+    )
+    assert results[stack.records.two].changed
+    assert "records-one" not in results[stack.records.two].output
+
+
+def test_standalone_resource_unchanged(stack):
+    stack.provider = TerraformProvider(name="local")
+    stack.file = stack.provider.resource(type="local_file", output=["id"])
+
+    assert stack.file.workspace is None
+    assert stack.file.address == "local_file.thing"
+    assert stack.file.config["output"]["id"]["value"] == "${local_file.thing.id}"
+
+
+@pytest.fixture
+def create_file_stack(TestingStack, tmp_path, terraform_calls):
+    # the plan always has changes, so the resource is never up to date
+    terraform_calls.stdout["show"] = json.dumps(
+        dict(resource_changes=[resource_change("local_file.thing", ["create"])])
+    )
+
+    def create_file_stack(version="~> 2.3"):
+        stack = TestingStack()
+        stack.provider = TerraformProvider(
+            name="local",
+            source="hashicorp/local",
+            version=version,
+        )
+        stack.file = stack.provider.resource(
+            type="local_file",
+            args=dict(content="world", filename=str(tmp_path / "hello.txt")),
+        )
+        return stack
+
+    return create_file_stack
+
+
+def fake_init(stack):
+    with stack.file.terraform_directory() as tfdir:
+        (tfdir / ".terraform").mkdir(parents=True, exist_ok=True)
+        return tfdir
+
+
+def test_init_skipped_when_unchanged(create_file_stack, terraform_calls):
+    stack = create_file_stack()
+    apply(stack, deploy=True, dry_run=True)
+    assert terraform_calls.calls[0] == ("init", "-upgrade")
+    fake_init(stack)
+
+    terraform_calls.calls.clear()
+    apply(create_file_stack(), deploy=True, dry_run=True)
+    assert terraform_calls.calls[0] == ("plan", "-out=opslib.tfplan", "-refresh=false")
+
+
+def test_init_upgrade_when_requirements_change(create_file_stack, terraform_calls):
+    stack = create_file_stack()
+    apply(stack, deploy=True, dry_run=True)
+    fake_init(stack)
+
+    terraform_calls.calls.clear()
+    apply(create_file_stack(version="~> 2.4"), deploy=True, dry_run=True)
+    assert terraform_calls.calls[0] == ("init", "-upgrade")
+
+
+def test_init_when_lock_file_changes(create_file_stack, terraform_calls):
+    stack = create_file_stack()
+    apply(stack, deploy=True, dry_run=True)
+    tfdir = fake_init(stack)
+    (tfdir / ".terraform.lock.hcl").write_text("# changed\n")
+
+    terraform_calls.calls.clear()
+    apply(create_file_stack(), deploy=True, dry_run=True)
+    assert terraform_calls.calls[0] == ("init",)
+
+
+def test_init_upgrade_providers(create_file_stack, terraform_calls):
+    stack = create_file_stack()
+    apply(stack, deploy=True, dry_run=True)
+    fake_init(stack)
+
+    terraform_calls.calls.clear()
+    cli = get_main_cli(create_file_stack)
+    CliRunner().invoke(
+        cli, ["-", "diff", "--upgrade-providers"], obj={}, catch_exceptions=False
+    )
+    assert terraform_calls.calls[0] == ("init", "-upgrade")
+
+
+def add_plugin(version, size, mtime):
+    path = (
+        get_plugin_cache_directory()
+        / "registry.terraform.io/hashicorp/local"
+        / version
+        / "linux_amd64"
+    )
+    path.mkdir(parents=True)
+    (path / "terraform-provider-local").write_bytes(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def link_plugin(tfdir, plugin):
+    link = tfdir / ".terraform/providers" / plugin.relative_to(plugin.parents[4])
+    link.parent.mkdir(parents=True)
+    link.symlink_to(plugin)
+
+
+def test_plugin_cache_shared(create_file_stack, terraform_calls, monkeypatch):
+    monkeypatch.delenv("TF_PLUGIN_CACHE_DIR", raising=False)
+    cache_dir = get_cache_directory() / "terraform/plugins"
+    stack = create_file_stack()
+    assert get_plugin_cache_directory() == cache_dir
+
+    apply(stack, deploy=True, dry_run=True)
+    assert terraform_calls.env["TF_PLUGIN_CACHE_DIR"] == str(cache_dir)
+    assert cache_dir.is_dir()
+
+
+def test_prune_plugin_cache():
+    old = add_plugin("2.3.0", 300, mtime=1000)
+    used = add_plugin("2.4.0", 300, mtime=2000)
+    kept = add_plugin("2.4.1", 300, mtime=500)
+
+    assert prune_plugin_cache(700, keep=[kept]) == [old]
+    assert not old.parent.exists()
+    assert used.exists() and kept.exists()
+
+    assert prune_plugin_cache(700) == []
+
+
+def test_prune_plugin_cache_cli(create_file_stack):
+    old = add_plugin("2.3.0", 2048, mtime=1000)
+    add_plugin("2.4.0", 100, mtime=2000)
+
+    cli = get_main_cli(create_file_stack)
+    result = CliRunner().invoke(
+        cli, ["provider", "prune-plugin-cache", "1k"], obj={}, catch_exceptions=False
+    )
+    assert result.output == f"Removed {old}\n"
+
+
+def test_init_when_plugins_missing(create_file_stack, terraform_calls):
+    stack = create_file_stack()
+    apply(stack, deploy=True, dry_run=True)
+    tfdir = fake_init(stack)
+    plugin = add_plugin("2.3.0", 10, mtime=1000)
+    link_plugin(tfdir, plugin)
+    shutil.rmtree(plugin)
+
+    terraform_calls.calls.clear()
+    apply(create_file_stack(), deploy=True, dry_run=True)
+    assert terraform_calls.calls[0] == ("init",)
+
+
+def test_init_prunes_plugin_cache(create_file_stack, terraform_calls, monkeypatch):
+    monkeypatch.setenv("OPSLIB_TERRAFORM_PLUGIN_CACHE_SIZE", "1k")
+    stack = create_file_stack()
+    tfdir = fake_init(stack)
+    old = add_plugin("2.3.0", 1000, mtime=1000)
+    used = add_plugin("2.4.0", 1000, mtime=500)
+    link_plugin(tfdir, used)
+
+    apply(stack, deploy=True, dry_run=True)
+    assert terraform_calls.calls[0] == ("init", "-upgrade")
+    assert not old.exists()
+    assert used.stat().st_mtime > 1000
+
+
+def test_offline_uses_plugin_cache_as_mirror(
+    create_file_stack, terraform_calls, monkeypatch
+):
+    monkeypatch.setenv("OPSLIB_TERRAFORM_OFFLINE", "1")
+    stack = create_file_stack()
+    apply(stack, deploy=True, dry_run=True)
+
+    env = terraform_calls.env
+    assert env["TF_PLUGIN_CACHE_DIR"] == ""
+    config = open(env["TF_CLI_CONFIG_FILE"]).read()
+    assert "filesystem_mirror" in config
+    assert json.dumps(str(get_plugin_cache_directory())) in config
+
+
+def write_tfstate(component, outputs):
+    with component.terraform_directory() as tfdir:
+        tfdir.mkdir(exist_ok=True)
+        state = dict(version=4, outputs=outputs)
+        (tfdir / "terraform.tfstate").write_text(json.dumps(state))
+
+
+def test_output_read_from_state(stack, terraform_calls):
+    stack.file = TerraformResource(type="local_file", output=["id"])
+    with pytest.raises(NotAvailable):
+        evaluate(stack.file.output["id"])
+
+    write_tfstate(stack.file, dict(id=dict(value="one", sensitive=True)))
+    assert evaluate(stack.file.output["id"]) == "one"
+    assert terraform_calls.calls == []
+
+
+def test_read_outputs_after_change(stack):
+    stack.file = TerraformResource(type="local_file", output=["id"])
+    with stack.file.terraform_directory() as tfdir:
+        assert read_outputs(tfdir) == {}
+
+        write_tfstate(stack.file, dict(id=dict(value="one")))
+        assert read_outputs(tfdir) == dict(id=dict(value="one"))
+
+        write_tfstate(stack.file, dict(id=dict(value="second")))
+        assert read_outputs(tfdir) == dict(id=dict(value="second"))
+
+
+def test_read_outputs_waits_for_lock(tmp_path):
+    path = tmp_path / "terraform.tfstate"
+    locked = threading.Event()
+
+    def write_slowly():
+        with directory_lock(tmp_path):
+            path.write_text('{"outputs": ')
+            locked.set()
+            time.sleep(0.1)
+            path.write_text(json.dumps(dict(outputs=dict(id=dict(value="one")))))
+
+    thread = threading.Thread(target=write_slowly)
+    thread.start()
+    locked.wait()
+    assert read_outputs(tmp_path) == dict(id=dict(value="one"))
+    thread.join()
+
+
+def test_workspace_output_read_from_state(stack, terraform_calls):
+    stack.records = TerraformWorkspace()
+    stack.records.one = TerraformResource(type="local_file", output=["id"])
+    write_tfstate(stack.records, {"records-one__id": dict(value="one")})
+
+    assert evaluate(stack.records.one.output["id"]) == "one"
+    assert terraform_calls.calls == []
+
+
+@pytest.fixture
+def concurrent_terraform(monkeypatch):
+    terraform_calls = SimpleNamespace(calls=[], running=0, max_running=0)
+    lock = threading.Lock()
+    plan = dict(resource_changes=[resource_change("local_file.thing", ["create"])])
+
+    def mock_run(*args, cwd, extra_env, **kwargs):
+        with lock:
+            terraform_calls.calls.append(args[1:])
+            terraform_calls.running += 1
+            terraform_calls.max_running = max(
+                terraform_calls.max_running, terraform_calls.running
+            )
+
+        time.sleep(0.05)
+        if args[1] == "apply":
+            outputs = dict(id=dict(value=cwd.parent.name))
+            (cwd / "terraform.tfstate").write_text(json.dumps(dict(outputs=outputs)))
+
+        with lock:
+            terraform_calls.running -= 1
+
+        stdout = json.dumps(plan) if args[1] == "show" else ""
+        completed = subprocess.CompletedProcess(args, 0, stdout.encode("utf8"), b"")
+        return LocalRunResult(completed, encoding="utf8")
+
+    monkeypatch.setattr(terraform, "run", mock_run)
+    return terraform_calls
+
+
+def test_concurrent_resources(stack, concurrent_terraform):
+    stack.provider = TerraformProvider(name="local", concurrency=3)
+    for n in range(6):
+        setattr(stack, f"file{n}", stack.provider.resource(type="local_file"))
+
+    results = apply(stack, deploy=True)
+
+    assert all(results[getattr(stack, f"file{n}")].changed for n in range(6))
+    assert concurrent_terraform.max_running == 3
+
+
+def test_concurrent_dependencies_retried(stack, concurrent_terraform):
+    stack.provider = TerraformProvider(name="local", concurrency=2)
+    stack.first = stack.provider.resource(type="local_file", output=["id"])
+    stack.second = stack.provider.resource(
+        type="local_file",
+        args=dict(content=stack.first.output["id"]),
+    )
+
+    results = apply(stack, deploy=True)
+
+    assert not results[stack.second].failed
+    assert stack.second.config["resource"]["local_file"]["thing"] == dict(
+        content="_statedir"
+    )
+
+
+@pytest.mark.parametrize("opaque", [False, True])
+def test_concurrent_dependencies_stale_output(stack, concurrent_terraform, opaque):
+    stack.provider = TerraformProvider(name="local", concurrency=2)
+    stack.first = stack.provider.resource(type="local_file", output=["id"])
+    if opaque:
+        args = Lazy(lambda: dict(content=evaluate(stack.first.output["id"])))
+    else:
+        args = dict(content=stack.first.output["id"])
+    stack.second = stack.provider.resource(type="local_file", args=args)
+
+    with stack.first.terraform_directory() as tfdir:
+        tfdir.mkdir(parents=True, exist_ok=True)
+        outputs = dict(id=dict(value="stale"))
+        (tfdir / "terraform.tfstate").write_text(json.dumps(dict(outputs=outputs)))
+
+    apply(stack, deploy=True)
+
+    assert concurrent_terraform.max_running == 1
+    assert stack.second.config["resource"]["local_file"]["thing"] == dict(
+        content="_statedir"
+    )
+
+
+def test_parallelism(stack, concurrent_terraform):
+    stack.provider = TerraformProvider(name="local", parallelism=4)
+    stack.file = stack.provider.resource(type="local_file")
+
+    apply(stack, deploy=True)
+
+    assert ("plan", "-parallelism=4", "-out=opslib.tfplan", "-refresh=false") in (
+        concurrent_terraform.calls
+    )
+    assert ("apply", "-parallelism=4", "opslib.tfplan") in concurrent_terraform.calls
+    assert ("init", "-upgrade") in concurrent_terraform.calls
+
+
+def test_concurrent_upgrade_providers(TestingStack, concurrent_terraform):
+    def create_stack():
+        stack = TestingStack()
+        stack.provider = TerraformProvider(name="local", concurrency=2)
+        stack.one = stack.provider.resource(type="local_file")
+        stack.two = stack.provider.resource(type="local_file")
+        return stack
+
+    stack = create_stack()
+    apply(stack, deploy=True, dry_run=True)
+    for component in [stack.one, stack.two]:
+        with component.terraform_directory() as tfdir:
+            (tfdir / ".terraform").mkdir()
+
+    concurrent_terraform.calls.clear()
+    apply(create_stack(), deploy=True, dry_run=True)
+    assert ("init", "-upgrade") not in concurrent_terraform.calls
+
+    apply(create_stack(), deploy=True, dry_run=True, upgrade_providers=True)
+    assert concurrent_terraform.calls.count(("init", "-upgrade")) == 2
+
+
+def test_directory_lock(tmp_path):
+    lock = directory_lock(tmp_path / "tf")
+    assert directory_lock(tmp_path / "tf") is lock
+    acquired = []
+
+    def acquire():
+        with lock:
+            acquired.append(True)
+
+    with lock:
+        with lock:
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            thread.join(0.1)
+            assert acquired == []
+
+    thread.join()
+    assert acquired == [True]
@@ -1,3 +1,4 @@
+from datetime import timedelta
 from unittest.mock import Mock
 
 import pytest
@@ -6,6 +7,7 @@ from opslib.components import Component
 from opslib.operations import apply
 from opslib.props import Prop
 from opslib.results import Result
+from opslib.state import StatefulMixin
 from opslib.uptodate import UpToDate
 
 
@@ -101,3 +103,75 @@ def test_change(Bench):
     results = apply(bench2, deploy=True)
     assert results[bench2.target].changed
     assert bench.path.read_text() == "different"
+
+
+@pytest.fixture
+def RefreshBench(TestingStack):
+    class Target(StatefulMixin, Component):
+        uptodate = UpToDate(refresh_ttl=timedelta(hours=1))
+
+        @uptodate.snapshot
+        def name(self):
+            return self._meta.name
+
+        @uptodate.refresh
+        def refresh(self):
+            self._meta.stack.log.append(self.name())
+            return Result()
+
+    class RefreshBench(TestingStack):
+        def build(self):
+            self.log = []
+            self.a = Target()
+            self.b = Target()
+            self.c = Target()
+
+    return RefreshBench
+
+
+def test_refresh_stale_only(RefreshBench):
+    bench = RefreshBench()
+    apply(bench.a, refresh=True)
+    apply(bench, refresh=True, stale_only=True)
+    assert bench.log == ["a", "b", "c"]
+
+    bench.log.clear()
+    apply(bench, refresh=True, stale_only=True)
+    assert bench.log == []
+
+    bench.b.refresh_ttl = timedelta(0)
+    apply(bench, refresh=True, stale_only=True)
+    assert bench.log == ["b"]
+
+
+def test_refresh_budget_stalest_first(RefreshBench):
+    bench = RefreshBench()
+    apply(bench.b, refresh=True)
+    apply(bench.a, refresh=True)
+    bench.log.clear()
+
+    apply(bench, refresh=True, budget=timedelta(minutes=5))
+    assert bench.log == ["c", "b", "a"]
+
+
+def test_refresh_budget_spent(RefreshBench):
+    bench = RefreshBench()
+    results = apply(bench, refresh=True, budget=timedelta(0))
+    assert results == {}
+    assert bench.log == []
+
+
+def test_deploy_and_destroy_keep_refresh_time(RefreshBench, monkeypatch):
+    bench = RefreshBench()
+    monkeypatch.setattr("opslib.uptodate.time.time", lambda: 1000.0)
+    apply(bench.a, refresh=True)
+    assert bench.a.uptodate.refreshed == 1000.0
+
+    monkeypatch.setattr("opslib.uptodate.time.time", lambda: 2000.0)
+    bench.a.uptodate.set(True)
+    bench.a.uptodate.set(False)
+    assert bench.a.uptodate.refreshed == 1000.0
+
+    bench.b.uptodate.set(True)
+    assert bench.b.uptodate.refreshed is None
+    assert bench.b.uptodate.is_stale()